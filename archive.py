@@ -0,0 +1,359 @@
+"""
+Twilight Monitor Long-Term Archive
+
+Packs the raw files of finished nights into one compressed bundle per month
+(`DATA/archive/YYYYMM.zip`) and reads them back transparently:
+
+1) The raw electrometer vectors of a night are grouped in chunks of exposures;
+   each field (`time`, `CURR`) of a chunk is byte-shuffled and compressed
+   (zlib, or blosc when installed) and stored as one zip member
+2) The mount files are stored as deflated zip members
+3) An index per night (`index/YYYYMMDD.json`) maps the relative keys of the
+   files to their chunk and position
+4) The nightly CSV stores the relative keys (e.g. 'keysighB2987A/202410/20241002_1.npy')
+   instead of absolute paths of the acquisition computer
+5) The raw files are deleted only after reading the bundle back (`--delete`)
+
+Byte shuffling groups the bytes of the same significance of the float samples,
+which compresses much better than the raw doubles.
+
+The readers (`rawstats.read_vector`, `pointing.read_mount_file`) use the raw
+file when it exists and the bundle otherwise. Only the chunks that a query
+touches are decompressed, and the last chunks are kept in memory, so reading
+the exposures of a night in order decompresses each chunk once.
+
+Usage:
+    python archive.py pack 202409 --delete      # all finished nights of a month
+    python archive.py pack 20240930             # one night
+    python archive.py info 202409
+"""
+import argparse
+import io
+import json
+import os
+import re
+import shutil
+import time
+import zipfile
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from loader import data_key, list_nights, night_filename, resolve_data_path, resolve_filename
+from config import databaseRoot
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+ARCHIVE_DIRNAME = 'archive'
+CHUNK_SIZE = 256        # exposures per chunk
+ZLIB_LEVEL = 6
+MIN_AGE = 1             # days since the last write of the nightly file, the last night is still being written
+CHUNK_CACHE_SIZE = 16   # decompressed chunks kept in memory
+PATH_COLUMNS = ['electrometer_filename', 'mount_filename']
+
+
+def bundle_filename(month, root=None):
+    if root is None:
+        root = databaseRoot
+    return os.path.join(root, 'DATA', ARCHIVE_DIRNAME, f'{month}.zip')
+
+
+def key_month(key):
+    """Month (YYYYMM) of a data key, from its folder or its file name."""
+    parts = key.split('/')
+    if len(parts) > 1 and re.fullmatch(r'\d{6}', parts[-2]):
+        return parts[-2]
+    match = re.search(r'(\d{8})', os.path.basename(key))
+    return match.group(1)[:6] if match else None
+
+
+def encode(values, codec='zlib'):
+    """Compresses a 1-D numeric array (byte-shuffled)."""
+    values = np.ascontiguousarray(values)
+    if codec == 'blosc':
+        return blosc.compress(values.tobytes(), typesize=values.itemsize, shuffle=blosc.SHUFFLE, cname='lz4')
+    shuffled = values.view(np.uint8).reshape(-1, values.itemsize).T
+    return zlib.compress(np.ascontiguousarray(shuffled).tobytes(), ZLIB_LEVEL)
+
+
+def decode(buffer, dtype, n, codec='zlib'):
+    dtype = np.dtype(dtype)
+    if codec == 'blosc':
+        return np.frombuffer(blosc.decompress(buffer), dtype=dtype)
+    shuffled = np.frombuffer(zlib.decompress(buffer), dtype=np.uint8).reshape(dtype.itemsize, n)
+    return np.ascontiguousarray(shuffled.T).view(dtype).ravel()
+
+
+def make_chunks(night, vectors, chunk_size=CHUNK_SIZE):
+    """
+    Groups the vectors of a night in chunks of the same dtype.
+
+    Returns:
+    list: (chunk name, dtype, list of (key, array))
+    """
+    chunks = []
+    for key, array in vectors:
+        if not chunks or chunks[-1][1] != array.dtype or len(chunks[-1][2]) >= chunk_size:
+            chunks.append((f'{night}_{len(chunks):04d}', array.dtype, []))
+        chunks[-1][2].append((key, array))
+    return chunks
+
+
+def raw_files(df, root=None):
+    """Raw files of a nightly CSV still on disk: list of (kind, key, local path)."""
+    files = []
+    for path in dict.fromkeys(df.get('electrometer_filename', [])):
+        local = resolve_data_path(path, root)
+        if path and os.path.isfile(local):
+            files.append(('vector', data_key(path), local))
+    for path in dict.fromkeys(df.get('mount_filename', [])):
+        local = resolve_data_path(path, root)
+        if path and os.path.isfile(f'{local}.npz'):
+            files.append(('mount', data_key(path), f'{local}.npz'))
+    return files
+
+
+def verify(files, root=None):
+    """Reads the archived files back and compares them with the raw files."""
+    for kind, key, local in files:
+        if kind == 'vector' and not np.array_equal(read_vector(key, root), np.load(local).ravel()):
+            raise IOError(f"archived vector {key} does not match the raw file")
+        if kind == 'mount' and read_mount(key, root) is None:
+            raise IOError(f"archived mount file {key} can not be read")
+
+
+def finish_night(fname, df, files, delete=False):
+    """Replaces the paths of the nightly CSV by relative keys and deletes the archived raw files."""
+    for col in PATH_COLUMNS:
+        if col in df:
+            df[col] = [data_key(path) for path in df[col]]
+    tmp = fname + '.tmp'
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, fname)
+
+    raw_bytes = sum(os.path.getsize(local) for _, _, local in files)
+    if delete:
+        for _, _, local in files:
+            os.remove(local)
+    return raw_bytes
+
+
+def pack_night(night, root=None, chunk_size=CHUNK_SIZE, codec=None, delete=False):
+    """
+    Packs the raw vectors and mount files of a night into the bundle of its month
+    and replaces the paths of the nightly CSV by relative keys.
+
+    A night already in the bundle (e.g. an interrupted pack) is not packed
+    again: only the CSV rewrite and the deletion of its archived raw files
+    are finished.
+
+    Returns:
+    dict: number of packed vectors and mount files, raw and packed bytes
+        (None if there was nothing left to do)
+    """
+    import pandas as pd
+
+    codec = codec or ('blosc' if blosc is not None else 'zlib')
+    fname = resolve_filename(night)
+    date = os.path.splitext(os.path.basename(fname))[0]
+    bundle = bundle_filename(date[:6], root)
+    df = pd.read_csv(fname, dtype=str, keep_default_na=False)
+    files = raw_files(df, root)
+
+    archived = read_index(bundle)
+    if date in archived['nights']:
+        files = [f for f in files if f[1] in archived['vectors' if f[0] == 'vector' else 'mounts']]
+        keyed = all(data_key(path) == path for col in PATH_COLUMNS if col in df for path in df[col])
+        if keyed and not (delete and files):
+            print(f"{date} is already in {bundle}")
+            return None
+        print(f"{date} is already in {bundle}, finishing the CSV rewrite and the cleanup")
+        verify(files, root)
+        raw_bytes = finish_night(fname, df, files, delete)
+        return {'night': date, 'nvectors': sum(f[0] == 'vector' for f in files),
+                'nmounts': sum(f[0] == 'mount' for f in files),
+                'raw_bytes': raw_bytes, 'bundle_bytes': os.path.getsize(bundle)}
+
+    vectors = [(key, np.load(local).ravel()) for kind, key, local in files if kind == 'vector']
+    mounts = []
+    for kind, key, local in files:
+        if kind == 'mount':
+            with open(local, 'rb') as f:
+                mounts.append((key, f.read()))
+
+    index = {'night': date, 'codec': codec, 'chunks': {}, 'vectors': {}, 'mounts': {}}
+    # the bundle is updated in a copy: a pack killed halfway leaves the bundle as it was
+    os.makedirs(os.path.dirname(bundle), exist_ok=True)
+    tmp = bundle + '.tmp'
+    if os.path.isfile(bundle):
+        shutil.copyfile(bundle, tmp)
+    elif os.path.isfile(tmp):
+        os.remove(tmp)
+    with zipfile.ZipFile(tmp, 'a') as z:
+        for name, dtype, members in make_chunks(date, vectors, chunk_size):
+            flat = np.concatenate([array for _, array in members])
+            fields = dtype.names or ('',)
+            for field in fields:
+                values = flat[field] if field else flat
+                z.writestr(f'chunks/{name}.{field or "data"}', encode(values, codec), zipfile.ZIP_STORED)
+            index['chunks'][name] = {'dtype': dtype.descr if dtype.names else dtype.str,
+                                     'fields': list(fields), 'n': len(flat)}
+            offset = 0
+            for key, array in members:
+                index['vectors'][key] = [name, offset, len(array)]
+                offset += len(array)
+        for key, data in mounts:
+            member = f'mount/{key}.npz'
+            z.writestr(member, data, zipfile.ZIP_DEFLATED)
+            index['mounts'][key] = member
+        z.writestr(f'index/{date}.json', json.dumps(index), zipfile.ZIP_DEFLATED)
+    os.replace(tmp, bundle)
+
+    # read everything back before touching the originals
+    verify(files, root)
+    raw_bytes = finish_night(fname, df, files, delete)
+    return {'night': date, 'nvectors': len(vectors), 'nmounts': len(mounts),
+            'raw_bytes': raw_bytes, 'bundle_bytes': os.path.getsize(bundle)}
+
+
+def finished_nights(nights, min_age=MIN_AGE):
+    """
+    Nights whose nightly file was not written for `min_age` days.
+
+    The age is the one of the last write, not of the date of the file: a
+    night that runs past 00:00 UTC is still written under the date it started.
+    """
+    last = time.time() - min_age*86400.
+    files = [resolve_filename(n) for n in nights]
+    return [n for n, f in zip(nights, files) if os.path.isfile(f) and os.path.getmtime(f) <= last]
+
+
+# open bundles: path -> ((mtime, size), ZipFile, index)
+_bundles = {}
+_chunks = OrderedDict()
+
+
+def read_index(bundle):
+    """Merged index of the nights of a bundle (empty if the bundle does not exist)."""
+    if not os.path.isfile(bundle):
+        return {'nights': {}, 'chunks': {}, 'vectors': {}, 'mounts': {}}
+    return open_bundle(bundle)[1]
+
+
+def open_bundle(bundle):
+    stat = os.stat(bundle)
+    mtime = (stat.st_mtime_ns, stat.st_size)
+    cached = _bundles.get(bundle)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+    if cached is not None:
+        cached[1].close()
+
+    z = zipfile.ZipFile(bundle, 'r')
+    index = {'nights': {}, 'chunks': {}, 'vectors': {}, 'mounts': {}}
+    for member in z.namelist():
+        if member.startswith('index/'):
+            night = json.loads(z.read(member))
+            index['nights'][night['night']] = night['codec']
+            for name, chunk in night['chunks'].items():
+                index['chunks'][name] = dict(chunk, codec=night['codec'])
+            index['vectors'].update(night['vectors'])
+            index['mounts'].update(night['mounts'])
+    _bundles[bundle] = (mtime, z, index)
+    return z, index
+
+
+def read_chunk(bundle, name):
+    """Decompressed fields of a chunk (the last ones are kept in memory)."""
+    z, index = open_bundle(bundle)
+    cache_key = (bundle, _bundles[bundle][0], name)
+    if cache_key in _chunks:
+        _chunks.move_to_end(cache_key)
+        return _chunks[cache_key]
+
+    chunk = index['chunks'][name]
+    dtype = np.dtype([tuple(d) for d in chunk['dtype']]) if isinstance(chunk['dtype'], list) else np.dtype(chunk['dtype'])
+    data = np.empty(chunk['n'], dtype=dtype)
+    for field in chunk['fields']:
+        if field:
+            data[field] = decode(z.read(f'chunks/{name}.{field}'), dtype[field], chunk['n'], chunk['codec'])
+        else:
+            data[:] = decode(z.read(f'chunks/{name}.data'), dtype, chunk['n'], chunk['codec'])
+
+    _chunks[cache_key] = data
+    while len(_chunks) > CHUNK_CACHE_SIZE:
+        _chunks.popitem(last=False)
+    return data
+
+
+def read_vector(path, root=None):
+    """Raw electrometer vector of a data path or key from the archive (None if not archived)."""
+    key = data_key(path)
+    month = key_month(key) if key else None
+    bundle = bundle_filename(month, root) if month else None
+    if bundle is None or not os.path.isfile(bundle):
+        return None
+    _, index = open_bundle(bundle)
+    if key not in index['vectors']:
+        return None
+    name, offset, n = index['vectors'][key]
+    return read_chunk(bundle, name)[offset:offset+n]
+
+
+def read_mount(path, root=None):
+    """Mount file of a data path or key from the archive, as a dict (None if not archived)."""
+    key = data_key(path)
+    if key and key.endswith('.npz'):
+        key = key[:-4]
+    month = key_month(key) if key else None
+    bundle = bundle_filename(month, root) if month else None
+    if bundle is None or not os.path.isfile(bundle):
+        return None
+    z, index = open_bundle(bundle)
+    if key not in index['mounts']:
+        return None
+    with np.load(io.BytesIO(z.read(index['mounts'][key])), allow_pickle=True) as data:
+        return {k: data[k] for k in data.files}
+
+
+def info(month, root=None):
+    """Nights, files and compressed size of a monthly bundle."""
+    bundle = bundle_filename(month, root)
+    _, index = open_bundle(bundle)
+    return {'bundle': bundle, 'nights': sorted(index['nights']), 'nvectors': len(index['vectors']),
+            'nmounts': len(index['mounts']), 'bytes': os.path.getsize(bundle)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-term archive of the raw files")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('pack', help="pack finished nights into the monthly bundles")
+    p.add_argument('dates', nargs='+', help="nights (YYYYMMDD) or months (YYYYMM)")
+    p.add_argument('--root', default=None, help="database root (default: config.databaseRoot)")
+    p.add_argument('--delete', action='store_true', help="delete the raw files once packed")
+    p.add_argument('--min-age', type=int, default=MIN_AGE, help="only pack nights older than this (days)")
+    p.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    p.add_argument('--codec', choices=['zlib', 'blosc'], default=None, help="default: blosc if installed")
+    p = sub.add_parser('info', help="describe a monthly bundle")
+    p.add_argument('month')
+    p.add_argument('--root', default=None)
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        print(info(args.month, args.root))
+    else:
+        nights = []
+        for date in args.dates:
+            if len(date) == 6:
+                nights += list_nights(args.root, month=date)
+            else:
+                nights.append(night_filename(date, args.root))
+        for night in finished_nights(nights, args.min_age):
+            res = pack_night(night, root=args.root, chunk_size=args.chunk_size, codec=args.codec, delete=args.delete)
+            if res is not None:
+                print(f"{res['night']}: {res['nvectors']} vectors and {res['nmounts']} mount files, "
+                      f"{res['raw_bytes']/1e6:0.2f} MB raw, bundle now {res['bundle_bytes']/1e6:0.2f} MB")
@@ -0,0 +1,326 @@
+"""
+Twilight Monitor Benchmarks
+
+Measures the data and analysis paths on synthetic nights, at 1x to 100x the
+size of the recorded nights:
+
+1) write: exposure write throughput through `TwilightMonitorDatabase`
+2) load: nightly-file load time (`loader.load_night`, without and with the cache)
+3) query: multi-night query latency (`loader.load_nights`)
+4) ephemeris: Sun position rate (`twilightSunAltAz.get_sun_alt_az`)
+5) reduce: map reduction time (`reduction.reduce_maps`)
+
+The synthetic nights follow the statistics of the nightly files in `DATA/`
+(exposures per night, cadence, pointings per rank, current levels and noise),
+with the same map structure as `Scheduler.map_alt_az`.
+
+The results are written as JSON; `compare` flags the benchmarks that got slower
+than a baseline.
+
+Usage:
+    python benchmark.py run --scales 1 10 100 --output baseline.json
+    python benchmark.py compare baseline.json new.json --threshold 1.2
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from loader import list_nights, load_night, load_nights, night_filename
+from reduction import reduce_maps
+
+COLUMNS = ['tmid', 'date', 'seq_id', 'exp_time_cmd', 'exp_time', 'filter', 'Alt', 'Az',
+           'current_mean', 'current_std', 'alt_std', 'az_std', 'alt_rank', 'az_rank',
+           'electrometer_filename', 'flag', 'mount_filename']
+
+# used when there is no recorded night to seed the generator
+DEFAULT_STATS = {
+    'nexposures': 270, 'cadence': 4.05, 'el_steps': 5, 'az_steps': 7, 'exp_time': 0.93,
+    'alt': [75.7, 66.0, 56.3, 46.6, 36.9], 'alt_scatter': 0.5, 'az_step': 29.4,
+    'log_current': -5.3, 'log_current_slope': -1.0, 'log_current_scatter': 0.3, 'rel_std': 0.1,
+}
+EPHEMERIS_STEPS = 120  # Sun positions computed by twilightSunAltAz
+NIGHT_START = datetime.datetime(2024, 10, 1, 22, 0, 0)
+
+
+def night_statistics(nights):
+    """Statistics of the recorded nights that seed the synthetic nights."""
+    stats = dict(DEFAULT_STATS)
+    if not nights:
+        return stats
+    df = load_nights(nights, chile_time=False)
+    step = ~df['flag'].astype(bool) & (df['alt_rank'] > 0) & np.isfinite(df['current_mean'])
+    step &= (df['current_mean'].abs() > 0) & (df['current_mean'].abs() < 1)
+    if step.sum() < 10:
+        return stats
+    steps = df[step]
+
+    t = steps['date'].to_numpy()/1e6
+    dt = np.diff(t)
+    el_steps = int(steps.groupby('night')['alt_rank'].max().median())
+    alt = steps.groupby('alt_rank')['Alt'].median()
+    log_current = np.log10(steps['current_mean'].abs().to_numpy())
+    # hours since the first exposure of each night
+    hours = (t - steps.groupby('night')['date'].transform('min').to_numpy()/1e6)/3600.
+    slope = np.polyfit(hours, log_current, 1)[0] if np.ptp(hours) > 0 else DEFAULT_STATS['log_current_slope']
+
+    stats.update({
+        'nexposures': int(df.groupby('night').size().median()),
+        'cadence': float(np.median(dt[(dt > 0) & (dt < 60)])),
+        'el_steps': el_steps,
+        'az_steps': int(steps.groupby('night')['az_rank'].max().median()),
+        'exp_time': float(steps['exp_time'].median()),
+        'alt': [float(alt.get(i, DEFAULT_STATS['alt'][-1])) for i in range(1, el_steps+1)],
+        'alt_scatter': float(steps.groupby(['night', 'az_rank', 'alt_rank'])['Alt'].std().median()),
+        'az_step': float(np.median(np.abs(np.diff(steps.groupby('az_rank')['Az'].median().to_numpy())))),
+        'log_current': float(np.median(log_current)),
+        'log_current_slope': float(slope),
+        'log_current_scatter': float(np.std(log_current - slope*hours)),
+        'rel_std': float(np.nanmedian(steps['current_std']/steps['current_mean'].abs())),
+    })
+    return stats
+
+
+def synthetic_night(stats, scale=1.0, start=NIGHT_START, seed=0):
+    """
+    A synthetic night with `scale` times the exposures of a recorded night.
+
+    The exposures follow the map structure of the Scheduler: forward and
+    backward azimuth sweeps, each azimuth cycle with el_steps pointings and a
+    slewing-up exposure (flag=True, alt_rank=0).
+    """
+    rng = np.random.default_rng(seed)
+    n = max(int(stats['nexposures']*scale), 1)
+    el_steps, az_steps = stats['el_steps'], stats['az_steps']
+
+    # ranks of one map, repeated
+    alt_rank = np.tile(np.arange(el_steps+1), 2*az_steps)
+    alt_rank = np.where(alt_rank == el_steps, 0, alt_rank + 1)
+    az_rank = np.repeat(np.arange(1, az_steps+1), el_steps+1)
+    az_rank = np.concatenate([az_rank, az_rank])
+    backward = np.repeat([False, True], az_steps*(el_steps+1))
+    reps = n//len(alt_rank) + 1
+    alt_rank = np.tile(alt_rank, reps)[:n]
+    az_rank = np.tile(az_rank, reps)[:n]
+    backward = np.tile(backward, reps)[:n]
+    flag = alt_rank == 0
+
+    t = np.cumsum(stats['cadence']*(1 + 0.05*rng.standard_normal(n)).clip(0.5))
+    alt_mean = np.array([85.0] + list(stats['alt']))
+    alt = np.where(flag, 85.0, alt_mean[alt_rank]) + stats['alt_scatter']*rng.standard_normal(n)
+    az = np.where(backward, -180. + (az_rank - 1)*stats['az_step'], -(az_rank - 1)*stats['az_step'])
+    az += 0.05*rng.standard_normal(n)
+    log_current = stats['log_current'] + stats['log_current_slope']*t/3600. + stats['log_current_scatter']*rng.standard_normal(n)
+    current = -10**log_current
+    exp_time = np.where(flag, 10.0, stats['exp_time'])
+
+    dates = pd.Timestamp(start) + pd.to_timedelta(t, unit='s')
+    day = start.strftime('%Y%m%d')
+    seq_id = np.arange(1, n+1)
+    return pd.DataFrame({
+        'tmid': dates.strftime('%Y%m%d%H%M%S'),
+        'date': dates.strftime('%Y-%m-%d %H:%M:%S.%f'),
+        'seq_id': seq_id,
+        'exp_time_cmd': np.where(flag, np.round(exp_time, 3), 1),
+        'exp_time': np.round(exp_time + 0.001*rng.standard_normal(n), 6),
+        'filter': 'Empty',
+        'Alt': np.round(alt, 5),
+        'Az': np.round(az, 5),
+        'current_mean': current,
+        'current_std': np.abs(current)*stats['rel_std'],
+        'alt_std': '',
+        'az_std': '',
+        'alt_rank': alt_rank,
+        'az_rank': az_rank,
+        'electrometer_filename': [f'DATA/keysighB2987A/{day[:6]}/{day}_{i}.npy' for i in seq_id],
+        'flag': flag,
+        'mount_filename': [f'DATA/mount/{day[:6]}/mount_pointing_{day}_{i}' for i in seq_id],
+    }, columns=COLUMNS)
+
+
+def write_synthetic_nights(root, stats, nnights=1, scale=1.0, seed=0):
+    """Writes synthetic nights as nightly files in `root/DATA` and returns their paths."""
+    fnames = []
+    for i in range(nnights):
+        start = NIGHT_START + datetime.timedelta(days=i)
+        fname = night_filename(start.strftime('%Y%m%d'), root)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        synthetic_night(stats, scale, start=start, seed=seed+i).to_csv(fname, index=False)
+        fnames.append(fname)
+    return fnames
+
+
+def timeit(func, repeat=3):
+    """Best and median wall time [s] of `repeat` calls."""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return {'time_s': float(np.min(times)), 'median_s': float(np.median(times))}
+
+
+def bench_write(root, night):
+    """Exposure write throughput through TwilightMonitorDatabase (add_exposure + save per exposure)."""
+    try:
+        from twmdb import TwilightMonitorDatabase
+    except ImportError as e:
+        return {'skipped': f'twmdb not available ({e})'}
+
+    database = TwilightMonitorDatabase(path=root)
+    rows = night.to_dict('records')
+    dates = pd.to_datetime(night['date']).dt.to_pydatetime()
+    vector = np.zeros(10, dtype=[('time', '<f8'), ('CURR', '<f8')])
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for row, date in zip(rows, dates):
+            database.add_exposure(timestamp=date, alt=row['Alt'], az=row['Az'],
+                                  exp_time_cmd=row['exp_time_cmd'], exp_time=row['exp_time'],
+                                  filter_type=row['filter'], current_mean=row['current_mean'],
+                                  current_std=row['current_std'], alt_rank=int(row['alt_rank']),
+                                  az_rank=int(row['az_rank']), flag=row['flag'])
+            database.save_electrometer_file(vector)
+            database.save()
+    elapsed = time.perf_counter() - t0
+    return {'time_s': elapsed, 'n': len(rows), 'exposures_per_second': len(rows)/elapsed}
+
+
+def bench_load(fname, repeat=3):
+    """Nightly-file load time: CSV parse and cache build, and from the cache."""
+    cold = timeit(lambda: load_night(fname, rebuild=True), repeat)
+    warm = timeit(lambda: load_night(fname), repeat)
+    csv = timeit(lambda: pd.read_csv(fname), repeat)
+    return {'time_s': cold['time_s'], 'cached_s': warm['time_s'], 'pandas_csv_s': csv['time_s']}
+
+
+def bench_query(fnames, repeat=3):
+    """Multi-night query latency (all the nights, a few columns, from the cache)."""
+    columns = ['date', 'Alt', 'Az', 'current_mean', 'alt_rank', 'az_rank', 'flag']
+    load_nights(fnames, columns=columns)
+    out = timeit(lambda: load_nights(fnames, columns=columns, chile_time=False), repeat)
+    out['nnights'] = len(fnames)
+    return out
+
+
+def bench_ephemeris(n, repeat=3):
+    """Sun positions per second at Cerro Pachon."""
+    from twilightSunAltAz import get_sun_alt_az, setPachon
+    dates = [NIGHT_START + datetime.timedelta(minutes=i) for i in range(n)]
+    out = timeit(lambda: [get_sun_alt_az(setPachon(date)) for date in dates], repeat)
+    out.update({'n': n, 'positions_per_second': n/out['time_s']})
+    return out
+
+
+def bench_reduce(fname, repeat=3):
+    """Map reduction time of a night (map ids and one row per pointing)."""
+    df = load_nights([fname], chile_time=False)
+    out = timeit(lambda: reduce_maps(df), repeat)
+    out['n'] = len(df)
+    return out
+
+
+def run(stats, scales=(1, 10, 100), nnights=10, workdir=None, repeat=3, benchmarks=None):
+    """
+    Runs the benchmarks at each scale on synthetic nights written in `workdir`.
+
+    Returns:
+    dict: '<benchmark>@<scale>x' -> measurements
+    """
+    benchmarks = benchmarks or ['write', 'load', 'query', 'ephemeris', 'reduce']
+    cleanup = workdir is None
+    workdir = tempfile.mkdtemp(prefix='twm_bench_') if workdir is None else workdir
+    results = {}
+    try:
+        for scale in scales:
+            root = os.path.join(workdir, f'scale{scale}')
+            fnames = write_synthetic_nights(root, stats, nnights=nnights, scale=scale)
+            night = pd.read_csv(fnames[0])
+            bench = {
+                'write': lambda: bench_write(os.path.join(root, 'write'), night),
+                'load': lambda: bench_load(fnames[0], repeat),
+                'query': lambda: bench_query(fnames, repeat),
+                'ephemeris': lambda: bench_ephemeris(int(EPHEMERIS_STEPS*scale), repeat),
+                'reduce': lambda: bench_reduce(fnames[0], repeat),
+            }
+            for name in benchmarks:
+                key = f'{name}@{scale}x'
+                results[key] = bench[name]()
+                print(f"{key:>16s}: " + ", ".join(f"{k}={v:0.4g}" if isinstance(v, float) else f"{k}={v}"
+                                                  for k, v in results[key].items()))
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(baseline, new, threshold=1.2):
+    """
+    Compares the times of two result files.
+
+    Returns:
+    list: (benchmark, measurement, baseline, new, ratio) of the regressions
+    """
+    regressions = []
+    print(f"{'benchmark':>16s} {'measurement':>14s} {'baseline':>10s} {'new':>10s} {'ratio':>7s}")
+    for key, old in baseline['results'].items():
+        if key not in new['results']:
+            continue
+        for measurement, value in old.items():
+            if not measurement.endswith('_s') or measurement not in new['results'][key]:
+                continue
+            ratio = new['results'][key][measurement]/value if value > 0 else np.nan
+            mark = ' <-- slower' if ratio > threshold else ''
+            print(f"{key:>16s} {measurement:>14s} {value:10.4g} {new['results'][key][measurement]:10.4g} {ratio:7.2f}{mark}")
+            if ratio > threshold:
+                regressions.append((key, measurement, value, new['results'][key][measurement], ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the data and analysis paths on synthetic nights")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help="run the benchmarks")
+    p.add_argument('--root', default=None, help="database root of the recorded nights (default: config.databaseRoot)")
+    p.add_argument('--scales', nargs='+', type=float, default=[1, 10, 100], help="sizes relative to a recorded night")
+    p.add_argument('--nnights', type=int, default=10, help="nights of the multi-night query")
+    p.add_argument('--only', nargs='+', default=None, choices=['write', 'load', 'query', 'ephemeris', 'reduce'])
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--workdir', default=None, help="folder of the synthetic nights (default: temporary)")
+    p.add_argument('--output', default=None, help="JSON file of the results")
+
+    p = sub.add_parser('compare', help="compare results with a baseline")
+    p.add_argument('baseline')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=1.2, help="slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        stats = night_statistics(list_nights(args.root))
+        scales = [int(s) if s == int(s) else s for s in args.scales]
+        results = run(stats, scales=scales, nnights=args.nnights, workdir=args.workdir,
+                      repeat=args.repeat, benchmarks=args.only)
+        if args.output:
+            out = {'created': datetime.datetime.utcnow().isoformat(), 'python': sys.version.split()[0],
+                   'platform': platform.platform(), 'stats': stats, 'results': results}
+            with open(args.output, 'w') as f:
+                json.dump(out, f, indent=2)
+            print(f"Results written to {args.output}")
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare(baseline, new, threshold=args.threshold)
+        print(f"{len(regressions)} regression(s) above {args.threshold:0.2f}x")
+        sys.exit(1 if regressions else 0)
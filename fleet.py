@@ -0,0 +1,375 @@
+"""
+Twilight Monitor Fleet
+
+Coordinates several twilight monitors (different filters or sites) into one
+archive. Each unit runs its own Scheduler with its own mount, photodiode and
+local database, and streams its exposures to an aggregator process.
+
+1) `FleetDatabase` wraps the local database of a unit: the exposures are saved
+   locally as usual and tagged with the unit id for the stream
+2) `Publisher` sends the exposures as JSON lines over TCP from a bounded queue
+3) `Aggregator` receives the streams of all the units and merges them in time
+   order into `DATA/fleet/YYYYMM/YYYYMMDD.csv` (with a `unit_id` column)
+4) `plan_fleet` splits the azimuth range between the units, so together they
+   cover the sky faster than a single unit
+
+Merging: each unit stream is time ordered, so a row is written once every
+active unit has sent a later row. The heartbeats keep an idle unit active,
+they carry the time of its last published row: an exposure is timestamped
+before it is published, so a heartbeat stamped with the clock could pass it.
+Units silent for more than `IDLE_TIMEOUT` seconds do not hold the others back.
+
+Backpressure: the aggregator buffers at most `max_buffer` rows. When it is full
+it stops reading from the sockets, the unit queues fill up and `publish` waits
+up to `block_timeout` seconds. Rows that still do not fit are only dropped from
+the stream, they are kept in the local nightly file of the unit. If the buffer
+stays full because one unit holds the watermark back, the oldest rows are
+written anyway (the archive may then be out of order around that time).
+
+Usage:
+    python fleet.py aggregate --port 8765 --output /data/fleet     # aggregator
+    python fleet.py plan --units 3 --az-steps 7                    # sweep plans
+"""
+import argparse
+import datetime
+import heapq
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_PORT = 8765
+IDLE_TIMEOUT = 30.       # seconds
+HEARTBEAT_INTERVAL = 5.  # seconds
+RECONNECT_INTERVAL = 2.  # seconds
+
+# azimuth slew of run.py: 7.3 seconds at arrow speed 9 between 7 positions over 179 deg
+AZ_SLEW_TIME = 7.3
+AZ_SPACING = 179./6
+
+COLUMNS = ['unit_id', 'tmid', 'date', 'seq_id', 'exp_time_cmd', 'exp_time', 'filter', 'Alt', 'Az',
+           'current_mean', 'current_std', 'alt_rank', 'az_rank', 'flag']
+
+
+class Publisher:
+    """
+    Streams the rows of a unit to the aggregator from a background thread.
+
+    Parameters:
+    unit_id (str): name of the unit
+    host, port: address of the aggregator
+    maxsize (int): rows kept in memory while the aggregator is slow or unreachable
+    block_timeout (float): maximum wait of `publish` when the queue is full
+    """
+    def __init__(self, unit_id, host='127.0.0.1', port=DEFAULT_PORT, maxsize=1000, block_timeout=1.0):
+        self.unit_id = unit_id
+        self.address = (host, port)
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.block_timeout = block_timeout
+        self.ndropped = 0
+        self.nsent = 0
+        self.last_t = None  # time of the last published row, sent with the heartbeats
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def publish(self, row):
+        try:
+            self.queue.put(row, timeout=self.block_timeout)
+        except queue.Full:
+            self.ndropped += 1
+
+    def connect(self):
+        while self.running:
+            try:
+                sock = socket.create_connection(self.address, timeout=10)
+                sock.sendall((json.dumps({'hello': self.unit_id}) + '\n').encode())
+                return sock
+            except OSError:
+                time.sleep(RECONNECT_INTERVAL)
+        return None
+
+    def run(self):
+        sock = None
+        pending = None
+        while self.running or not self.queue.empty():
+            if sock is None:
+                sock = self.connect()
+                if sock is None:
+                    return
+            try:
+                if pending is None:
+                    try:
+                        pending = self.queue.get(timeout=HEARTBEAT_INTERVAL)
+                    except queue.Empty:
+                        pending = {'heartbeat': self.last_t}
+                sock.sendall((json.dumps(pending) + '\n').encode())
+                if 'heartbeat' not in pending:
+                    self.nsent += 1
+                    self.last_t = pending['t']
+                pending = None
+            except OSError:
+                # keep the pending row and reconnect
+                sock.close()
+                sock = None
+
+        if sock is not None:
+            sock.close()
+
+    def close(self, timeout=10.):
+        """Sends the queued rows and stops the thread."""
+        self.running = False
+        self.thread.join(timeout)
+
+
+class FleetDatabase:
+    """
+    Local database of a unit that also streams the exposures to the aggregator.
+
+    All the methods of the wrapped database are available, `add_exposure`
+    also publishes the row tagged with the unit id.
+    """
+    def __init__(self, database, unit_id, publisher):
+        self.database = database
+        self.unit_id = unit_id
+        self.publisher = publisher
+        self.seq_id = 0
+
+    def add_exposure(self, timestamp, alt, az, exp_time_cmd, exp_time, filter_type,
+                     current_mean, current_std, alt_rank, az_rank, flag):
+        self.database.add_exposure(timestamp=timestamp, alt=alt, az=az, exp_time_cmd=exp_time_cmd,
+                                   exp_time=exp_time, filter_type=filter_type, current_mean=current_mean,
+                                   current_std=current_std, alt_rank=alt_rank, az_rank=az_rank, flag=flag)
+        self.seq_id += 1
+        self.publisher.publish({'unit_id': self.unit_id,
+                                't': timestamp.replace(tzinfo=datetime.timezone.utc).timestamp(),
+                                'tmid': timestamp.strftime('%Y%m%d%H%M%S'),
+                                'date': timestamp.isoformat(sep=' '),
+                                'seq_id': self.seq_id,
+                                'exp_time_cmd': exp_time_cmd, 'exp_time': exp_time, 'filter': filter_type,
+                                'Alt': float(alt), 'Az': float(az),
+                                'current_mean': float(current_mean), 'current_std': float(current_std),
+                                'alt_rank': int(alt_rank), 'az_rank': int(az_rank), 'flag': str(flag)})
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
+class Aggregator:
+    """
+    Merges the unit streams into a single time-ordered archive.
+
+    Parameters:
+    root (str): archive root, the rows go to `root/DATA/fleet/YYYYMM/YYYYMMDD.csv`
+    max_buffer (int): maximum number of rows held in memory
+    """
+    def __init__(self, root, host='127.0.0.1', port=DEFAULT_PORT, max_buffer=10000, idle_timeout=IDLE_TIMEOUT):
+        self.root = root
+        self.max_buffer = max_buffer
+        self.idle_timeout = idle_timeout
+        self.buffers = {}      # unit_id -> list of rows (time ordered)
+        self.watermarks = {}   # unit_id -> last time received
+        self.last_seen = {}    # unit_id -> wall time of the last message
+        self.nbuffered = 0
+        self.nwritten = 0
+        self.cond = threading.Condition()
+
+        aggregator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                unit_id = None
+                for line in self.rfile:
+                    msg = json.loads(line)
+                    if 'hello' in msg:
+                        unit_id = msg['hello']
+                        aggregator.register(unit_id)
+                    elif unit_id is not None:
+                        aggregator.receive(unit_id, msg)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.address = self.server.server_address
+
+    def register(self, unit_id):
+        with self.cond:
+            self.buffers.setdefault(unit_id, [])
+            self.watermarks.setdefault(unit_id, -np.inf)
+            self.last_seen[unit_id] = time.time()
+
+    def receive(self, unit_id, msg):
+        with self.cond:
+            # backpressure: stop reading this socket until the buffer drains
+            while 'heartbeat' not in msg and self.nbuffered >= self.max_buffer:
+                if not self.cond.wait(1.0):
+                    # the watermark is held by a slow unit, write the oldest rows anyway
+                    self.flush_oldest(self.max_buffer//2 or 1)
+
+            self.last_seen[unit_id] = time.time()
+            if 'heartbeat' in msg:
+                if msg['heartbeat'] is not None:
+                    self.watermarks[unit_id] = max(self.watermarks[unit_id], msg['heartbeat'])
+            else:
+                self.buffers[unit_id].append(msg)
+                self.watermarks[unit_id] = max(self.watermarks[unit_id], msg['t'])
+                self.nbuffered += 1
+            self.flush_locked()
+
+    def watermark(self):
+        """Time up to which every active unit has sent its rows."""
+        now = time.time()
+        active = [u for u in self.watermarks if now - self.last_seen[u] < self.idle_timeout]
+        if not active:
+            return np.inf
+        return min(self.watermarks[u] for u in active)
+
+    def flush_locked(self):
+        """Writes the buffered rows older than the watermark, in time order."""
+        limit = self.watermark()
+        ready = []
+        for unit_id, rows in self.buffers.items():
+            n = 0
+            while n < len(rows) and rows[n]['t'] <= limit:
+                n += 1
+            if n:
+                ready.append(rows[:n])
+                self.buffers[unit_id] = rows[n:]
+        if not ready:
+            return 0
+
+        merged = list(heapq.merge(*ready, key=lambda row: row['t']))
+        self.write(merged)
+        self.nbuffered -= len(merged)
+        self.cond.notify_all()
+        return len(merged)
+
+    def flush_oldest(self, n):
+        """Writes the n oldest buffered rows, whatever the watermark."""
+        merged = list(heapq.merge(*self.buffers.values(), key=lambda row: row['t']))[:n]
+        for row in merged:
+            self.buffers[row['unit_id']].pop(0)
+        self.write(merged)
+        self.nbuffered -= len(merged)
+        self.cond.notify_all()
+
+    def write(self, rows):
+        files = {}
+        for row in rows:
+            date = row['tmid'][:8]
+            files.setdefault(date, []).append(row)
+        for date, part in files.items():
+            fname = os.path.join(self.root, 'DATA', 'fleet', date[:6], f'{date}.csv')
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            new = not os.path.exists(fname)
+            with open(fname, 'a') as f:
+                if new:
+                    f.write(','.join(COLUMNS) + '\n')
+                for row in part:
+                    f.write(','.join(str(row.get(c, '')) for c in COLUMNS) + '\n')
+        self.nwritten += len(rows)
+
+    def flush(self, force=False):
+        """Writes the rows ready to be merged (all of them if `force`, e.g. at shutdown)."""
+        with self.cond:
+            if not force:
+                return self.flush_locked()
+            merged = list(heapq.merge(*self.buffers.values(), key=lambda row: row['t']))
+            self.write(merged)
+            self.buffers = {u: [] for u in self.buffers}
+            self.nbuffered = 0
+            self.cond.notify_all()
+            return len(merged)
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.1}, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.flush(force=True)
+
+
+def plan_fleet(units, az_steps=7, az_start=0.0, az_end=-179.0):
+    """
+    Splits the azimuth sweep between the units.
+
+    Each unit gets a contiguous sector of the az_steps azimuth positions, so
+    a map of the whole range takes about 1/len(units) of the single unit time.
+    The az_rank of the rows stays global (az_rank0 offset).
+
+    Returns:
+    dict: unit_id -> {'az_steps', 'az_slew_time', 'az_start', 'az_end', 'az_rank0'}
+        for `Scheduler.set_azimuth_sweep_params`. The azimuth is slewed by
+        time, so az_slew_time is scaled to the spacing of the positions.
+    """
+    positions = np.linspace(az_start, az_end, az_steps)
+    spacing = abs(az_end - az_start)/(az_steps - 1) if az_steps > 1 else AZ_SPACING
+    az_slew_time = AZ_SLEW_TIME*spacing/AZ_SPACING
+    plans = {}
+    for unit_id, ranks in zip(units, np.array_split(np.arange(az_steps), len(units))):
+        if len(ranks) == 0:
+            continue
+        plans[unit_id] = {'az_steps': int(len(ranks)),
+                          'az_slew_time': float(az_slew_time),
+                          'az_start': float(positions[ranks[0]]),
+                          'az_end': float(positions[ranks[-1]]),
+                          'az_rank0': int(ranks[0])}
+    return plans
+
+
+def make_unit_scheduler(unit_id, plan, host='127.0.0.1', port=DEFAULT_PORT, database=None, **kwargs):
+    """
+    Scheduler of a fleet unit: local database streamed to the aggregator and
+    the azimuth sector of its plan (see `plan_fleet`).
+
+    The Scheduler keyword arguments (e.g. `clock`) are passed through.
+    """
+    from scheduler import Scheduler
+
+    if database is None:
+        from twmdb import TwilightMonitorDatabase
+        from config import databaseRoot
+        database = TwilightMonitorDatabase(path=databaseRoot)
+
+    publisher = Publisher(unit_id, host=host, port=port)
+    s = Scheduler(database=FleetDatabase(database, unit_id, publisher), **kwargs)
+    s.set_azimuth_sweep_params(**dict({'az_slew_time': AZ_SLEW_TIME}, **plan))
+    return s
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Twilight Monitor fleet")
+    sub = parser.add_subparsers(dest='command', required=True)
+    agg = sub.add_parser('aggregate', help="run the aggregator")
+    agg.add_argument('--output', required=True, help="archive root")
+    agg.add_argument('--host', default='127.0.0.1')
+    agg.add_argument('--port', type=int, default=DEFAULT_PORT)
+    agg.add_argument('--max-buffer', type=int, default=10000)
+    plan = sub.add_parser('plan', help="print the sweep plan of each unit")
+    plan.add_argument('--units', type=int, default=2)
+    plan.add_argument('--az-steps', type=int, default=7)
+    args = parser.parse_args()
+
+    if args.command == 'aggregate':
+        aggregator = Aggregator(args.output, host=args.host, port=args.port, max_buffer=args.max_buffer)
+        print(f"Aggregator listening on {aggregator.address[0]}:{aggregator.address[1]}")
+        try:
+            aggregator.server.serve_forever(poll_interval=0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            aggregator.flush(force=True)
+            print(f"{aggregator.nwritten} rows written")
+    else:
+        for unit_id, p in plan_fleet([f'unit{i+1}' for i in range(args.units)], az_steps=args.az_steps).items():
+            print(unit_id, p)
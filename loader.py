@@ -0,0 +1,335 @@
+"""
+Twilight Monitor Nightly Loader
+
+Loads the nightly CSV files written by the database ("DATA/YYYYMM/YYYYMMDD.csv")
+with a fixed schema and keeps a typed columnar binary cache next to them.
+
+The CSV files are converted only once:
+
+1) Parse the CSV with the fixed schema (`SCHEMA`)
+2) Save each column as a `.npy` file in `DATA/YYYYMM/.cache/YYYYMMDD/`
+3) Store the source mtime and size in `meta.json`
+
+Later reads memory-map the cached columns, so repeated loads are near-instant
+and only touch the pages that are actually used. The cache is rebuilt when
+the CSV changes (different mtime or size).
+
+Column types:
+- `tmid` and `date` are int64 (`date` is in microseconds since epoch, UTC)
+- `flag` is bool; non-boolean flags (e.g. 'test2', 'continous') go to `flag_label`
+- `filter` and `flag_label` are categories (int16 codes + list of labels)
+- missing ranks are 0 and missing floats are NaN
+
+Usage:
+    from loader import load_night, load_dataframe
+    cols = load_night('20241002')          # dict of (memory-mapped) numpy arrays
+    df = load_dataframe('20241002')        # pandas DataFrame with chilean_time
+"""
+import csv
+import glob
+import json
+import os
+
+import numpy as np
+
+from config import databaseRoot
+
+CACHE_VERSION = 2
+CACHE_DIRNAME = '.cache'
+DATA_DIRNAMES = ('keysighB2987A', 'mount')  # raw electrometer vectors and mount files
+CHILE_TZ = 'America/Santiago'
+
+# (column, kind) in the order written by the database
+SCHEMA = [
+    ('tmid', 'int64'),
+    ('date', 'datetime'),
+    ('seq_id', 'int64'),
+    ('exp_time_cmd', 'float64'),
+    ('exp_time', 'float64'),
+    ('filter', 'category'),
+    ('Alt', 'float64'),
+    ('Az', 'float64'),
+    ('current_mean', 'float64'),
+    ('current_std', 'float64'),
+    ('alt_std', 'float64'),
+    ('az_std', 'float64'),
+    ('alt_rank', 'int64'),
+    ('az_rank', 'int64'),
+    ('electrometer_filename', 'str'),
+    ('flag', 'bool'),
+    ('mount_filename', 'str'),
+    # written back by rawstats.py
+    ('current_mean_clip', 'float64'),
+    ('current_std_clip', 'float64'),
+    ('current_nclip', 'int64'),
+    ('current_drift', 'float64'),
+    ('noise_white', 'float64'),
+    ('noise_lowf', 'float64'),
+]
+# derived columns, not present in the CSV
+DERIVED = [('flag_label', 'category')]
+
+
+def night_filename(date, root=None):
+    """Returns the path of the nightly CSV file for a date 'YYYYMMDD'."""
+    if root is None:
+        root = databaseRoot
+    return os.path.join(root, 'DATA', date[:6], f'{date}.csv')
+
+
+def resolve_filename(night):
+    """Accepts a date 'YYYYMMDD' or a path to a CSV file."""
+    if os.path.exists(night) or night.endswith('.csv'):
+        return night
+    return night_filename(night)
+
+
+def resolve_data_path(path, root=None):
+    """
+    Resolves a file path stored in the nightly CSV (electrometer or mount file).
+
+    The CSV files store absolute paths on the acquisition computer. If the path
+    does not exist here, its key (see `data_key`) is re-rooted at `root/DATA/`
+    (default: databaseRoot).
+    """
+    if not path or os.path.exists(path):
+        return path
+    if root is None:
+        root = databaseRoot
+    return os.path.join(root, 'DATA', data_key(path))
+
+
+def data_key(path):
+    """
+    Relative key of a data file under `DATA/` (e.g. 'keysighB2987A/202410/20241002_1.npy').
+
+    Absolute paths of the acquisition computer are cut at '/DATA/', or at the
+    data folder (`DATA_DIRNAMES`) for the first nights, written outside of
+    `DATA/` (e.g. '/home/.../Documents/keysighB2987A/202409/20240924_1.npy').
+    Relative keys are returned as they are.
+    """
+    if not path:
+        return path
+    _, sep, relative = path.partition('/DATA/')
+    if sep:
+        return relative
+    if path.startswith('DATA/'):
+        return path[len('DATA/'):]
+    starts = [path.rfind(f'/{dirname}/') for dirname in DATA_DIRNAMES]
+    if os.path.isabs(path) and max(starts) >= 0:
+        return path[max(starts)+1:]
+    return path
+
+
+def cache_dirname(fname):
+    base = os.path.splitext(os.path.basename(fname))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(fname)), CACHE_DIRNAME, base)
+
+
+def parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_int(value):
+    # ranks were written as '1.0' in some of the early nights
+    value = parse_float(value)
+    return 0 if np.isnan(value) else int(value)
+
+
+def parse_flag(value):
+    """Returns (flag, label). Boolean strings set the flag, anything else is a label."""
+    value = (value or '').strip()
+    if value.lower() == 'true':
+        return True, ''
+    if value.lower() in ('false', ''):
+        return False, ''
+    return False, value
+
+
+def encode_category(values):
+    categories = sorted(set(values))
+    index = {c: i for i, c in enumerate(categories)}
+    codes = np.array([index[v] for v in values], dtype=np.int16)
+    return codes, categories
+
+
+def read_csv(fname):
+    """
+    Parses a nightly CSV file with the fixed schema.
+
+    Columns missing in the file (older nights) are filled with the defaults.
+    Returns a dict of numpy arrays and a dict of categories.
+    """
+    with open(fname, newline='') as f:
+        rows = list(csv.DictReader(f))
+
+    columns = {}
+    categories = {}
+    for col, kind in SCHEMA:
+        raw = [row.get(col) for row in rows]
+        if kind == 'int64':
+            columns[col] = np.array([parse_int(v) for v in raw], dtype=np.int64)
+        elif kind == 'float64':
+            columns[col] = np.array([parse_float(v) for v in raw], dtype=np.float64)
+        elif kind == 'datetime':
+            stamps = [v if v else 'NaT' for v in raw]
+            columns[col] = np.array(stamps, dtype='datetime64[us]').astype(np.int64)
+        elif kind == 'category':
+            columns[col], categories[col] = encode_category([v or '' for v in raw])
+        elif kind == 'str':
+            columns[col] = np.array([v or '' for v in raw], dtype=np.str_)
+        elif kind == 'bool':
+            flags = [parse_flag(v) for v in raw]
+            columns[col] = np.array([f[0] for f in flags], dtype=bool)
+            columns['flag_label'], categories['flag_label'] = encode_category([f[1] for f in flags])
+    return columns, categories
+
+
+def source_stat(fname):
+    st = os.stat(fname)
+    return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size}
+
+
+def read_meta(cachedir):
+    try:
+        with open(os.path.join(cachedir, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_cache_valid(fname, meta):
+    if meta is None or meta.get('version') != CACHE_VERSION:
+        return False
+    return meta.get('source') == source_stat(fname)
+
+
+def write_cache(fname, columns, categories):
+    cachedir = cache_dirname(fname)
+    os.makedirs(cachedir, exist_ok=True)
+    # each column goes to a new file: arrays memory-mapped by an earlier load
+    # keep the old file, instead of seeing it rewritten (or truncated) under them
+    for col, arr in columns.items():
+        path = os.path.join(cachedir, f'{col}.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, arr)
+        os.replace(path + '.tmp', path)
+
+    meta = {'version': CACHE_VERSION,
+            'source': source_stat(fname),
+            'nrows': int(len(columns['tmid'])),
+            'columns': list(columns.keys()),
+            'categories': categories}
+    # write the meta last, so an interrupted conversion is never read as valid
+    tmp = os.path.join(cachedir, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(cachedir, 'meta.json'))
+    return meta
+
+
+def read_cache(cachedir, meta, columns=None, mmap=True):
+    mode = 'r' if mmap else None
+    names = meta['columns'] if columns is None else columns
+    out = {}
+    for col in names:
+        path = os.path.join(cachedir, f'{col}.npy')
+        # empty nights can not be memory-mapped
+        out[col] = np.load(path, mmap_mode=mode if meta['nrows'] > 0 else None)
+    return out
+
+
+def load_night(night, columns=None, mmap=True, rebuild=False):
+    """
+    Load a nightly file as a dict of typed numpy arrays.
+
+    Parameters:
+    night (str): date 'YYYYMMDD' or path to the nightly CSV file
+    columns (list): subset of columns to load (default: all)
+    mmap (bool): memory-map the cached columns
+    rebuild (bool): force the conversion of the CSV file
+
+    Returns:
+    dict: column name -> numpy array. Categories are returned in `cols['_categories']`.
+    """
+    fname = resolve_filename(night)
+    cachedir = cache_dirname(fname)
+    meta = read_meta(cachedir)
+
+    if rebuild or not is_cache_valid(fname, meta):
+        cols, categories = read_csv(fname)
+        meta = write_cache(fname, cols, categories)
+        if columns is not None:
+            cols = {c: cols[c] for c in columns}
+    else:
+        cols = read_cache(cachedir, meta, columns, mmap)
+
+    cols['_categories'] = meta['categories']
+    return cols
+
+
+def decode_category(cols, col):
+    """Returns the labels of a category column as a numpy array of strings."""
+    labels = np.array(cols['_categories'][col], dtype=np.str_)
+    return labels[np.asarray(cols[col])]
+
+
+def to_dataframe(cols, chile_time=True):
+    """
+    Converts the loaded columns to a pandas DataFrame.
+
+    `date` is converted to a tz-aware UTC `timestamp` and, if `chile_time`
+    is set, to `chilean_time` (America/Santiago).
+    """
+    # pandas is only loaded for the DataFrames (the numpy path starts faster)
+    import pandas as pd
+
+    data = {}
+    for col, arr in cols.items():
+        if col.startswith('_'):
+            continue
+        if col in cols['_categories']:
+            data[col] = pd.Categorical.from_codes(np.asarray(arr), cols['_categories'][col])
+        else:
+            data[col] = arr
+    df = pd.DataFrame(data, copy=False)
+
+    if 'date' in df:
+        df['timestamp'] = pd.to_datetime(df['date'], unit='us', utc=True)
+        if chile_time:
+            df['chilean_time'] = df['timestamp'].dt.tz_convert(CHILE_TZ)
+    return df
+
+
+def load_dataframe(night, columns=None, chile_time=True):
+    """Load a nightly file as a pandas DataFrame (see `load_night`)."""
+    return to_dataframe(load_night(night, columns=columns), chile_time=chile_time)
+
+
+def list_nights(root=None, month='*'):
+    """Lists the nightly CSV files in the database, sorted by date."""
+    if root is None:
+        root = databaseRoot
+    return sorted(glob.glob(os.path.join(root, 'DATA', month, '[0-9]'*8 + '.csv')))
+
+
+def load_nights(nights, columns=None, chile_time=True):
+    """
+    Load several nights into a single DataFrame.
+
+    A `night` column with the file name (YYYYMMDD) is added to each row.
+    """
+    import pandas as pd
+
+    frames = []
+    for night in nights:
+        fname = resolve_filename(night)
+        df = load_dataframe(fname, columns=columns, chile_time=chile_time)
+        df['night'] = os.path.splitext(os.path.basename(fname))[0]
+        frames.append(df)
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
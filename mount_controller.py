@@ -0,0 +1,231 @@
+"""
+Command-Queue Mount Controller
+
+Owns the serial link of the mount through a single worker thread. The
+Scheduler calls the controller with the same methods as `IoptronMount`:
+
+1) The command goes to a queue and the worker sends it to the mount
+2) State-setting commands that do not change the state are coalesced
+   (e.g. a repeated `set_arrow_speed(9)` costs no serial round trip), and a
+   read already waiting in the queue is shared by the callers
+3) Each command has a timeout (timed slews add their slew time)
+4) Failed or timed out commands are retried with exponential backoff, only
+   when it is safe (no relative motion is sent twice)
+5) A command still running after its timeout marks the link as hung: the
+   queued commands are cancelled and the next ones fail at once, until the
+   hung call returns
+6) The latency of every command is recorded (`stats`, `report`)
+
+The gotos of IoptronMount move the mount with the arrow keys at their `speed`
+argument, so after a goto the arrow speed is that speed: a `set_arrow_speed(9)`
+right after a goto is sent, only repeats without a goto in between are skipped.
+
+Attributes (e.g. `altitude_deg`, `slew_pause`) are read from the mount directly.
+
+Usage:
+    mount = MountController(IoptronMount(port))
+    mount.set_arrow_speed(9)
+    mount.report()
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+
+# seconds, on top of the slew time for timed slews
+DEFAULT_TIMEOUT = 5.0
+TIMEOUTS = {
+    'goto_elevation': 60.0,
+    'goto_azimuth': 90.0,
+    'goto_zero_position': 120.0,
+}
+# commands that set a state of the mount: name -> argument that identifies the state
+STATE_COMMANDS = {'set_arrow_speed': 0}
+# commands that are safe to send twice
+RETRY_SAFE = {'set_arrow_speed', 'get_current_alt_az', 'stop_updown',
+              'goto_elevation', 'goto_azimuth', 'goto_zero_position'}
+# gotos that leave the arrow speed at their `speed` argument: name -> default speed
+GOTO_ARROW_SPEED = {'goto_elevation': 8, 'goto_azimuth': 8}
+# commands after which the cached state is unknown
+INVALIDATE = {'goto_zero_position'}
+TIMED_SLEWS = {'slew_up', 'slew_down', 'slew_left', 'slew_right'}
+
+
+class MountCommandError(Exception):
+    """Raised when a command still fails after the retries."""
+    pass
+
+
+class MountController:
+    """
+    Single-worker command queue in front of the mount.
+
+    Parameters:
+    mount: IoptronMount (or any object with the same methods)
+    retries (int): retries of the retry-safe commands
+    backoff (float): first wait before a retry [s], doubled at each retry
+    timeouts (dict): per-command timeouts [s]
+    """
+    def __init__(self, mount, retries=2, backoff=0.5, timeouts=None):
+        self.mount = mount
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.state = {}
+        self.pending_reads = {}
+        self.latencies = {}
+        self.counters = {}
+        self.hung = None
+        self.running = True
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def __getattr__(self, name):
+        attr = getattr(self.mount, name)
+        if not callable(attr):
+            return attr
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def run(self):
+        while self.running:
+            try:
+                name, args, kwargs, future = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self.lock:
+                # only the reads still waiting in the queue are shared
+                if self.pending_reads.get(name) is future:
+                    del self.pending_reads[name]
+            t0 = time.time()
+            try:
+                result = getattr(self.mount, name)(*args, **kwargs)
+                future.set_result(result)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.record(name, time.time() - t0)
+                if self.hung is not None:
+                    print(f"Mount link responding again after {name} ({time.time() - t0:0.1f} seconds)")
+                    self.hung = None
+
+    def record(self, name, latency):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(latency)
+
+    def count(self, name, key):
+        with self.lock:
+            counters = self.counters.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + 1
+
+    def timeout(self, name, args, kwargs):
+        timeout = self.timeouts.get(name, DEFAULT_TIMEOUT)
+        if name in TIMED_SLEWS and not kwargs.get('is_freerun', False):
+            slew_time = args[0] if args else kwargs.get('slewTime', kwargs.get('slew_time', 0))
+            timeout += float(slew_time or 0)
+        return timeout
+
+    def submit(self, name, args, kwargs):
+        future = Future()
+        with self.lock:
+            # a read waiting in the queue serves every caller
+            if name.startswith('get_') and name in self.pending_reads:
+                counters = self.counters.setdefault(name, {})
+                counters['coalesced'] = counters.get('coalesced', 0) + 1
+                return self.pending_reads[name]
+            if name.startswith('get_'):
+                self.pending_reads[name] = future
+        self.queue.put((name, args, kwargs, future))
+        return future
+
+    def mark_hung(self, name):
+        """The worker is stuck in a serial call: cancel the queued commands."""
+        self.hung = name
+        self.state.clear()
+        with self.lock:
+            self.pending_reads.clear()
+        while True:
+            try:
+                _, _, _, future = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            future.cancel()
+        print(f"Mount command {name} is not returning, the mount link is marked as hung")
+
+    def call(self, name, *args, **kwargs):
+        """Sends a command and waits for its result (with timeout and retries)."""
+        if self.hung is not None:
+            self.count(name, 'failures')
+            raise MountCommandError(f"{name} not sent: the mount link is hung ({self.hung} did not return)")
+        if name in STATE_COMMANDS:
+            key = args[STATE_COMMANDS[name]] if args else next(iter(kwargs.values()), None)
+            if self.state.get(name, object()) == key:
+                self.count(name, 'coalesced')
+                return None
+
+        retries = self.retries if name in RETRY_SAFE else 0
+        wait = self.backoff
+        for attempt in range(retries+1):
+            future = self.submit(name, args, kwargs)
+            try:
+                result = future.result(timeout=self.timeout(name, args, kwargs))
+            except TimeoutError:
+                self.count(name, 'timeouts')
+                error = MountCommandError(f"{name} timed out")
+                # a timed out command must not be sent later
+                if not future.cancel() and not future.done():
+                    # the worker is stuck in this call, a retry would only wait behind it
+                    self.mark_hung(name)
+                    break
+            except Exception as e:
+                self.count(name, 'failures')
+                error = e
+            else:
+                if name in STATE_COMMANDS:
+                    self.state[name] = key
+                elif name in GOTO_ARROW_SPEED:
+                    self.state['set_arrow_speed'] = kwargs.get('speed', GOTO_ARROW_SPEED[name])
+                elif name in INVALIDATE:
+                    self.state.clear()
+                return result
+
+            # the state of the mount is unknown after a failure
+            self.state.clear()
+            if attempt < retries:
+                self.count(name, 'retries')
+                print(f"Mount command {name} failed ({error}), retrying in {wait:0.1f} seconds")
+                time.sleep(wait)
+                wait *= 2
+
+        raise MountCommandError(f"{name} failed after {attempt+1} attempts: {error}")
+
+    def stats(self):
+        """Per-command latency statistics [s] and counters."""
+        with self.lock:
+            names = set(self.latencies) | set(self.counters)
+            out = {}
+            for name in sorted(names):
+                lat = np.array(self.latencies.get(name, []))
+                out[name] = {'count': len(lat),
+                             'mean': float(lat.mean()) if len(lat) else np.nan,
+                             'p50': float(np.percentile(lat, 50)) if len(lat) else np.nan,
+                             'p95': float(np.percentile(lat, 95)) if len(lat) else np.nan,
+                             'max': float(lat.max()) if len(lat) else np.nan}
+                for key in ('coalesced', 'retries', 'timeouts', 'failures'):
+                    out[name][key] = self.counters.get(name, {}).get(key, 0)
+            return out
+
+    def report(self):
+        print(f"{'command':>20s} {'count':>6s} {'mean':>7s} {'p95':>7s} {'max':>7s} {'coal.':>6s} {'retry':>6s} {'fail':>6s}")
+        for name, s in self.stats().items():
+            print(f"{name:>20s} {s['count']:6d} {s['mean']:7.3f} {s['p95']:7.3f} {s['max']:7.3f} "
+                  f"{s['coalesced']:6d} {s['retries']:6d} {s['failures']+s['timeouts']:6d}")
+
+    def close(self):
+        self.running = False
+        self.worker.join(1.0)
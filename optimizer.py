@@ -0,0 +1,371 @@
+"""
+Sweep Parameter Optimizer
+
+Searches the sweep parameters of the Scheduler (azimuth slew time, elevation
+slew time and photodiode delay) with the replay simulator, instead of tuning
+them on sky time:
+
+1) Fit a timing model from the archive (`RecordedNight.fit_timing`: slew
+   rates and latency, goto overhead, pointing jitter and the electrometer
+   overhead per exposure), median of the nights, clamped to the range of a
+   working mount
+2) Simulate one map per candidate (replay devices on a virtual clock), in parallel
+3) Keep the candidates within the coverage and spacing limits and minimize
+   the map duration (grid search, refined around the best candidate)
+4) Validate the best candidate with the pointing jitter on (at least
+   `MIN_PASS_FRACTION` of the jittered maps within the limits), and write the
+   parameter set as JSON, loaded with `Scheduler.load_sweep_params`
+
+The current settings (`BASELINE`, run.py) are a candidate as well: when no
+validated candidate is faster, nothing is written.
+
+The limits are on the simulated pointings: the lowest altitude, the spacing
+between elevation steps, the azimuth span and spacing, and how much of the
+way back up the slewing-up exposure covers without overshooting 85 deg.
+
+Usage:
+    python optimizer.py --nights 20241002 20241003 --output sweep_params.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from loader import list_nights, night_filename
+from replay import (DEFAULT_TIMING, RECORDED_AZ_SLEW_TIME, RECORDED_EL_SLEW_TIME, MemoryDatabase,
+                    RecordedNight, ReplayMount, VirtualClock, make_devices)
+from scheduler import PHOTODIODE_DELAY, Scheduler, validate_sweep_params
+
+# plausible range of the timing model, the fits of a night are clamped to it
+MODEL_LIMITS = {
+    'el_rate': (2.0, 7.0),         # deg/s
+    'az_rate': (2.0, 7.0),         # deg/s
+    'alt_jitter': (0.0, 1.0),      # deg
+    'overhead': (0.0, 2.0),        # seconds per exposure
+    'slew_latency': (0.0, 2.0),    # seconds per timed slew
+    'goto_settle': (0.0, 3.0),     # seconds
+    'scale_time': (0.0, 5.0),      # seconds per auto scale
+    'goto_overhead': (0.0, 10.0),  # seconds per goto
+}
+# the sweep parameters are the candidates, the rest of the timing model is fitted
+DEFAULT_MODEL = {k: v for k, v in DEFAULT_TIMING.items()
+                 if k not in ['el_steps', 'az_steps', 'el_slew_time', 'az_slew_time', 'exp_time']}
+
+# limits of the simulated map
+LIMITS = {
+    'lowest_alt': 40.0,        # deg, the lowest pointing is at most this altitude
+    'min_alt_spacing': 5.0,    # deg between elevation steps
+    'max_alt_spacing': 15.0,   # deg
+    'min_az_span': 170.0,      # deg covered by the forward azimuth sweep
+    'max_az_spacing': 35.0,    # deg between azimuth cycles
+    'min_up_coverage': 0.75,   # fraction of the way back to 85 deg covered by the slewing-up exposure
+    'max_overshoot': 2.0,      # deg above 85 deg at the end of the slewing-up exposure
+}
+
+# fraction of the jittered maps within the limits for a validated candidate
+MIN_PASS_FRACTION = 0.9
+
+# search range of the parameters
+SEARCH_SPACE = {
+    'az_slew_time': (6.0, 9.0),
+    'el_slew_time': (1.5, 3.5),
+    'photodiode_delay': (0.0, 3.0),
+}
+
+# run.py
+BASELINE = {'az_steps': 7, 'az_slew_time': RECORDED_AZ_SLEW_TIME, 'el_steps': 5,
+            'el_slew_time': RECORDED_EL_SLEW_TIME, 'photodiode_delay': PHOTODIODE_DELAY}
+
+TOP_ALT = 85.0
+
+
+def fit_night(night):
+    """
+    Timing model of a recorded night (see `RecordedNight.fit_timing`), None
+    when the night has no complete map to fit it on.
+    """
+    recorded = RecordedNight(night)
+    if len(recorded) < 10:
+        return None
+    timing = recorded.fit_timing()
+    if not np.isfinite(timing['gaps']['step']):
+        return None
+    fit = {k: timing[k] for k in DEFAULT_MODEL}
+    fit['nexposures'] = len(recorded)
+    return fit
+
+
+def fit_timing_model(nights):
+    """
+    Timing model from several nights: median of the nightly fits, clamped to MODEL_LIMITS.
+
+    Returns:
+    dict: the DEFAULT_MODEL keys and the nightly fits
+    """
+    fits = {}
+    for night in nights:
+        fit = fit_night(night)
+        if fit is not None:
+            fits[os.path.basename(night)[:8]] = fit
+
+    model = dict(DEFAULT_MODEL)
+    for key in DEFAULT_MODEL:
+        values = np.array([f[key] for f in fits.values()], dtype=float)
+        values = values[np.isfinite(values)]
+        if not len(values):
+            continue
+        model[key] = float(np.median(values))
+        if key in MODEL_LIMITS:
+            vmin, vmax = MODEL_LIMITS[key]
+            value = float(np.clip(model[key], vmin, vmax))
+            if value != model[key]:
+                print(f"Warning: {key}={model[key]:0.3f} out of range, clamped to {value:0.3f}")
+            model[key] = value
+    model['nights'] = fits
+    return model
+
+
+class TracingMount(ReplayMount):
+    """Replay mount that records the altitude at the end of each slewing-up exposure."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.up_alts = []
+
+    def stop_updown(self):
+        super().stop_updown()
+        self.up_alts.append(self.alt)
+
+
+def simulate_map(params, model, recorded, seed=0, jitter=False):
+    """
+    Simulates one map with the sweep parameters on the timing model.
+
+    Returns:
+    dict: map_duration [min] and the pointing metrics checked against LIMITS
+    """
+    clock = VirtualClock(recorded.start)
+    mount, photodiode = make_devices(clock, recorded, dict(model, el_steps=params['el_steps']), seed=seed,
+                                     jitter=jitter, mount_class=TracingMount)
+    database = MemoryDatabase()
+
+    s = Scheduler(filter=recorded.filter, mount=mount, photodiode=photodiode, database=database, clock=clock)
+    s.set_azimuth_sweep_params(az_steps=int(params['az_steps']), az_slew_time=params['az_slew_time'])
+    s.set_elevation_sweep_params(el_steps=int(params['el_steps']), el_slew_time=params['el_slew_time'],
+                                 photodiode_delay=params['photodiode_delay'],
+                                 el_corrections=params.get('el_corrections'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        s.map_alt_az()
+    metrics = pointing_metrics(database.rows, mount.up_alts)
+    metrics['map_duration'] = (clock.time() - recorded.start)/60.
+    return metrics
+
+
+def pointing_metrics(rows, up_alts):
+    """Coverage and spacing of the simulated exposures (rows of the nightly file)."""
+    alt = np.array([r[6] for r in rows], dtype=float)
+    az = np.array([r[7] for r in rows], dtype=float)
+    alt_rank = np.array([r[12] for r in rows])
+    az_rank = np.array([r[13] for r in rows])
+    flag = np.array([r[15] is True for r in rows])
+    step = ~flag & (alt_rank > 0)
+
+    # elevation steps, the first one from the top
+    dalt = []
+    last_alts = []
+    start = np.flatnonzero(step & (alt_rank == 1))
+    for i in start:
+        cycle = [TOP_ALT]
+        j = i
+        while j < len(rows) and step[j] and az_rank[j] == az_rank[i]:
+            cycle.append(alt[j])
+            j += 1
+        dalt += list(np.abs(np.diff(cycle)))
+        last_alts.append(cycle[-1])
+
+    # azimuth cycles of the forward sweep (the backward sweep starts with a goto to its end)
+    cycle_az = az[start[:len(start)//2]] if len(start) > 1 else az[start]
+    daz = np.abs(np.diff(cycle_az))
+    az_span = np.ptp(cycle_az) if len(cycle_az) else 0.
+
+    up = np.array(up_alts[:len(last_alts)])
+    last = np.array(last_alts[:len(up)])
+    coverage = (up - last)/(TOP_ALT - last) if len(up) else np.array([np.nan])
+    return {'lowest_alt': float(np.max(last_alts)),
+            'min_alt_spacing': float(np.min(dalt)), 'max_alt_spacing': float(np.max(dalt)),
+            'min_az_span': float(az_span), 'max_az_spacing': float(np.max(daz)) if len(daz) else 0.,
+            'min_up_coverage': float(np.min(coverage)), 'max_overshoot': float(np.max(up - TOP_ALT)) if len(up) else 0.,
+            'nexposures': len(rows)}
+
+
+def check_limits(metrics, limits=LIMITS):
+    """Names of the limits the metrics violate (lowest_alt and max_* are upper limits)."""
+    violations = []
+    for key, limit in limits.items():
+        value = metrics[key]
+        upper = key == 'lowest_alt' or key.startswith('max_')
+        if not np.isfinite(value) or (value > limit if upper else value < limit):
+            violations.append(key)
+    return violations
+
+
+# the workers load the reference night once
+_worker = {}
+
+
+def _init_worker(night, model, limits):
+    _worker['recorded'] = RecordedNight(night)
+    _worker['model'] = model
+    _worker['limits'] = limits
+
+
+def _evaluate(params):
+    try:
+        metrics = simulate_map(params, _worker['model'], _worker['recorded'])
+    except Exception as e:
+        return {'params': params, 'error': repr(e), 'violations': ['error'], 'map_duration': np.inf}
+    return {'params': params, 'metrics': metrics, 'violations': check_limits(metrics, _worker['limits']),
+            'map_duration': metrics['map_duration']}
+
+
+def _validate(args):
+    params, nvalidate = args
+    runs = [simulate_map(params, _worker['model'], _worker['recorded'], seed=seed, jitter=True)
+            for seed in range(nvalidate)]
+    median = {key: float(np.median([m[key] for m in runs])) for key in _worker['limits']}
+    npass = sum(not check_limits(m, _worker['limits']) for m in runs)
+    return {'nruns': nvalidate, 'npass': npass, 'passed': npass >= MIN_PASS_FRACTION*nvalidate,
+            'violations': check_limits(median, _worker['limits']),
+            'map_duration_max': float(max(m['map_duration'] for m in runs))}
+
+
+def make_grid(space, ngrid, fixed):
+    """Candidates on a regular grid of the search space, with the fixed parameters."""
+    axes = [np.round(np.linspace(vmin, vmax, ngrid), 3) for vmin, vmax in space.values()]
+    return [dict(fixed, **dict(zip(space, (float(v) for v in values)))) for values in itertools.product(*axes)]
+
+
+def refine_space(space, best, ngrid):
+    """Search space of one grid cell around the best candidate."""
+    out = {}
+    for key, (vmin, vmax) in space.items():
+        step = (vmax - vmin)/(ngrid - 1)
+        out[key] = (max(vmin, best[key] - step), min(vmax, best[key] + step))
+    return out
+
+
+def rank(results):
+    feasible = [r for r in results if not r['violations']]
+    return sorted(feasible, key=lambda r: r['map_duration'])
+
+
+def optimize(night, model, az_steps=7, el_steps=5, space=SEARCH_SPACE, limits=LIMITS,
+             ngrid=7, nrefine=2, nproc=None, nvalidate=10, ncandidates=20):
+    """
+    Searches the sweep parameters that minimize the map duration within the limits.
+
+    Parameters:
+    night (str): reference night for the replay photodiode (the currents do not change the timing)
+    model (dict): timing model (see `fit_timing_model`)
+    ngrid (int): grid points per parameter
+    nrefine (int): refinements of the grid around the best candidate
+    nvalidate (int): simulations with pointing jitter of the best candidates
+    ncandidates (int): candidates validated in parallel, from the fastest one
+
+    Returns:
+    dict: best candidate, baseline (with its validation), number of evaluations
+        and the validation runs of the best candidate
+    """
+    fixed = {'az_steps': az_steps, 'el_steps': el_steps}
+    with Pool(nproc, initializer=_init_worker, initargs=(night, model, limits)) as pool:
+        # the current settings compete with the grid
+        baseline = pool.apply(_evaluate, (dict(BASELINE, **fixed),))
+        baseline['validation'] = pool.apply(_validate, ((baseline['params'], nvalidate),))
+        results = [baseline]
+        for i in range(nrefine+1):
+            results += pool.map(_evaluate, make_grid(space, ngrid, fixed))
+            ranked = rank(results)
+            if not ranked:
+                break
+            print(f"Pass {i+1}: {len(results)} candidates, best {ranked[0]['map_duration']:0.2f} min/map")
+            space = refine_space(space, ranked[0]['params'], ngrid)
+
+        # the candidates on the edge of a limit fail with the pointing jitter on
+        ranked = rank(results)
+        for i in range(0, len(ranked), ncandidates):
+            batch = ranked[i:i+ncandidates]
+            validations = pool.map(_validate, [(c['params'], nvalidate) for c in batch])
+            for candidate, validation in zip(batch, validations):
+                if validation['passed'] and not validation['violations']:
+                    validate_sweep_params(candidate['params'])
+                    return {'best': candidate, 'baseline': baseline, 'nevaluations': len(results),
+                            'validation': validation}
+    raise RuntimeError("no candidate within the limits, relax the limits or widen the search space")
+
+
+def is_improvement(result):
+    """The best candidate is faster than the current settings, or they do not pass the validation."""
+    baseline = result['baseline']
+    if baseline['violations'] or not baseline['validation']['passed'] or baseline['validation']['violations']:
+        return True
+    return result['best']['map_duration'] < baseline['map_duration']
+
+
+def write_params(fname, result, model, limits=LIMITS):
+    """Writes the parameter set in the format read by `Scheduler.load_sweep_params`."""
+    out = {'created': datetime.datetime.utcnow().isoformat(),
+           'params': result['best']['params'],
+           'map_duration': result['best']['map_duration'],
+           'metrics': result['best']['metrics'],
+           'baseline': {'params': result['baseline']['params'],
+                        'map_duration': result['baseline']['map_duration'],
+                        'violations': result['baseline']['violations'],
+                        'validation': result['baseline']['validation']},
+           'validation': result['validation'],
+           'limits': limits,
+           'model': model}
+    tmp = f'{fname}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(out, f, indent=2)
+    os.replace(tmp, fname)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimize the sweep parameters with the replay simulator")
+    parser.add_argument('--nights', nargs='*', default=None, help="nights (YYYYMMDD) of the timing model (default: all)")
+    parser.add_argument('--root', default=None, help="database root (default: config.databaseRoot)")
+    parser.add_argument('--az-steps', type=int, default=7)
+    parser.add_argument('--el-steps', type=int, default=5)
+    parser.add_argument('--ngrid', type=int, default=7, help="grid points per parameter")
+    parser.add_argument('--nrefine', type=int, default=2, help="grid refinements")
+    parser.add_argument('--nproc', type=int, default=None)
+    parser.add_argument('--output', default='sweep_params.json')
+    args = parser.parse_args()
+
+    if args.nights:
+        nights = [night_filename(n, args.root) for n in args.nights]
+    else:
+        nights = list_nights(args.root)
+
+    model = fit_timing_model(nights)
+    print("Timing model: " + ", ".join(f"{k}={model[k]:0.3f}" for k in MODEL_LIMITS))
+
+    result = optimize(nights[-1], model, az_steps=args.az_steps, el_steps=args.el_steps,
+                      ngrid=args.ngrid, nrefine=args.nrefine, nproc=args.nproc)
+
+    best, baseline = result['best'], result['baseline']
+    print(f"Baseline: {baseline['map_duration']:0.2f} min/map {baseline['params']} "
+          f"{'(violates ' + ', '.join(baseline['violations']) + ')' if baseline['violations'] else ''}"
+          f"(validation {baseline['validation']['npass']}/{baseline['validation']['nruns']})")
+    print(f"Best:     {best['map_duration']:0.2f} min/map {best['params']} "
+          f"(validation {result['validation']['npass']}/{result['validation']['nruns']})")
+    if not is_improvement(result):
+        print(f"The current settings are the fastest validated parameters, {args.output} not written")
+    else:
+        write_params(args.output, result, model)
+        print(f"Written to {args.output} ({result['nevaluations']} evaluations)")
@@ -0,0 +1,218 @@
+"""
+Pointing Repeatability and Slew-Rate Analytics
+
+Batch version of the `Repeatability` and `checkSlewRate` notebooks, over all
+the nights of the archive:
+
+1) Load every night and split it in maps (`reduction.assign_map_ids`)
+2) Pointing scatter: mean and std of Alt/Az per (night, map_id, direction, az_rank,
+   alt_rank) and per (night, direction, az_rank, alt_rank) across the maps of the night
+3) Slew rates: achieved rate of each elevation step from the mount pointing
+   files, versus the commanded slew time and arrow speed
+4) Nightly summary and drift detection across nights
+
+The drift detection fits a linear trend of each nightly metric versus date
+and compares the last night with the previous ones (median and MAD), so a
+degrading mount shows up before it costs maps.
+
+Usage:
+    python pointing.py --output ./pointing_report
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import archive
+from loader import list_nights, load_nights, resolve_data_path
+from reduction import assign_map_ids, pointings
+
+DEFAULT_ARROW_SPEED = 9  # used by the Scheduler before it was stored in the mount files
+DRIFT_SIGMA = 3.0
+
+
+def pointing_scatter(df, by=('night', 'map_id')):
+    """
+    Pointing scatter of each (az_rank, alt_rank) pointing.
+
+    Parameters:
+    df (DataFrame): exposures with map ids (see `reduction.assign_map_ids`)
+    by (tuple): grouping on top of the pointing, ('night', 'map_id') for the
+        scatter within each map (forward and backward visits) or ('night',)
+        for the scatter across the maps of the night
+
+    The nights without azimuth ranks (az_rank 0, 20240924 and 20240925) do not
+    tell the pointings apart and are skipped.
+
+    Returns:
+    DataFrame: Alt/Az mean, std and count per group
+    """
+    df = pointings(df)
+    df = df[df['az_rank'] > 0]
+    # the backward sweep ranks depend on the Scheduler version, keep the sweeps apart
+    keys = list(by) + ['direction', 'az_rank', 'alt_rank']
+    out = df.groupby(keys, sort=True).agg(Alt_mean=('Alt', 'mean'), Alt_std=('Alt', 'std'),
+                                          Az_mean=('Az', 'mean'), Az_std=('Az', 'std'),
+                                          count=('Alt', 'size'))
+    return out.reset_index()
+
+
+def read_mount_file(fname, root=None):
+    """
+    Loads a mount pointing file (saved with np.savez, the CSV omits the extension).
+
+    Files that are not on disk are read from the monthly archive (see archive.py).
+    """
+    if not fname:
+        return None
+    path = fname
+    if not os.path.isfile(f'{path}.npz'):
+        path = resolve_data_path(fname, root)
+    for path in (path, f'{path}.npz'):
+        if os.path.isfile(path):
+            with np.load(path, allow_pickle=True) as data:
+                return {k: data[k] for k in data.files}
+    return archive.read_mount(fname, root)
+
+
+def load_mount_steps(df, root=None):
+    """
+    One row per elevation step of every mount pointing file of the exposures.
+
+    Returns:
+    DataFrame: night, mount_filename, step, alt_start, slew_angle, slew_duration,
+        slew_rate, slew_time (commanded), arrow_speed, direction
+    """
+    files = df[['night', 'mount_filename']].drop_duplicates()
+    columns = {k: [] for k in ['night', 'mount_filename', 'step', 'alt_start', 'slew_angle', 'slew_duration',
+                               'slew_rate', 'slew_time', 'arrow_speed', 'direction']}
+    for night, fname in files.itertuples(index=False):
+        data = read_mount_file(fname, root)
+        if data is None or 'slew_rate' not in data:
+            continue
+        rate = np.atleast_1d(data['slew_rate']).astype(float)
+        angle = np.atleast_1d(data['slew_angle']).astype(float)
+        duration = np.atleast_1d(data['slew_duration']).astype(float)
+        n = min(len(rate), len(angle)-1, len(duration))
+        columns['night'] += [night]*n
+        columns['mount_filename'] += [fname]*n
+        columns['step'].append(np.arange(1, n+1))
+        columns['alt_start'].append(angle[:n])
+        columns['slew_angle'].append(np.diff(angle)[:n])
+        columns['slew_duration'].append(duration[:n])
+        columns['slew_rate'].append(rate[:n])
+        columns['slew_time'] += [float(data.get('test_slew_time', np.nan))]*n
+        columns['arrow_speed'] += [int(data.get('arrow_speed', DEFAULT_ARROW_SPEED))]*n
+        columns['direction'] += [str(data.get('direction', 'down'))]*n
+
+    for k in ['step', 'alt_start', 'slew_angle', 'slew_duration', 'slew_rate']:
+        columns[k] = np.concatenate(columns[k]) if columns[k] else np.array([])
+    return pd.DataFrame(columns)
+
+
+def slew_rate_stats(steps):
+    """
+    Achieved slew rates per night, commanded slew time, arrow speed and step.
+
+    `efficiency` is the achieved angle over the angle expected from the
+    median rate of the group and the commanded slew time. `correction` is
+    the factor used in `Scheduler.sweep_elevation` (median rate / step rate).
+    """
+    if steps.empty:
+        return pd.DataFrame()
+    steps = steps.assign(abs_rate=steps['slew_rate'].abs(), abs_angle=steps['slew_angle'].abs())
+    keys = ['night', 'slew_time', 'arrow_speed', 'step']
+    out = steps.groupby(keys, sort=True).agg(rate_mean=('abs_rate', 'mean'), rate_std=('abs_rate', 'std'),
+                                             angle_mean=('abs_angle', 'mean'), alt_start=('alt_start', 'mean'),
+                                             duration_mean=('slew_duration', 'mean'), count=('abs_rate', 'size'))
+    out = out.reset_index()
+    median_rate = out.groupby(['night', 'slew_time', 'arrow_speed'])['rate_mean'].transform('median')
+    out['correction'] = median_rate/out['rate_mean']
+    out['efficiency'] = out['angle_mean']/(median_rate*out['slew_time'])
+    return out
+
+
+def nightly_summary(scatter, rates=None):
+    """
+    One row per night with the pointing and slew-rate metrics tracked for drift.
+
+    scatter: `pointing_scatter(df, by=('night',))`
+    rates: `slew_rate_stats(steps)` (optional)
+
+    The nights missing from `scatter` (no azimuth ranks) are left out, the
+    slew rates of those nights are not joined either.
+    """
+    summary = scatter.groupby('night').agg(alt_scatter=('Alt_std', 'median'),
+                                           alt_scatter_p90=('Alt_std', lambda x: np.nanpercentile(x, 90) if x.notna().any() else np.nan),
+                                           az_scatter=('Az_std', 'median'),
+                                           npointings=('count', 'sum'))
+    if rates is not None and not rates.empty:
+        summary = summary.join(rates.groupby('night').agg(slew_rate=('rate_mean', 'median'),
+                                                          slew_rate_spread=('rate_std', 'median'),
+                                                          efficiency=('efficiency', 'median')))
+    summary = summary.reset_index()
+    summary['date'] = pd.to_datetime(summary['night'], format='%Y%m%d')
+    return summary
+
+
+def detect_drift(summary, metrics=None, nsigma=DRIFT_SIGMA):
+    """
+    Trend and drift of each nightly metric.
+
+    Returns:
+    DataFrame: metric, slope per 30 days, last value, robust z-score of the last
+        night versus the previous ones and an `alert` flag
+    """
+    if metrics is None:
+        metrics = [c for c in summary.columns if c not in ('night', 'date', 'npointings')]
+    days = (summary['date'] - summary['date'].min()).dt.days.to_numpy(dtype=float)
+
+    rows = []
+    for metric in metrics:
+        y = summary[metric].to_numpy(dtype=float)
+        ok = np.isfinite(y)
+        slope = np.polyfit(days[ok], y[ok], 1)[0]*30 if ok.sum() >= 3 and np.ptp(days[ok]) > 0 else np.nan
+
+        z = np.nan
+        if ok.sum() >= 4:
+            history, last = y[ok][:-1], y[ok][-1]
+            mad = 1.4826*np.median(np.abs(history - np.median(history)))
+            z = (last - np.median(history))/mad if mad > 0 else np.nan
+        rows.append({'metric': metric, 'slope_per_30d': slope, 'last': y[ok][-1] if ok.any() else np.nan,
+                     'last_z': z, 'alert': bool(np.isfinite(z) and abs(z) > nsigma)})
+    return pd.DataFrame(rows)
+
+
+def run(nights, output=None, root=None):
+    """Computes all the tables for a list of nights and writes them as CSV files in `output`."""
+    df = assign_map_ids(load_nights(nights, chile_time=False))
+
+    tables = {'scatter_map': pointing_scatter(df, by=('night', 'map_id')),
+              'scatter_night': pointing_scatter(df, by=('night',))}
+    tables['slew_steps'] = load_mount_steps(df, root)
+    tables['slew_rates'] = slew_rate_stats(tables['slew_steps'])
+    tables['summary'] = nightly_summary(tables['scatter_night'], tables['slew_rates'])
+    tables['drift'] = detect_drift(tables['summary'])
+
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+        for name, table in tables.items():
+            table.to_csv(os.path.join(output, f'{name}.csv'), index=False)
+    return tables
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pointing repeatability and slew-rate analytics over the archive")
+    parser.add_argument('--root', default=None, help="database root (default: config.databaseRoot)")
+    parser.add_argument('--month', default='*', help="month to process (YYYYMM), default: all")
+    parser.add_argument('--output', default=None, help="folder for the output tables")
+    args = parser.parse_args()
+
+    tables = run(list_nights(args.root, month=args.month), output=args.output, root=args.root)
+    print(tables['summary'].to_string(index=False))
+    print("")
+    print(tables['drift'].to_string(index=False))
+    for row in tables['drift'].itertuples():
+        if row.alert:
+            print(f"ALERT: {row.metric} drifted on the last night (z={row.last_z:0.1f})")
@@ -0,0 +1,306 @@
+"""
+Time-Critical Map Prioritization
+
+In a raster map (`Scheduler.map_alt_az`) the pointings are visited in a fixed
+order and the first and last ones are minutes apart, while the sky near the
+Sun-side horizon changes much faster than elsewhere. This module orders the
+pointings of a map by how fast the brightness of each region changes:
+
+1) Rates: slope of log10|current| versus time [dex/min] of each region of the
+   sky, from the reduced maps of past nights (`fit_region_rates`) and updated
+   with the exposures of the current night (`RateEstimator`)
+2) Visits: the visit budget of a raster map (two visits per pointing) is split
+   between the pointings proportionally to their rate, with at least one visit each
+3) Order: stride scheduling spreads the visits of each pointing evenly over the
+   map, so fast regions are revisited often and slow ones once
+4) Time: the visit budget is reduced until the expected time of the plan
+   (`plan_times`, gotos and photodiode auto scales) fits in the time of the
+   raster map. The plan is used only if its skew is lower than the raster
+   one (`choose_plan`), otherwise the raster order is mapped
+5) The Scheduler executes the plan with gotos (`Scheduler.map_pointings`) and
+   records a timestamp per pointing; `reduction.time_correct_map` brings the
+   map to a single reference time
+
+`map_skew` measures the time consistency of a plan: the rms brightness change
+[dex] between the reference time of the map and the closest visit of each
+pointing, i.e. what the time correction has to interpolate.
+
+Usage:
+    python priority.py --nights 20241002 20241003   # plan and compare with the raster order
+"""
+import argparse
+
+import numpy as np
+
+from loader import list_nights, load_nights, night_filename
+from scheduler import RESCALE_DISTANCE
+
+ALT_BIN = 10.     # deg, regions of the rate table
+AZ_BIN = 30.      # deg
+MIN_WEIGHT = 0.1  # fraction of the median rate given to the slowest regions
+VISITS_PER_POINTING = 2  # raster map: forward and backward sweeps
+
+# recorded pointings of run.py (el_steps=5, az_steps=7)
+DEFAULT_ALTS = [75.7, 66.0, 56.3, 46.6, 36.9]
+DEFAULT_AZS = list(np.linspace(0., -179., 7))
+
+
+def fit_region_rates(maps, alt_bin=ALT_BIN, az_bin=AZ_BIN):
+    """
+    Brightness rate of change of each region of the sky from reduced maps.
+
+    Parameters:
+    maps (DataFrame): `reduction.reduce_maps` output (Alt, Az, current, t per pointing and map)
+
+    Returns:
+    DataFrame: Alt, Az, rate [dex/min] (median of the nightly fits) and nnights per region
+    """
+    # pandas is only needed for the rate table (the planning runs on the mount computer)
+    import pandas as pd
+
+    maps = maps[np.isfinite(maps['current']) & (maps['current'] != 0)]
+    maps = maps.assign(alt_bin=np.round(maps['Alt']/alt_bin).astype(int),
+                       az_bin=np.round(maps['Az']/az_bin).astype(int),
+                       logI=np.log10(np.abs(maps['current'])), minutes=maps['t']/60.)
+
+    rows = []
+    for (night, alt_b, az_b), g in maps.groupby(['night', 'alt_bin', 'az_bin']):
+        if len(g) < 3 or np.ptp(g['minutes']) < 1.:
+            continue
+        slope = np.polyfit(g['minutes'] - g['minutes'].mean(), g['logI'], 1)[0]
+        rows.append({'night': night, 'alt_bin': alt_b, 'az_bin': az_b, 'Alt': g['Alt'].mean(),
+                     'Az': g['Az'].mean(), 'rate': slope})
+    if not rows:
+        return pd.DataFrame(columns=['Alt', 'Az', 'rate', 'nnights'])
+    fits = pd.DataFrame(rows)
+    out = fits.groupby(['alt_bin', 'az_bin']).agg(Alt=('Alt', 'mean'), Az=('Az', 'mean'),
+                                                  rate=('rate', 'median'), nnights=('night', 'size'))
+    return out.reset_index(drop=True)
+
+
+def grid_pointings(alts=DEFAULT_ALTS, azs=DEFAULT_AZS):
+    """Pointings of a raster map, with the ranks of `Scheduler.map_alt_az`."""
+    return [{'alt': float(alt), 'az': float(az), 'alt_rank': i+1, 'az_rank': j+1}
+            for j, az in enumerate(azs) for i, alt in enumerate(alts)]
+
+
+def nearest_rate(rates, alt, az):
+    """Rate of the region of the table closest to (alt, az), 0 if the table is empty."""
+    if rates is None or len(rates) == 0:
+        return 0.
+    d2 = (rates['Alt'].to_numpy() - alt)**2 + (rates['Az'].to_numpy() - az)**2
+    return float(rates['rate'].to_numpy()[np.argmin(d2)])
+
+
+class RateEstimator:
+    """
+    Running brightness rates of the pointings during the night.
+
+    Each pointing starts with the rate of the past nights (prior). Once a
+    pointing has been visited twice, its rate is the slope between the visits,
+    smoothed with the previous estimate.
+    """
+    def __init__(self, prior=None, smoothing=0.5, max_age=1800.):
+        self.prior = prior
+        self.smoothing = smoothing
+        self.max_age = max_age
+        self.last = {}
+        self.running = {}
+
+    def update(self, pointing, t, current):
+        key = (pointing['az_rank'], pointing['alt_rank'])
+        if not np.isfinite(current) or current == 0:
+            return
+        logI = np.log10(abs(current))
+        if key in self.last:
+            t0, logI0 = self.last[key]
+            if 0 < t - t0 < self.max_age:
+                rate = (logI - logI0)/((t - t0)/60.)
+                old = self.running.get(key, rate)
+                self.running[key] = self.smoothing*old + (1-self.smoothing)*rate
+        self.last[key] = (t, logI)
+
+    def rate(self, pointing):
+        key = (pointing['az_rank'], pointing['alt_rank'])
+        if key in self.running:
+            return self.running[key]
+        return nearest_rate(self.prior, pointing['alt'], pointing['az'])
+
+
+def allocate_visits(weights, budget):
+    """At least one visit per pointing, the rest proportional to the weights (largest remainder)."""
+    n = len(weights)
+    visits = np.ones(n, dtype=int)
+    extra = budget - n
+    if extra <= 0:
+        return visits
+    share = extra*weights/weights.sum()
+    visits += np.floor(share).astype(int)
+    remainder = budget - visits.sum()
+    visits[np.argsort(-(share - np.floor(share)), kind='stable')[:remainder]] += 1
+    return visits
+
+
+def plan_map(pointings, rates, budget=None, min_weight=MIN_WEIGHT, block=None, max_time=None, timing=None):
+    """
+    Orders the visits of a map by the brightness rate of each pointing.
+
+    Parameters:
+    pointings (list): dicts with alt, az, alt_rank and az_rank (see `grid_pointings`)
+    rates (list): |rate| of each pointing [dex/min]
+    budget (int): total visits, default: the visits of a raster map
+    block (int): visits reordered along the sky to shorten the slews, default: two azimuths of altitudes
+    max_time (float): time [s] of the map (`plan_times` on `timing`): the
+        budget is reduced until the plan fits, down to one visit per pointing
+
+    Returns:
+    list: pointings in visit order, with the visit number of each pointing
+    """
+    budget = VISITS_PER_POINTING*len(pointings) if budget is None else budget
+    if max_time is not None:
+        for n in range(budget, min(budget, len(pointings)) - 1, -1):
+            plan = plan_map(pointings, rates, n, min_weight, block)
+            if plan_times(plan, timing)[-1] <= max_time:
+                break
+        return plan
+
+    rates = np.abs(np.asarray(rates, dtype=float))
+    floor = min_weight*np.median(rates) if np.any(rates > 0) else 1.
+    visits = allocate_visits(np.maximum(rates, floor), budget)
+
+    # stride scheduling: pointing i is visited every 1/visits[i] of the map, starting
+    # half a stride in, so the mean time of its visits is the middle of the map.
+    # The ties are taken in mirrored order before and after the middle (like the
+    # forward and backward sweeps of a raster map).
+    passes = [((k + 0.5)/n, i) for i, n in enumerate(visits) for k in range(n)]
+    order = [i for _, i in sorted(passes, key=lambda x: (x[0], x[1] if x[0] <= 0.5 else -x[1]))]
+
+    # visits close in time are reordered along the sky (alternating in azimuth)
+    block = block or 2*len({p['alt_rank'] for p in pointings})
+    plan, count = [], np.zeros(len(pointings), dtype=int)
+    for k in range(0, len(order), block):
+        chunk = sorted(order[k:k+block], key=lambda i: (pointings[i]['az'], -pointings[i]['alt']),
+                       reverse=(k//block) % 2 == 1)
+        for i in chunk:
+            count[i] += 1
+            plan.append(dict(pointings[i], visit=int(count[i]), nvisits=int(visits[i])))
+    return plan
+
+
+def raster_plan(pointings):
+    """Visit order of `Scheduler.map_alt_az`: forward and backward azimuth sweeps, elevation down."""
+    forward = sorted(pointings, key=lambda p: (p['az_rank'], p['alt_rank']))
+    backward = sorted(pointings, key=lambda p: (-p['az_rank'], p['alt_rank']))
+    return [dict(p, visit=1, nvisits=2) for p in forward] + [dict(p, visit=2, nvisits=2) for p in backward]
+
+
+def plan_times(plan, timing=None):
+    """
+    Expected time [s] of the end of each visit from the start of the map, on a
+    timing model (`optimizer.fit_timing_model`, default: replay.DEFAULT_TIMING).
+
+    Same steps as `Scheduler.map_pointings`: a goto in azimuth when the
+    azimuth changes, a goto in elevation, an auto scale of the photodiode past
+    RESCALE_DISTANCE from the last scaled pointing and the exposure.
+    """
+    if timing is None:
+        from replay import DEFAULT_TIMING
+        timing = DEFAULT_TIMING
+    times, t = [], 0.
+    alt, az = 90., 0.
+    scaled = None
+    for i, p in enumerate(plan):
+        if i == 0 or abs(p['az'] - az) > 0.5:
+            t += timing['goto_overhead'] + abs(p['az'] - az)/timing['goto_rate']
+            az = p['az']
+        t += timing['goto_overhead'] + abs(p['alt'] - alt)/timing['goto_rate']
+        alt = p['alt']
+        if scaled is None or max(abs(p['alt'] - scaled[0]), abs(p['az'] - scaled[1])) > RESCALE_DISTANCE:
+            t += timing['scale_time']
+            scaled = (p['alt'], p['az'])
+        t += timing['exp_time'] + timing['overhead']
+        times.append(t)
+    return np.array(times)
+
+
+def choose_plan(pointings, rates, timing=None, max_time=None):
+    """
+    Priority plan of the pointings if it beats the raster order, the raster order otherwise.
+
+    The priority plan must fit in the time of the raster map (`max_time`,
+    default: `plan_times` of the raster order) and have a lower `map_skew`.
+
+    Returns:
+    list: the plan, and True if it is the priority plan
+    """
+    raster = raster_plan(pointings)
+    raster_times = plan_times(raster, timing)
+    max_time = raster_times[-1] if max_time is None else max_time
+    plan = plan_map(pointings, rates, max_time=max_time, timing=timing)
+    times = plan_times(plan, timing)
+    rate = {(p['az_rank'], p['alt_rank']): r for p, r in zip(pointings, rates)}
+    if times[-1] <= max_time and map_skew(plan, times, rate) < map_skew(raster, raster_times, rate):
+        return plan, True
+    return raster, False
+
+
+def map_skew(plan, times, rates, t_ref=None):
+    """
+    Time consistency of a map: rms over the pointings of the brightness change [dex]
+    between their closest visit and the reference time (default: middle of the map).
+    """
+    times = np.asarray(times, dtype=float)
+    t_ref = 0.5*(times.min() + times.max()) if t_ref is None else t_ref
+    keys = [(p['az_rank'], p['alt_rank']) for p in plan]
+    skew = []
+    for key in dict.fromkeys(keys):
+        idx = [k for k, other in enumerate(keys) if other == key]
+        rate = rates[key] if isinstance(rates, dict) else rates[idx[0]]
+        skew.append(rate*np.min(np.abs(times[idx] - t_ref))/60.)
+    return float(np.sqrt(np.mean(np.square(skew))))
+
+
+def run_priority_maps(scheduler, pointings, estimator, nmaps=1, timing=None, max_time=None):
+    """
+    Maps the sky `nmaps` times, planning each map with the latest rates of the
+    estimator (`choose_plan`: in the time of a raster map, raster order if the
+    priority plan does not lower the skew).
+
+    Returns:
+    list: visits of each map (see `Scheduler.map_pointings`)
+    """
+    maps = []
+    for _ in range(nmaps):
+        plan, priority = choose_plan(pointings, [estimator.rate(p) for p in pointings], timing, max_time)
+        if not priority:
+            print("The priority plan does not lower the time skew, mapping in raster order")
+        maps.append(scheduler.map_pointings(plan, estimator=estimator, flag='priority' if priority else 'raster'))
+    return maps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plan a map ordered by the brightness rate of each region")
+    parser.add_argument('--nights', nargs='*', default=None, help="nights (YYYYMMDD) of the rate table (default: all)")
+    parser.add_argument('--root', default=None, help="database root (default: config.databaseRoot)")
+    args = parser.parse_args()
+
+    from reduction import reduce_maps
+    from replay import DEFAULT_TIMING
+
+    nights = [night_filename(n, args.root) for n in args.nights] if args.nights else list_nights(args.root)
+    rates = fit_region_rates(reduce_maps(load_nights(nights, chile_time=False)))
+    print(rates.to_string(index=False))
+
+    # timing model of the same nights (goto and exposure overheads)
+    from optimizer import fit_timing_model
+    timing = dict(DEFAULT_TIMING, **{k: v for k, v in fit_timing_model(nights).items() if k in DEFAULT_TIMING})
+
+    pointings = grid_pointings()
+    rate = {(p['az_rank'], p['alt_rank']): nearest_rate(rates, p['alt'], p['az']) for p in pointings}
+    raster = raster_plan(pointings)
+    plan = plan_map(pointings, list(rate.values()), max_time=plan_times(raster, timing)[-1], timing=timing)
+    for name, p in [('raster', raster), ('priority', plan)]:
+        times = plan_times(p, timing)
+        print(f"{name:>9s}: {len(p)} visits, {times[-1]/60.:0.2f} min, skew {map_skew(p, times, rate):0.4f} dex")
+    _, priority = choose_plan(pointings, list(rate.values()), timing)
+    print(f"mapping in {'priority' if priority else 'raster'} order")
@@ -0,0 +1,436 @@
+"""
+Twilight Monitor Quicklook Server
+
+Local web page that follows the nightly CSV file while the Scheduler is mapping
+and shows the alt/az map, the timing and QA panels within seconds.
+
+1) A watcher thread polls the nightly file and reads only the new lines
+2) Each new exposure updates the map state in O(1) and produces a delta
+3) The deltas are pushed to the browsers with server-sent events (`/events`)
+4) New clients get a full snapshot first (`/state`)
+
+The acquisition loop is not touched: the quicklook only reads the file that
+the database is already writing.
+
+QA checks:
+- bad range: |current_mean| above `BAD_CURRENT` (electrometer overflow)
+- stuck mount: a new pointing (alt_rank, az_rank) with the same Alt/Az as the previous one
+- stale: no new exposure for more than `STALE_TIME` seconds
+
+Usage:
+    python quicklook.py                    # follows the nightly file being written
+    python quicklook.py --night 20241002 --port 8050
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from loader import list_nights, night_filename, parse_flag, parse_float, parse_int
+
+BAD_CURRENT = 1.0        # A, overflow values from the electrometer
+STUCK_TOLERANCE = 0.05   # deg
+STALE_TIME = 60.         # seconds
+POLL_INTERVAL = 0.5      # seconds
+CLIENT_QUEUE_SIZE = 1000
+
+
+class NightTail:
+    """
+    Follows a nightly CSV file and returns only the rows appended since the last poll.
+
+    If the file is replaced (new inode, e.g. `rawstats.write_back`), gets
+    shorter or its header line changes, the tail restarts from the beginning
+    and `reset` is set.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.offset = 0
+        self.header = None
+        self.first_line = None
+        self.inode = None
+        self.reset = False
+
+    def restart(self):
+        self.offset = 0
+        self.header = None
+        self.first_line = None
+        self.reset = True
+
+    def poll(self):
+        self.reset = False
+        try:
+            st = os.stat(self.fname)
+        except OSError:
+            return []
+        size = st.st_size
+        with open(self.fname, 'rb') as f:
+            first_line = f.readline()
+            if self.offset > 0 and (size < self.offset or st.st_ino != self.inode
+                                    or first_line != self.first_line):
+                self.restart()
+            self.inode = st.st_ino
+            if size == self.offset:
+                return []
+            if self.offset == 0:
+                self.first_line = first_line if first_line.endswith(b'\n') else None
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+
+        # keep incomplete lines for the next poll
+        end = chunk.rfind(b'\n') + 1
+        self.offset += end
+        lines = chunk[:end].decode().splitlines()
+
+        if self.header is None and lines:
+            self.header = next(csv.reader([lines[0]]))
+            lines = lines[1:]
+        return [dict(zip(self.header, values)) for values in csv.reader(lines)]
+
+
+def finite(value):
+    """NaN is not valid JSON, it is sent as null."""
+    return float(value) if value is not None and np.isfinite(value) else None
+
+
+def parse_row(row):
+    """Parses the quicklook fields of a CSV row."""
+    flag, label = parse_flag(row.get('flag'))
+    stamp = row.get('date') or ''
+    t = datetime.datetime.fromisoformat(stamp).replace(tzinfo=datetime.timezone.utc).timestamp() if stamp else np.nan
+    return {'seq_id': parse_int(row.get('seq_id')),
+            't': t,
+            'alt': parse_float(row.get('Alt')),
+            'az': parse_float(row.get('Az')),
+            'current': parse_float(row.get('current_mean')),
+            'exp_time': parse_float(row.get('exp_time')),
+            'alt_rank': parse_int(row.get('alt_rank')),
+            'az_rank': parse_int(row.get('az_rank')),
+            'flag': flag,
+            'label': label}
+
+
+class QuicklookState:
+    """
+    Incremental map, timing and QA state of a night.
+
+    `update` costs O(1) per exposure and returns the delta sent to the clients.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.cells = {}
+        self.nexp = 0
+        self.nbad = 0
+        self.nstuck = 0
+        self.last = None
+        self.last_pointing = None
+        self.interval_mean = np.nan
+        self.interval_max = 0.
+        self.alerts = []
+
+    def update(self, exp):
+        self.nexp += 1
+        alerts = []
+
+        bad = not np.isfinite(exp['current']) or abs(exp['current']) >= BAD_CURRENT
+        if bad:
+            self.nbad += 1
+            alerts.append(f"bad range at seq {exp['seq_id']}: {exp['current']:.3g} A")
+
+        # stuck mount: a new pointing that did not move
+        pointing = (exp['az_rank'], exp['alt_rank'])
+        if not exp['flag'] and self.last_pointing is not None and pointing != self.last_pointing[0]:
+            _, alt, az = self.last_pointing
+            if abs(exp['alt']-alt) < STUCK_TOLERANCE and abs(exp['az']-az) < STUCK_TOLERANCE:
+                self.nstuck += 1
+                alerts.append(f"stuck mount at seq {exp['seq_id']}: Alt={exp['alt']:.2f} Az={exp['az']:.2f}")
+        if not exp['flag']:
+            self.last_pointing = (pointing, exp['alt'], exp['az'])
+
+        # timing
+        interval = np.nan
+        if self.last is not None:
+            interval = exp['t'] - self.last['t']
+            self.interval_mean = interval if np.isnan(self.interval_mean) else 0.9*self.interval_mean + 0.1*interval
+            self.interval_max = max(self.interval_max, interval)
+        self.last = exp
+
+        cell = None
+        if not bad and not exp['flag']:
+            key = f"{exp['az_rank']}-{exp['alt_rank']}"
+            cell = {'key': key, 'alt': finite(exp['alt']), 'az': finite(exp['az']), 't': finite(exp['t']),
+                    'log_current': finite(np.log10(abs(exp['current'])*6.28e18)) if exp['current'] else None}
+            self.cells[key] = cell
+
+        self.alerts = (self.alerts + alerts)[-20:]
+        return {'type': 'exposure', 'cell': cell, 'alerts': alerts, 'timing': self.timing(), 'qa': self.qa()}
+
+    def timing(self):
+        return {'nexp': self.nexp,
+                'last_time': finite(self.last['t']) if self.last else None,
+                'last_exp_time': finite(self.last['exp_time']) if self.last else None,
+                'interval_mean': finite(self.interval_mean),
+                'interval_max': finite(self.interval_max)}
+
+    def qa(self):
+        stale = self.last is not None and time.time() - self.last['t'] > STALE_TIME
+        return {'nbad': self.nbad, 'nstuck': self.nstuck, 'stale': bool(stale)}
+
+    def snapshot(self):
+        return {'type': 'snapshot', 'cells': list(self.cells.values()), 'alerts': self.alerts,
+                'timing': self.timing(), 'qa': self.qa()}
+
+
+class Quicklook:
+    """
+    Watches the nightly file and broadcasts the deltas to the connected clients.
+
+    If `night` is None, the most recently modified nightly file (of this or
+    the previous month) is followed: a night keeps writing its file past UTC
+    midnight, and the state is reset only when the next night starts a new file.
+    """
+    def __init__(self, night=None, root=None, poll_interval=POLL_INTERVAL):
+        self.night = night
+        self.root = root
+        self.poll_interval = poll_interval
+        self.state = QuicklookState()
+        self.tail = None
+        self.clients = []
+        self.lock = threading.RLock()
+        self.running = False
+
+    def current_filename(self):
+        if self.night is not None:
+            if self.night.endswith('.csv'):
+                return self.night
+            return night_filename(self.night, self.root)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        months = {now.strftime('%Y%m'), (now - datetime.timedelta(days=31)).strftime('%Y%m')}
+        nights = [f for month in months for f in list_nights(self.root, month=month)]
+        if not nights:
+            return night_filename(now.strftime('%Y%m%d'), self.root)
+        return max(nights, key=lambda f: (os.path.getmtime(f), f))
+
+    def poll(self):
+        fname = self.current_filename()
+        if self.tail is None or self.tail.fname != fname:
+            self.tail = NightTail(fname)
+            self.reset()
+
+        rows = self.tail.poll()
+        if self.tail.reset:
+            self.reset()
+        for row in rows:
+            try:
+                exp = parse_row(row)
+            except (ValueError, TypeError) as e:
+                print(f"Skipping malformed row (seq_id {row.get('seq_id')}): {e}")
+                continue
+            with self.lock:
+                self.broadcast(self.state.update(exp))
+        return len(rows)
+
+    def reset(self):
+        with self.lock:
+            self.state.reset()
+        self.broadcast(self.state.snapshot())
+
+    def subscribe(self):
+        client = queue.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        with self.lock:
+            self.clients.append(client)
+            client.put(self.state.snapshot())
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def broadcast(self, event):
+        with self.lock:
+            for client in self.clients:
+                try:
+                    client.put_nowait(event)
+                except queue.Full:
+                    # a slow client gets a fresh snapshot instead of the backlog
+                    with client.mutex:
+                        client.queue.clear()
+                    client.put_nowait(self.state.snapshot())
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                self.poll()
+            except Exception as e:
+                # the watcher keeps following the file
+                print(f"Quicklook poll failed: {e!r}")
+            time.sleep(self.poll_interval)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.running = False
+
+
+class QuicklookHandler(BaseHTTPRequestHandler):
+    quicklook = None
+
+    def do_GET(self):
+        if self.path == '/':
+            self.send_body(PAGE.encode(), 'text/html')
+        elif self.path == '/state':
+            with self.quicklook.lock:
+                snapshot = self.quicklook.state.snapshot()
+            self.send_body(json.dumps(snapshot).encode(), 'application/json')
+        elif self.path == '/events':
+            self.stream_events()
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        client = self.quicklook.subscribe()
+        try:
+            while True:
+                try:
+                    event = client.get(timeout=15)
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                except queue.Empty:
+                    # keep-alive, also refreshes the stale flag
+                    self.wfile.write(f"data: {json.dumps({'type': 'qa', 'qa': self.quicklook.state.qa()})}\n\n".encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.quicklook.unsubscribe(client)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(night=None, root=None, host='127.0.0.1', port=8050):
+    quicklook = Quicklook(night=night, root=root)
+    quicklook.start()
+    handler = type('Handler', (QuicklookHandler,), {'quicklook': quicklook})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    print(f"Quicklook on http://{host}:{port} following {quicklook.current_filename()}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        quicklook.stop()
+        server.server_close()
+
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Twilight Monitor Quicklook</title>
+<style>
+body { font-family: sans-serif; display: flex; gap: 2em; }
+#alerts { color: #b00; font-size: 0.9em; }
+td { padding: 0 0.6em; }
+</style></head>
+<body>
+<canvas id="map" width="520" height="520"></canvas>
+<div>
+<h3>Timing</h3><table id="timing"></table>
+<h3>QA</h3><table id="qa"></table>
+<h3>Alerts</h3><div id="alerts"></div>
+</div>
+<script>
+const cells = {};
+const canvas = document.getElementById('map');
+const ctx = canvas.getContext('2d');
+const R = 240, C = 260;
+
+function color(v) {
+  // log(e-/s) from 8 to 14 mapped to a blue-yellow ramp
+  const x = Math.max(0, Math.min(1, (v - 8) / 6));
+  return `rgb(${Math.round(255*x)},${Math.round(200*x)},${Math.round(255*(1-x))})`;
+}
+
+function xy(alt, az) {
+  const r = R * (90 - alt) / 90, th = az * Math.PI / 180;
+  return [C + r * Math.sin(th), C - r * Math.cos(th)];
+}
+
+function drawGrid() {
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  ctx.strokeStyle = '#ccc';
+  for (const alt of [0, 30, 60]) {
+    ctx.beginPath(); ctx.arc(C, C, R * (90 - alt) / 90, 0, 2 * Math.PI); ctx.stroke();
+  }
+}
+
+function drawCell(c) {
+  if (c.log_current === null) return;
+  const [x, y] = xy(c.alt, c.az);
+  ctx.fillStyle = color(c.log_current);
+  ctx.beginPath(); ctx.arc(x, y, 9, 0, 2 * Math.PI); ctx.fill();
+}
+
+function table(id, obj) {
+  document.getElementById(id).innerHTML = Object.entries(obj)
+    .map(([k, v]) => `<tr><td>${k}</td><td>${typeof v === 'number' ? v.toFixed(2) : v}</td></tr>`).join('');
+}
+
+function alerts(list, replace) {
+  const el = document.getElementById('alerts');
+  if (replace) el.innerHTML = '';
+  for (const a of list) el.innerHTML = `<div>${a}</div>` + el.innerHTML;
+}
+
+const source = new EventSource('/events');
+source.onmessage = (msg) => {
+  const ev = JSON.parse(msg.data);
+  if (ev.type === 'snapshot') {
+    for (const k in cells) delete cells[k];
+    drawGrid();
+    for (const c of ev.cells) { cells[c.key] = c; drawCell(c); }
+    alerts(ev.alerts, true);
+  } else if (ev.type === 'exposure') {
+    if (ev.cell) { cells[ev.cell.key] = ev.cell; drawCell(ev.cell); }
+    alerts(ev.alerts, false);
+  }
+  if (ev.timing) table('timing', ev.timing);
+  if (ev.qa) table('qa', ev.qa);
+};
+</script>
+</body></html>
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Twilight Monitor quicklook server")
+    parser.add_argument('--night', default=None, help="night to follow (YYYYMMDD or CSV path), default: the last modified nightly file")
+    parser.add_argument('--root', default=None, help="database root (default: config.databaseRoot)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    args = parser.parse_args()
+
+    serve(night=args.night, root=args.root, host=args.host, port=args.port)
@@ -0,0 +1,329 @@
+"""
+Raw Electrometer Sample Analytics
+
+`Scheduler.acquire` only stores the mean and std of each exposure, while the raw
+electrometer samples (`photodiode.datavector`) are saved to one `.npy` file per
+exposure. This module reprocesses the raw vectors of a night (or a month) in bulk:
+
+1) Memory-map the raw vectors of every exposure
+2) Concatenate them into a flat array with the offsets of each exposure
+3) Compute the per-exposure statistics, vectorized across the ragged vectors
+4) Write the results back to the nightly CSV as extra columns
+
+The statistics are:
+- `current_mean_clip`, `current_std_clip`, `current_nclip`: sigma-clipped mean, std and number of kept samples
+- `current_drift`: linear drift of the current within the exposure [A/s]
+- `noise_white`, `noise_lowf`: noise amplitude spectral density [A/sqrt(Hz)] at high and lowest frequency
+
+The nights are split in chunks of exposures that are processed on multiple cores.
+
+Usage:
+    python rawstats.py 20241002          # one night
+    python rawstats.py 202410 --nproc 8  # one month
+"""
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+import archive
+from loader import list_nights, load_night, night_filename, resolve_data_path, resolve_filename
+
+STAT_COLUMNS = ['current_mean_clip', 'current_std_clip', 'current_nclip',
+                'current_drift', 'noise_white', 'noise_lowf']
+
+
+def read_vector(fname, exp_time=np.nan, root=None):
+    """
+    Memory-maps a raw electrometer vector and returns (time, current).
+
+    The vectors are structured arrays with the fields `time` and `CURR`. Files
+    that are not on disk are read from the monthly archive (see archive.py),
+    missing files return empty arrays. Plain arrays are assumed to be evenly
+    sampled over the exposure time.
+    """
+    path = resolve_data_path(fname, root)
+    if path and os.path.exists(path):
+        data = np.load(path, mmap_mode='r')
+    else:
+        data = archive.read_vector(fname, root) if fname else None
+    if data is None:
+        return np.empty(0), np.empty(0)
+
+    if data.dtype.names is not None and 'CURR' in data.dtype.names:
+        current = np.asarray(data['CURR'], dtype=np.float64).ravel()
+        if 'time' in data.dtype.names:
+            return np.asarray(data['time'], dtype=np.float64).ravel(), current
+    else:
+        current = np.asarray(data, dtype=np.float64).ravel()
+
+    dt = exp_time/len(current) if np.isfinite(exp_time) and len(current) else 1.0
+    return np.arange(len(current))*dt, current
+
+
+def load_vectors(fnames, exp_times=None, root=None):
+    """
+    Loads the ragged raw vectors into flat arrays.
+
+    Returns:
+    time, current (np.array): concatenated samples
+    lengths (np.array): number of samples of each exposure
+    """
+    if exp_times is None:
+        exp_times = np.full(len(fnames), np.nan)
+    times, currents = [], []
+    for fname, exp_time in zip(fnames, exp_times):
+        t, y = read_vector(fname, exp_time, root)
+        times.append(t)
+        currents.append(y)
+    lengths = np.array([len(y) for y in currents], dtype=np.int64)
+    if lengths.sum() == 0:
+        return np.empty(0), np.empty(0), lengths
+    return np.concatenate(times), np.concatenate(currents), lengths
+
+
+def segment_ids(lengths):
+    return np.repeat(np.arange(len(lengths)), lengths)
+
+
+def segment_sum(seg, values, nseg):
+    return np.bincount(seg, weights=values, minlength=nseg)
+
+
+def segment_median(seg, values, mask, nseg):
+    """Median of the masked values of each segment (sorting once by segment and value)."""
+    median = np.full(nseg, np.nan)
+    n = segment_sum(seg, mask, nseg).astype(np.int64)
+    valid = n > 0
+    if not valid.any():
+        return median
+
+    # kept samples come first within each segment, in increasing order
+    order = np.lexsort((values, ~mask, seg))
+    start = np.concatenate([[0], np.cumsum(np.bincount(seg, minlength=nseg))[:-1]])[valid]
+    lo = order[start + (n[valid]-1)//2]
+    hi = order[start + n[valid]//2]
+    median[valid] = 0.5*(values[lo] + values[hi])
+    return median
+
+
+def sigma_clip_segments(current, lengths, nsigma=3.0, niter=5):
+    """
+    Sigma-clipped mean and std of each segment of a flat array.
+
+    The samples are clipped around the segment median with a robust scale
+    (1.4826 MAD), so a single spike is rejected even in 10-sample exposures.
+    When the MAD is zero (quantized readings, most samples equal to the
+    median), the std of the kept samples is used instead.
+
+    Returns:
+    mean, std, nkept (np.array): per segment statistics
+    mask (np.array): samples kept by the clipping
+    """
+    nseg = len(lengths)
+    seg = segment_ids(lengths)
+    finite = np.isfinite(current)
+    values = np.where(finite, current, 0.)
+    mask = finite
+
+    for _ in range(niter):
+        center = segment_median(seg, values, mask, nseg)
+        resid = np.abs(values - center[seg])
+        scale = 1.4826*segment_median(seg, resid, mask, nseg)
+        flat = ~(scale > 0)
+        if flat.any():
+            n = segment_sum(seg, mask, nseg)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                std = np.sqrt(segment_sum(seg, np.where(mask, resid**2, 0.), nseg)/(n-1))
+            scale[flat] = np.nan_to_num(std[flat])
+        new = finite & (resid <= nsigma*scale[seg])
+        if np.array_equal(new, mask):
+            break
+        mask = new
+
+    n = segment_sum(seg, mask, nseg)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = segment_sum(seg, np.where(mask, values, 0.), nseg)/n
+        var = segment_sum(seg, np.where(mask, (values-mean[seg])**2, 0.), nseg)/(n-1)
+    std = np.sqrt(var)
+    std[n < 2] = np.nan
+    return mean, std, n.astype(np.int64), mask
+
+
+def linear_drift_segments(time, current, lengths, mask=None):
+    """Least-squares slope [A/s] of the current within each segment."""
+    nseg = len(lengths)
+    seg = segment_ids(lengths)
+    if mask is None:
+        mask = np.isfinite(current)
+    w = mask.astype(np.float64)
+    y = np.where(mask, current, 0.)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        n = segment_sum(seg, w, nseg)
+        tmean = segment_sum(seg, w*time, nseg)/n
+        ymean = segment_sum(seg, w*y, nseg)/n
+        tc = time - tmean[seg]
+        slope = segment_sum(seg, w*tc*(y-ymean[seg]), nseg)/segment_sum(seg, w*tc**2, nseg)
+    slope[n < 2] = np.nan
+    return slope
+
+
+def fill_clipped(time, current, lengths, mask):
+    """
+    Replaces the samples rejected by the clipping by a linear interpolation
+    of the kept samples of their segment (the segment is left as it is if
+    less than two samples are kept).
+    """
+    filled = np.array(current, dtype=np.float64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    seg = segment_ids(lengths)
+    for i in np.unique(seg[~mask]):
+        lo, hi = offsets[i], offsets[i+1]
+        keep = mask[lo:hi]
+        if keep.sum() < 2:
+            continue
+        t = time[lo:hi]
+        filled[lo:hi][~keep] = np.interp(t[~keep], t[keep], filled[lo:hi][keep])
+    return filled
+
+
+def noise_spectra(time, current, lengths, mask=None):
+    """
+    One-sided noise amplitude spectral density of each segment.
+
+    The segments are grouped by length and each group is transformed at once,
+    after removing a linear trend. The samples rejected by the clipping
+    (`mask` False) are interpolated first, so a spike does not set the noise level.
+
+    Returns:
+    list of (freq, asd) per segment (None for segments with less than 4 samples)
+    """
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    spectra = [None]*len(lengths)
+    if mask is not None:
+        current = fill_clipped(time, current, lengths, mask)
+
+    for n in np.unique(lengths):
+        if n < 4:
+            continue
+        idx = np.flatnonzero(lengths == n)
+        rows = offsets[idx][:, None] + np.arange(n)[None, :]
+        t, y = time[rows], current[rows]
+        dt = np.median(np.abs(np.diff(t, axis=1)), axis=1)
+        dt[~(dt > 0)] = 1.0
+
+        # remove a linear trend per row
+        tc = t - t.mean(axis=1, keepdims=True)
+        yc = y - y.mean(axis=1, keepdims=True)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = (tc*yc).sum(axis=1, keepdims=True)/(tc**2).sum(axis=1, keepdims=True)
+        yc = yc - np.nan_to_num(slope)*tc
+
+        psd = np.abs(np.fft.rfft(yc, axis=1))**2*(2*dt[:, None]/n)
+        for k, i in enumerate(idx):
+            spectra[i] = (np.fft.rfftfreq(n, dt[k]), np.sqrt(psd[k]))
+    return spectra
+
+
+def summarize_spectra(spectra):
+    """White noise level (median of the upper half of the spectrum) and lowest frequency level."""
+    white = np.full(len(spectra), np.nan)
+    lowf = np.full(len(spectra), np.nan)
+    for i, spec in enumerate(spectra):
+        if spec is None:
+            continue
+        _, asd = spec
+        white[i] = np.median(asd[len(asd)//2:])
+        lowf[i] = asd[1]
+    return white, lowf
+
+
+def process_vectors(fnames, exp_times=None, nsigma=3.0, root=None):
+    """Computes the statistics columns for a list of raw vector files."""
+    time, current, lengths = load_vectors(fnames, exp_times, root)
+    mean, std, nkept, mask = sigma_clip_segments(current, lengths, nsigma=nsigma)
+    drift = linear_drift_segments(time, current, lengths, mask)
+    white, lowf = summarize_spectra(noise_spectra(time, current, lengths, mask))
+    return {'current_mean_clip': mean, 'current_std_clip': std, 'current_nclip': nkept,
+            'current_drift': drift, 'noise_white': white, 'noise_lowf': lowf}
+
+
+def _process_chunk(args):
+    return process_vectors(*args)
+
+
+def process_night(night, nproc=None, chunksize=64, nsigma=3.0, pool=None, root=None):
+    """
+    Computes the statistics of all exposures of a night.
+
+    The exposures are split in chunks of `chunksize` that are processed in parallel.
+    Returns a dict of columns aligned with the rows of the nightly file.
+    """
+    cols = load_night(night, columns=['electrometer_filename', 'exp_time'])
+    fnames = [str(f) for f in cols['electrometer_filename']]
+    exp_times = np.asarray(cols['exp_time'])
+    chunks = [(fnames[i:i+chunksize], exp_times[i:i+chunksize], nsigma, root)
+              for i in range(0, len(fnames), chunksize)]
+
+    if pool is not None:
+        results = pool.map(_process_chunk, chunks)
+    elif nproc == 1 or len(chunks) <= 1:
+        results = [_process_chunk(c) for c in chunks]
+    else:
+        with Pool(nproc) as p:
+            results = p.map(_process_chunk, chunks)
+
+    if not results:
+        return {col: np.empty(0) for col in STAT_COLUMNS}
+    return {col: np.concatenate([r[col] for r in results]) for col in STAT_COLUMNS}
+
+
+def write_back(night, stats):
+    """
+    Adds (or replaces) the statistics columns in the nightly CSV file.
+
+    The original columns are kept as written by the database. Only run it on
+    finished nights, the database appends rows to the file during the night.
+    """
+    fname = resolve_filename(night)
+    df = pd.read_csv(fname, dtype=str, keep_default_na=False)
+    for col in STAT_COLUMNS:
+        df[col] = stats[col]
+    tmp = fname + '.tmp'
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, fname)
+
+
+def process_nights(nights, nproc=None, chunksize=64, nsigma=3.0, write=True, root=None):
+    """Processes several nights sharing a single pool of workers."""
+    out = {}
+    with Pool(nproc) as pool:
+        for night in nights:
+            stats = process_night(night, chunksize=chunksize, nsigma=nsigma, pool=pool, root=root)
+            if write:
+                write_back(night, stats)
+            out[night] = stats
+            print(f"{night}: {len(stats['current_mean_clip'])} exposures processed")
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute exposure statistics from the raw electrometer vectors")
+    parser.add_argument('dates', nargs='+', help="nights (YYYYMMDD) or months (YYYYMM)")
+    parser.add_argument('--root', default=None, help="database root (default: config.databaseRoot)")
+    parser.add_argument('--nproc', type=int, default=None, help="number of processes")
+    parser.add_argument('--nsigma', type=float, default=3.0, help="sigma-clipping threshold")
+    parser.add_argument('--dry-run', action='store_true', help="do not write the columns back")
+    args = parser.parse_args()
+
+    nights = []
+    for date in args.dates:
+        if len(date) == 6:
+            nights += list_nights(args.root, month=date)
+        else:
+            nights.append(night_filename(date, args.root))
+
+    process_nights(nights, nproc=args.nproc, nsigma=args.nsigma, write=not args.dry_run, root=args.root)
@@ -0,0 +1,150 @@
+"""
+Twilight Monitor Map Reduction
+
+Splits the exposures of the nightly files into maps and reduces each map to one
+value per pointing.
+
+A map (`Scheduler.map_alt_az`) is a forward azimuth sweep (0 to -180 deg)
+followed by a backward sweep (-180 to 0 deg). Each sweep visits az_rank = 1..N,
+and in each azimuth cycle alt_rank = 1..M, then takes a slewing-up exposure
+(flag=True, alt_rank=0).
+
+1) `assign_map_ids`: splits the exposures in azimuth cycles, sweeps and maps
+2) `reduce_maps`: one row per (night, map_id, direction, az_rank, alt_rank) with
+   the mean pointing, the median current and the mean time of the exposures
+3) `time_correct_map`: one row per pointing of a map, with the current brought
+   to a single reference time using the brightness rate of each pointing
+"""
+import numpy as np
+import pandas as pd
+
+MAX_GAP = 300.     # seconds without exposures that ends a map
+BAD_CURRENT = 1.0  # A, electrometer overflow
+
+
+def assign_map_ids(df):
+    """
+    Adds `cycle_id`, `sweep_id`, `direction` ('forward'/'backward') and `map_id` columns.
+
+    1) An azimuth cycle ends with the slewing-up exposure (flag=True), or when
+       az_rank changes or after a gap
+    2) A cycle moving to lower Az is forward, otherwise it is backward (the
+       cycle at -180 deg and the last one at 0 deg belong to the backward sweep)
+    3) A map starts with the forward cycle at Az~0 deg (or after a gap)
+
+    The ranks are not used for the direction: older nights numbered the
+    backward sweep from N to 1. The ids start at 1 in each night. `df` needs
+    the columns date, Az, az_rank, flag and (optionally) night.
+    """
+    df = df.copy()
+    if 'night' not in df:
+        df['night'] = ''
+    df = df.sort_values(['night', 'date'], kind='stable')
+
+    t = df['date'].to_numpy()/1e6
+    night = df['night'].to_numpy()
+    az_rank = df['az_rank'].to_numpy()
+    flag = df['flag'].to_numpy().astype(bool)
+
+    first = np.ones(len(df), dtype=bool)
+    first[1:] = night[1:] != night[:-1]
+    gap = np.zeros(len(df), dtype=bool)
+    gap[1:] = (t[1:] - t[:-1]) > MAX_GAP
+    new_cycle = first | gap
+    new_cycle[1:] |= flag[:-1] | (az_rank[1:] != az_rank[:-1])
+    df['cycle_id'] = np.cumsum(new_cycle)
+
+    # one row per cycle
+    cycles = df.groupby('cycle_id', sort=True).agg(night=('night', 'first'), Az=('Az', 'median'))
+    cycle_az = cycles['Az'].to_numpy()
+    cycle_first = first[new_cycle] | gap[new_cycle]
+
+    dprev = np.zeros(len(cycles))
+    dprev[1:] = cycle_az[1:] - cycle_az[:-1]
+    dnext = np.zeros(len(cycles))
+    dnext[:-1] = cycle_az[1:] - cycle_az[:-1]
+    cycle_last = np.ones(len(cycles), dtype=bool)
+    cycle_last[:-1] = cycle_first[1:]
+
+    start_map = cycle_first | ((cycle_az > -10.) & (dnext < -5.) & ~cycle_last)
+    forward = start_map | (~cycle_first & (dprev < -5.))
+    turn = np.ones(len(cycles), dtype=bool)
+    turn[1:] = forward[1:] != forward[:-1]
+    new_sweep = start_map | turn
+
+    map_id = pd.Series(start_map.astype(np.int64)).groupby(cycles['night'].to_numpy()).cumsum().to_numpy()
+    sweep_id = pd.Series(new_sweep.astype(np.int64)).groupby(cycles['night'].to_numpy()).cumsum().to_numpy()
+
+    index = df['cycle_id'].to_numpy() - 1
+    df['direction'] = np.where(forward, 'forward', 'backward')[index]
+    df['sweep_id'] = sweep_id[index]
+    df['map_id'] = map_id[index]
+    return df
+
+
+def pointings(df):
+    """Keeps the pointed exposures (not slewing) with a valid current."""
+    good = ~df['flag'].astype(bool) & (df['alt_rank'] > 0)
+    good &= np.isfinite(df['current_mean']) & (np.abs(df['current_mean']) < BAD_CURRENT)
+    return df[good]
+
+
+def reduce_maps(df):
+    """
+    Reduces each map to one row per pointing.
+
+    Returns:
+    DataFrame: night, map_id, direction, az_rank, alt_rank, Alt, Az, current, current_std, t, nexp
+    """
+    if 'map_id' not in df:
+        df = assign_map_ids(df)
+    df = pointings(df).assign(t=lambda d: d['date']/1e6)
+
+    # the backward sweep is kept apart, its ranks depend on the Scheduler version
+    keys = ['night', 'map_id', 'direction', 'az_rank', 'alt_rank']
+    grouped = df.groupby(keys, sort=True)
+    out = grouped.agg(Alt=('Alt', 'mean'), Az=('Az', 'mean'),
+                      current=('current_mean', 'median'), current_std=('current_mean', 'std'),
+                      t=('t', 'mean'), nexp=('t', 'size'))
+    return out.reset_index()
+
+
+def time_correct_map(df, rates=None, t_ref=None, keys=('az_rank', 'alt_rank')):
+    """
+    Brings the exposures of one map to a single reference time.
+
+    The brightness rate of change [dex/min] of each pointing is the slope of
+    log10|current| versus time of its visits, or `rates` (dict keyed by
+    `keys`, see priority.py) for the pointings visited once.
+
+    Parameters:
+    df (DataFrame): exposures of one map (date, Alt, Az, current_mean, ranks)
+    t_ref (float): reference time [unix seconds], default: middle of the map
+
+    Returns:
+    DataFrame: one row per pointing with Alt, Az, t, rate, nvisits, current
+        (median of the visits) and current_corr (at t_ref)
+    """
+    df = pointings(df).assign(t=lambda d: d['date']/1e6)
+    df = df[df['current_mean'] != 0]
+    if t_ref is None:
+        t_ref = 0.5*(df['t'].min() + df['t'].max())
+    rates = {} if rates is None else rates
+
+    rows = []
+    for key, g in df.groupby(list(keys), sort=True):
+        logI = np.log10(np.abs(g['current_mean'].to_numpy()))
+        minutes = g['t'].to_numpy()/60.
+        if len(g) > 1 and np.ptp(minutes) > 0:
+            rate = np.polyfit(minutes - minutes.mean(), logI, 1)[0]
+        else:
+            rate = rates.get(key, 0.)
+        # log-linear model of each visit, evaluated at the reference time
+        logI_ref = np.mean(logI + rate*(t_ref/60. - minutes))
+        sign = np.sign(np.median(g['current_mean']))
+        rows.append(dict(zip(keys, key), Alt=g['Alt'].mean(), Az=g['Az'].mean(), t=g['t'].mean(),
+                         rate=rate, nvisits=len(g), current=g['current_mean'].median(),
+                         current_corr=sign*10**logI_ref))
+    out = pd.DataFrame(rows)
+    out.attrs['t_ref'] = t_ref
+    return out
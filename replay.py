@@ -0,0 +1,911 @@
+"""
+Recorded-Night Replay Engine
+
+Replays a recorded night from the `DATA` folder through the Scheduler, with
+replay devices in place of the mount, the photodiode and the database, on a
+virtual clock.
+
+1) The timing model is fitted from the recorded night (`RecordedNight.fit_timing`):
+   the sweep parameters from the ranks and the mount files, and the time each
+   command takes from the gaps between the recorded exposures
+2) The virtual clock runs through each recorded run (run.py maps once per
+   run), from the start of the map before its first exposure to the goto zero
+   after its last exposure: an interrupted run is interrupted in the replay.
+   With `continuous`, it runs through each session instead (exposures without
+   a gap longer than `MAX_GAP`), waiting `map_overhead` between maps
+3) The replay mount integrates the slews with rates fitted from the recorded pointings
+4) The replay photodiode returns the recorded current (mean, std) of the nearest
+   recorded exposure in time and position, with the recorded noise
+5) The replay database writes the exposures as a regular nightly file (and raw vectors)
+6) The Scheduler maps the sky until the run ends
+
+Sleeping on the virtual clock does not wait, unless a `speed` is set (e.g.
+speed=100 waits 1 second of wall time per 100 seconds of virtual time).
+
+The output files can be followed by the quicklook and reprocessed like a real
+night. Replaying the same night with different sweep parameters tells how many
+maps the change would have produced (see `compare_runs`). Replaying the
+recorded parameters gives the recorded maps (tests/check_replay.py).
+
+Usage:
+    python replay.py 20241002 --speed 100 --output /tmp/replay
+    python replay.py 20241002 --compare el_steps=5,6
+    python replay.py 20241002 --timing
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from loader import load_dataframe
+from pointing import load_mount_steps
+from reduction import MAX_GAP, assign_map_ids
+from scheduler import EL_CORRECTIONS, PHOTODIODE_DELAY, Scheduler, measure_nsamples
+
+# Default mount model, replaced by the timing fitted from the recorded night
+EL_RATE = 4.5        # deg/s at arrow speed 9
+AZ_RATE = 4.3        # deg/s at arrow speed 9
+GOTO_RATE = 6.0      # deg/s, not constrained by the recorded gaps
+GOTO_OVERHEAD = 1.0  # seconds
+SLEW_PAUSE = 0.3     # seconds
+
+# Commanded slew times of the recorded nights (run.py), used when the mount files are not on disk
+RECORDED_EL_SLEW_TIME = 2.456
+RECORDED_AZ_SLEW_TIME = 7.3
+
+# Default timing model (see `RecordedNight.fit_timing`)
+DEFAULT_TIMING = {
+    'el_steps': 5, 'az_steps': 7,                 # run.py
+    'el_slew_time': RECORDED_EL_SLEW_TIME,        # seconds
+    'az_slew_time': RECORDED_AZ_SLEW_TIME,        # seconds
+    'exp_time': 1.0,                              # seconds
+    'el_rate': EL_RATE, 'az_rate': AZ_RATE,       # deg/s
+    'slew_pause': SLEW_PAUSE,                     # seconds before a timed slew moves
+    'slew_latency': 0.0,                          # seconds a timed slew blocks past its slew time
+    'goto_settle': 0.0,                           # seconds the first timed slew after a goto does not move
+    'overhead': 0.05,                             # seconds per exposure
+    'scale_time': 0.1,                            # seconds per photodiode auto scale
+    'goto_overhead': GOTO_OVERHEAD,               # seconds per goto
+    'goto_rate': GOTO_RATE,                       # deg/s
+    'map_overhead': 0.0,                          # seconds between two maps
+    'alt_jitter': 0.0,                            # deg
+}
+
+# gaps between consecutive exposures, see `classify_gaps`
+GAP_TYPES = ['step', 'up', 'cycle', 'turn', 'map']
+
+COLUMNS = ['tmid', 'date', 'seq_id', 'exp_time_cmd', 'exp_time', 'filter', 'Alt', 'Az',
+           'current_mean', 'current_std', 'alt_std', 'az_std', 'alt_rank', 'az_rank',
+           'electrometer_filename', 'flag', 'mount_filename']
+
+
+class ReplayFinished(Exception):
+    """Raised by the virtual clock when the recorded night is over."""
+    pass
+
+
+class VirtualClock:
+    """
+    Clock with the `time` and `sleep` interface of the time module.
+
+    Parameters:
+    start (float): initial time (unix timestamp)
+    end (float): raises ReplayFinished when the time goes past it
+    speed (float): wall time factor, None runs as fast as possible
+    """
+    def __init__(self, start, end=None, speed=None):
+        self.start = start
+        self.now = start
+        self.end = end
+        self.speed = speed
+        self.wall_start = time.time()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        seconds = max(float(seconds), 0.)
+        self.now += seconds
+        if self.speed:
+            time.sleep(seconds/self.speed)
+        if self.end is not None and self.now > self.end:
+            raise ReplayFinished()
+
+    def speedup(self):
+        wall = time.time() - self.wall_start
+        return (self.now - self.start)/wall if wall > 0 else np.inf
+
+
+class RecordedNight:
+    """
+    The exposures of a recorded night, as arrays.
+
+    `nearest` returns the recorded exposure closest in time and position.
+    """
+    # distance scales: 10 deg in position is as far as 60 seconds in time
+    POSITION_SCALE = 10.
+    TIME_SCALE = 60.
+
+    def __init__(self, night):
+        df = load_dataframe(night, chile_time=False)
+        good = np.isfinite(df['current_mean']) & (np.abs(df['current_mean']) < 1)
+        df = df[good & np.isfinite(df['Alt']) & np.isfinite(df['Az'])]
+        df = df.sort_values('date')
+
+        self.name = os.path.basename(str(night))[:8]
+        self.t = df['date'].to_numpy()/1e6
+        self.alt = df['Alt'].to_numpy()
+        self.az = df['Az'].to_numpy()
+        self.mean = df['current_mean'].to_numpy()
+        self.std = np.nan_to_num(df['current_std'].to_numpy())
+        self.exp_time = df['exp_time'].to_numpy()
+        self.exp_time_cmd = df['exp_time_cmd'].to_numpy().astype(float)
+        self.flag = df['flag'].to_numpy()
+        self.alt_rank = df['alt_rank'].to_numpy()
+        self.az_rank = df['az_rank'].to_numpy()
+        self.filter = str(df['filter'].iloc[0]) if len(df) else 'Empty'
+        self.mount_filename = df['mount_filename'].to_numpy() if 'mount_filename' in df else np.array([])
+
+    def __len__(self):
+        return len(self.t)
+
+    @property
+    def start(self):
+        return self.t[0]
+
+    @property
+    def end(self):
+        return self.t[-1]
+
+    def sessions(self):
+        """(start, end) times of the runs of exposures without a gap longer than MAX_GAP."""
+        if not len(self):
+            return []
+        cut = np.flatnonzero(np.diff(self.t) > MAX_GAP)
+        first = np.concatenate([[0], cut + 1])
+        last = np.concatenate([cut, [len(self) - 1]])
+        return [(self.t[i], self.t[j]) for i, j in zip(first, last)]
+
+    def runs(self):
+        """
+        (start, end) times of the recorded runs: run.py maps once per run, a run
+        is a map of `map_cycles` (a new map, or a gap longer than MAX_GAP).
+        """
+        if not len(self):
+            return []
+        maps = map_cycles(self.t, self.az, self.alt_rank, self.az_rank, self.flag)
+        runs = maps.groupby('map_id')['date'].agg(['min', 'max'])/1e6
+        return list(zip(runs['min'], runs['max']))
+
+    def nearest(self, t, alt, az, flag=False):
+        d2 = ((self.alt-alt)**2 + (self.az-az)**2)/self.POSITION_SCALE**2 + ((self.t-t)/self.TIME_SCALE)**2
+        d2 = np.where(self.flag == flag, d2, d2 + 1e6)
+        return int(np.argmin(d2))
+
+    def read_mount_steps(self):
+        """Elevation steps of the mount files of the night (empty when none are on disk)."""
+        files = pd.DataFrame({'night': self.name, 'mount_filename': self.mount_filename})
+        files = files[files['mount_filename'].astype(str).str.len() > 0]
+        return load_mount_steps(files)
+
+    def slew_times(self):
+        """
+        Commanded slew times (elevation, azimuth) [s].
+
+        The elevation slew time is saved in the mount files (test_slew_time), the
+        azimuth one is not saved: the run.py values are used when missing.
+        """
+        el_slew_time = RECORDED_EL_SLEW_TIME
+        steps = self.read_mount_steps()
+        if len(steps) and np.isfinite(steps['slew_time']).any():
+            el_slew_time = float(np.nanmedian(steps['slew_time']))
+        return el_slew_time, RECORDED_AZ_SLEW_TIME
+
+    def fit_mount_rates(self, el_slew_time=None, az_slew_time=None, slew_pause=SLEW_PAUSE):
+        """
+        Slew rates [deg/s] from the recorded pointings and the commanded slew times.
+
+        Elevation: consecutive alt_rank within an azimuth cycle.
+        Azimuth: first pointing of consecutive az_rank.
+        The slew times default to the ones of the night (`slew_times`).
+        """
+        night_el, night_az = self.slew_times()
+        el_slew_time = night_el if el_slew_time is None else el_slew_time
+        az_slew_time = night_az if az_slew_time is None else az_slew_time
+
+        step = ~self.flag & (self.alt_rank > 0)
+        idx = np.flatnonzero(step)
+        prev, nxt = idx[:-1], idx[1:]
+        ok = (self.alt_rank[nxt] == self.alt_rank[prev]+1) & (self.az_rank[nxt] == self.az_rank[prev])
+        dalt = np.abs(self.alt[nxt] - self.alt[prev])[ok]
+        dalt = dalt[dalt > 1.0]
+        el_rate = np.median(dalt)/(el_slew_time - slew_pause) if len(dalt) else EL_RATE
+
+        first = np.flatnonzero(step & (self.alt_rank == 1))
+        daz = np.abs(np.diff(self.az[first]))[np.diff(self.az_rank[first]) == 1] if len(first) > 1 else np.array([])
+        daz = daz[daz > 1.0]
+        az_rate = np.median(daz)/(az_slew_time - slew_pause) if len(daz) else AZ_RATE
+
+        # pointing repeatability of the same (az_rank, alt_rank) across maps,
+        # the nights without azimuth ranks do not tell the pointings apart
+        step &= self.az_rank > 0
+        pairs = np.unique(np.stack([self.az_rank[step], self.alt_rank[step]], axis=1), axis=0)
+        scatter = [np.std(self.alt[step & (self.az_rank == az) & (self.alt_rank == alt)]) for az, alt in pairs]
+        alt_jitter = np.nanmedian(scatter) if len(scatter) else 0.
+        return el_rate, az_rate, float(np.nan_to_num(alt_jitter))
+
+    def sweep_steps(self):
+        """(el_steps, az_steps) of the night: most frequent last alt_rank and largest az_rank."""
+        labels = classify_gaps(self.t, self.az, self.alt_rank, self.az_rank, self.flag)
+        last_rank = self.alt_rank[np.flatnonzero(labels == 'up') - 1]
+        if not len(last_rank) or not (self.az_rank > 0).any():
+            return None, None
+        return int(np.bincount(last_rank).argmax()), int(self.az_rank.max())
+
+    def gaps(self, el_steps=None, az_steps=None):
+        """Mean gap [s] per type of `classify_gaps` (nan when the night has none)."""
+        return gap_means(self.t, self.az, self.alt_rank, self.az_rank, self.flag, el_steps, az_steps)
+
+    def fit_timing(self, photodiode_delay=PHOTODIODE_DELAY):
+        """
+        Timing model of the recorded night for the replay devices.
+
+        1) Sweep parameters: el_steps and az_steps from the ranks, the slew times
+           from the mount files (`slew_times`) and the slew rates from the pointings.
+           The first elevation step (after the goto to 85 deg) is shorter than
+           the slew rate tells: the difference is the goto settle time
+        2) Slew latency (time a timed slew blocks past its slew time): from the
+           recorded slew durations of the mount files, otherwise from the
+           slewing-up exposure, whose duration the Scheduler computes from the
+           slew rate it measured with the latency
+        3) Exposure overhead: gap between elevation steps not spent slewing or integrating
+        4) Scale time and goto overhead: least squares on the gaps before the
+           slewing-up exposure, between azimuth cycles and between the sweeps,
+           simulated with the Scheduler (the simulated gaps are linear in both).
+           The goto rate is not constrained by these gaps (no night gives a
+           positive rate), the default one is kept
+        5) Map overhead: gap between two maps not simulated (restart of run.py)
+
+        The gaps are the ones of the complete maps. The nights without complete
+        maps (or without ranks) keep the default timing (DEFAULT_TIMING).
+
+        Returns:
+        dict: the DEFAULT_TIMING keys and the recorded mean gaps ('gaps')
+        """
+        timing = dict(DEFAULT_TIMING)
+        el_steps, az_steps = self.sweep_steps()
+        gaps = self.gaps(el_steps, az_steps) if el_steps else {k: np.nan for k in GAP_TYPES}
+        timing['gaps'] = gaps
+        if not np.isfinite(gaps['step']) or not np.isfinite(gaps['up']):
+            return timing
+
+        # 1) sweep parameters
+        timing['el_steps'], timing['az_steps'] = el_steps, az_steps
+        timing['el_slew_time'], timing['az_slew_time'] = self.slew_times()
+        timing['el_rate'], timing['az_rate'], timing['alt_jitter'] = self.fit_mount_rates(
+            timing['el_slew_time'], timing['az_slew_time'], timing['slew_pause'])
+        first = ~self.flag & (self.alt_rank == 1)
+        settle = (timing['el_slew_time']*EL_CORRECTIONS[0] - timing['slew_pause']
+                  - (85. - np.median(self.alt[first]))/timing['el_rate'])
+        timing['goto_settle'] = float(max(settle, 0.))
+        step = ~self.flag & (self.alt_rank > 0)
+        exp_time = self.exp_time_cmd[step]
+        timing['exp_time'] = float(np.nanmedian(exp_time)) if np.isfinite(exp_time).any() else DEFAULT_TIMING['exp_time']
+
+        # 2) slew latency
+        labels = classify_gaps(self.t, self.az, self.alt_rank, self.az_rank, self.flag, el_steps, az_steps)
+        slew_time, pause = timing['el_slew_time'], timing['slew_pause']
+        corrections = np.array([EL_CORRECTIONS[k] if k < len(EL_CORRECTIONS) else 1.0 for k in range(el_steps)])
+        steps = self.read_mount_steps()
+        if len(steps):
+            commanded = steps['slew_time'].to_numpy()*corrections[np.minimum(steps['step'].to_numpy(), el_steps) - 1]
+            latency = np.nanmedian(steps['slew_duration'].to_numpy() - commanded)
+        else:
+            up = np.flatnonzero(labels == 'up')
+            latency = np.nanmedian([self._up_latency(i, slew_time, pause, corrections, photodiode_delay) for i in up])
+        if np.isfinite(latency):
+            timing['slew_latency'] = float(max(latency, pause - slew_time*corrections.min()))
+
+        # 3) exposure overhead
+        into = np.flatnonzero(labels == 'step')
+        slews = slew_time*corrections[np.minimum(self.alt_rank[into], el_steps) - 1] + timing['slew_latency']
+        timing['overhead'] = float(max(np.mean(self.t[into] - self.t[into - 1] - slews) - timing['exp_time'], 0.))
+
+        # 4) scale time and goto overhead
+        fit = [k for k in ['up', 'cycle', 'turn'] if np.isfinite(gaps[k])]
+        sims = [simulate_gaps(self, {**timing, 'scale_time': scale, 'goto_overhead': goto})
+                for scale, goto in [(0., 0.), (1., 0.), (0., 1.)]]
+        slope = np.array([[sims[1][k] - sims[0][k], sims[2][k] - sims[0][k]] for k in fit])
+        residual = np.array([gaps[k] - sims[0][k] for k in fit])
+        solution = np.linalg.lstsq(slope, residual, rcond=None)[0]
+        for i in np.flatnonzero(solution < 0):
+            # a negative time: refit the other one with this one at zero
+            other = 1 - i
+            solution[i] = 0.
+            solution[other] = max(np.sum(slope[:, other]*residual)/np.sum(slope[:, other]**2), 0.)
+        timing['scale_time'], timing['goto_overhead'] = float(solution[0]), float(solution[1])
+
+        # 5) map overhead
+        if np.isfinite(gaps['map']):
+            sim = simulate_gaps(self, {**timing, 'map_overhead': 0.})
+            timing['map_overhead'] = float(max(gaps['map'] - sim['map'], 0.))
+        return timing
+
+
+    def _up_latency(self, i, slew_time, pause, corrections, photodiode_delay):
+        """
+        Slew latency from the slewing-up exposure `i`.
+
+        The Scheduler slews up for (85 - last alt)/rate - photodiode_delay, with
+        the median of the measured step rates alt step/(slew duration - pause).
+        The latency is the one that gives back the commanded exposure time.
+        """
+        j = i - 1
+        while j > 0 and self.alt_rank[j-1] == self.alt_rank[j] - 1 and self.az_rank[j-1] == self.az_rank[i]:
+            j -= 1
+        ranks = self.alt_rank[j:i]
+        if ranks[0] != 1 or len(ranks) < 2 or not np.isfinite(self.exp_time_cmd[i]):
+            return np.nan
+        dalt = -np.diff(np.concatenate([[85.], self.alt[j:i]]))
+        rate = (85. - self.alt[i-1])/(self.exp_time_cmd[i] + photodiode_delay)
+        commanded = slew_time*corrections[np.minimum(ranks, len(corrections)) - 1]
+
+        # the median rate decreases with the latency: bisection
+        low, high = pause - commanded.min() + 1e-3, 10.
+        if np.median(dalt/(commanded + low - pause)) < rate:
+            return np.nan
+        for _ in range(50):
+            mid = (low + high)/2.
+            if np.median(dalt/(commanded + mid - pause)) > rate:
+                low = mid
+            else:
+                high = mid
+        return (low + high)/2.
+
+
+def map_cycles(t, az, alt_rank, az_rank, flag, el_steps=None, az_steps=None):
+    """
+    Exposures split in azimuth cycles and maps (`assign_map_ids`), in time order.
+
+    With el_steps and az_steps, the `full` column tells the exposures of the
+    full azimuth cycles and the `complete` column the ones of the complete
+    maps: the full azimuth cycles (the el_steps elevation steps and the
+    slewing-up exposure) of the maps with at least 2*az_steps - 1 of them (the
+    first cycle of a run can carry the exposures of an interrupted one).
+
+    The forward sweep can go past -180 deg (Az +175 deg on 20240926) and the
+    backward sweep past 0 deg: Az is unwrapped and clipped at 0 deg so that
+    neither starts a new map.
+    """
+    az = np.asarray(az, dtype=float)
+    az = np.where(az > 90., az - 360., np.minimum(az, 0.))
+    df = assign_map_ids(pd.DataFrame({'date': np.asarray(t, dtype=float)*1e6, 'Az': az, 'az_rank': az_rank,
+                                      'flag': np.asarray(flag).astype(bool), 'alt_rank': alt_rank}))
+    df['full'] = df['complete'] = True
+    if el_steps is not None and len(df):
+        df['full'] = df.groupby('cycle_id')['date'].transform('size') == el_steps + 1
+        ncycles = df[df['full']].groupby('map_id')['cycle_id'].nunique()
+        df['complete'] = df['full'] & df['map_id'].isin(ncycles.index[ncycles >= 2*az_steps - 1])
+    return df
+
+
+def classify_gaps(t, az, alt_rank, az_rank, flag, el_steps=None, az_steps=None):
+    """
+    Type of the gap before each exposure ('' for the first one and the unknown ones).
+
+    step: elevation step to the next one (alt_rank k to k+1)
+    up: last elevation step to the slewing-up exposure
+    cycle: slewing-up exposure to the first step of the next azimuth cycle
+    turn: same, between the forward and the backward sweep (goto -180 deg)
+    map: same, between two maps (goto zero, or the next run of run.py)
+
+    The sweeps and maps are the ones of `assign_map_ids` (from Az, the ranks
+    of the backward sweep changed between nights). Gaps longer than MAX_GAP
+    are not classified, and with el_steps and az_steps neither are the gaps
+    out of the complete maps (out of the full cycles for the map gaps, see
+    `map_cycles`).
+    """
+    labels = np.full(len(t), '', dtype=object)
+    if len(t) < 2:
+        return labels
+    df = map_cycles(t, az, alt_rank, az_rank, flag, el_steps, az_steps)
+    cycle, sweep, maps = (df[k].to_numpy() for k in ['cycle_id', 'sweep_id', 'map_id'])
+    alt_rank, flag, full, complete = (df[k].to_numpy() for k in ['alt_rank', 'flag', 'full', 'complete'])
+
+    prev, nxt = np.arange(len(df) - 1), np.arange(1, len(df))
+    session = np.diff(df['date'].to_numpy())/1e6 <= MAX_GAP
+    ok = session & complete[prev] & complete[nxt]
+    same = cycle[nxt] == cycle[prev]
+    labels[nxt[ok & same & ~flag[prev] & ~flag[nxt] & (alt_rank[prev] > 0) &
+               (alt_rank[nxt] == alt_rank[prev] + 1)]] = 'step'
+    labels[nxt[ok & same & ~flag[prev] & flag[nxt]]] = 'up'
+    start = ok & ~same & flag[prev] & ~flag[nxt] & (alt_rank[nxt] == 1)
+    labels[nxt[start & (sweep[nxt] == sweep[prev])]] = 'cycle'
+    labels[nxt[start & (sweep[nxt] != sweep[prev]) & (maps[nxt] == maps[prev])]] = 'turn'
+    start = session & full[prev] & full[nxt] & ~same & flag[prev] & ~flag[nxt] & (alt_rank[nxt] == 1)
+    labels[nxt[start & (maps[nxt] != maps[prev])]] = 'map'
+    # back to the order of the arrays
+    out = np.full(len(t), '', dtype=object)
+    out[df.index.to_numpy()] = labels
+    return out
+
+
+def gap_means(t, az, alt_rank, az_rank, flag, el_steps=None, az_steps=None):
+    """
+    Mean gap [s] per type of `classify_gaps` (nan when there is none).
+
+    The mean, not the median: the duration of a map is the sum of its gaps.
+    """
+    labels = classify_gaps(t, az, alt_rank, az_rank, flag, el_steps, az_steps)
+    dt = np.concatenate([[np.nan], np.diff(np.asarray(t, dtype=float))])
+    return {k: float(np.mean(dt[labels == k])) if (labels == k).any() else np.nan for k in GAP_TYPES}
+
+
+def complete_maps(t, az, alt_rank, az_rank, flag, el_steps, az_steps):
+    """
+    Durations [min] of the complete maps (see `map_cycles`), from the first to
+    the last exposure of their full cycles.
+    """
+    if not len(t):
+        return []
+    df = map_cycles(t, az, alt_rank, az_rank, flag, el_steps, az_steps)
+    maps = df[df['complete']].groupby('map_id')['date'].agg(['min', 'max'])
+    return list((maps['max'] - maps['min'])/1e6/60.)
+
+
+class ReplayMount:
+    """
+    Mount model with the IoptronMount interface used by the Scheduler.
+
+    Timed slews move at constant rate after a `slew_pause` and block for
+    `slew_latency` past the slew time, free-running slews move until
+    `stop_updown`. A goto takes `goto_overhead` plus the distance at `goto_rate`,
+    and the first timed slew after it does not move for `goto_settle`.
+    All the waiting is done on the virtual clock.
+    """
+    def __init__(self, clock, el_rate=EL_RATE, az_rate=AZ_RATE, slew_pause=SLEW_PAUSE,
+                 alt_jitter=0., seed=0, slew_latency=0., goto_overhead=GOTO_OVERHEAD, goto_rate=GOTO_RATE,
+                 goto_settle=0.):
+        self.clock = clock
+        self.el_rate = el_rate
+        self.az_rate = az_rate
+        self.slew_pause = slew_pause
+        self.slew_latency = slew_latency
+        self.goto_overhead = goto_overhead
+        self.goto_rate = goto_rate
+        self.goto_settle = goto_settle
+        self.settling = False
+        self.alt_jitter = alt_jitter
+        self.rng = np.random.default_rng(seed)
+        self.arrow_speed = 9
+        self.alt = 90.
+        self.az = 0.
+        self.freerun = None
+        self.altitude_deg = self.alt
+        self.azimuth_deg = self.az
+        self.ncommands = 0
+
+    def _move(self, axis, sign, duration):
+        if axis == 'alt':
+            self.alt = float(np.clip(self.alt + sign*self.el_rate*duration, 0., 90.))
+        else:
+            self.az = float(np.clip(self.az + sign*self.az_rate*duration, -180., 180.))
+
+    def _slew(self, axis, sign, slew_time, is_freerun):
+        self.ncommands += 1
+        if is_freerun:
+            self.freerun = (axis, sign, self.clock.time())
+            return
+        self.clock.sleep(slew_time + self.slew_latency)
+        settle = self.goto_settle if self.settling else 0.
+        self.settling = False
+        self._move(axis, sign, max(slew_time - self.slew_pause - settle, 0.))
+        if axis == 'alt' and self.alt_jitter:
+            self.alt += self.rng.normal(0., self.alt_jitter)
+
+    def _freerun_position(self):
+        if self.freerun is None:
+            return self.alt, self.az
+        axis, sign, t0 = self.freerun
+        alt, az = self.alt, self.az
+        self._move(axis, sign, max(self.clock.time() - t0 - self.slew_pause, 0.))
+        position = self.alt, self.az
+        self.alt, self.az = alt, az
+        return position
+
+    def set_arrow_speed(self, speed):
+        self.ncommands += 1
+        self.arrow_speed = speed
+
+    def get_current_alt_az(self, verbose=False):
+        self.ncommands += 1
+        self.altitude_deg, self.azimuth_deg = self._freerun_position()
+        if verbose:
+            print(f"Alt: {self.altitude_deg:0.3f}, Az: {self.azimuth_deg:0.3f}")
+
+    def slew_up(self, slew_time=0, is_freerun=False):
+        self._slew('alt', +1, slew_time, is_freerun)
+
+    def slew_down(self, slew_time=0, is_freerun=False):
+        self._slew('alt', -1, slew_time, is_freerun)
+
+    def slew_left(self, slew_time=0, is_freerun=False):
+        self._slew('az', -1, slew_time, is_freerun)
+
+    def slew_right(self, slew_time=0, is_freerun=False):
+        self._slew('az', +1, slew_time, is_freerun)
+
+    def stop_updown(self):
+        self.ncommands += 1
+        self.alt, self.az = self._freerun_position()
+        self.freerun = None
+
+    def _goto(self, alt=None, az=None):
+        self.ncommands += 1
+        distance = max(abs((alt if alt is not None else self.alt) - self.alt),
+                       abs((az if az is not None else self.az) - self.az))
+        self.clock.sleep(self.goto_overhead + distance/self.goto_rate)
+        self.settling = True
+        if alt is not None:
+            self.alt = alt
+        if az is not None:
+            self.az = az
+
+    def goto_elevation(self, alt, tol=1.0, speed=8, niters=1):
+        self._goto(alt=alt)
+
+    def goto_azimuth(self, az, tol=1.0, speed=8, niters=1):
+        self._goto(az=az)
+
+    def goto_zero_position(self):
+        self._goto(alt=90., az=0.)
+
+
+class ReplayPhotodiode:
+    """
+    Electrometer model with the Keysight interface used by the Scheduler.
+
+    Each measurement waits the acquisition time on the virtual clock and returns
+    the recorded current of the nearest recorded exposure, with samples drawn
+    from the recorded mean and std. An auto scale takes `scale_time` (default:
+    the acquisition time of its samples).
+    """
+    def __init__(self, clock, night, mount, overhead=0.05, seed=0, scale_time=None):
+        self.clock = clock
+        self.night = night
+        self.mount = mount
+        self.overhead = overhead
+        self.scale_time = scale_time
+        self.rng = np.random.default_rng(seed)
+        self.params = {'rang': 2e-6, 'nplc': 5, 'nsamples': 10}
+        self.datavector = None
+        self.freq = 50
+
+    def write(self, command):
+        pass
+
+    def on(self):
+        pass
+
+    def set_mode(self, mode):
+        self.params['mode'] = mode
+
+    def set_nplc(self, nplc):
+        self.params['nplc'] = nplc
+
+    def set_nsamples(self, nsamples):
+        self.params['nsamples'] = nsamples
+
+    def set_rang(self, rang):
+        self.params['rang'] = rang
+
+    def set_acquisition_time(self, exposureTime):
+        self.params['nsamples'] = max(measure_nsamples(exposureTime, self.params['nplc'], self.freq), 1)
+
+    def get_params(self):
+        return self.params
+
+    def auto_scale(self, rang0=20e-6, verbose=False):
+        if self.scale_time is None:
+            self.clock.sleep(self.params['nsamples']*self.params['nplc']/self.freq)
+        else:
+            self.clock.sleep(self.scale_time)
+        self.params['rang'] = rang0
+
+    def start_measurement(self):
+        nsamples = self.params['nsamples']
+        duration = nsamples*self.params['nplc']/self.freq
+        t0 = self.clock.time()
+        self.clock.sleep(duration + self.overhead)
+
+        alt, az = self.mount._freerun_position()
+        i = self.night.nearest(t0, alt, az, flag=self.mount.freerun is not None)
+        samples = self.night.mean[i] + self.night.std[i]*self.rng.standard_normal(nsamples)
+
+        self.datavector = np.zeros(nsamples, dtype=[('time', '<f8'), ('CURR', '<f8')])
+        self.datavector['time'] = np.arange(nsamples)*duration/nsamples
+        self.datavector['CURR'] = samples
+        teff = self.night.exp_time[i] if not self.night.flag[i] and np.isfinite(self.night.exp_time[i]) else duration
+        return {'mean': float(np.mean(samples)), 'std': float(np.std(samples)), 'teff': float(teff)}
+
+
+class ReplayDatabase:
+    """
+    Database with the TwilightMonitorDatabase interface used by the Scheduler.
+
+    Writes the nightly file at `root/DATA/YYYYMM/YYYYMMDD.csv` in the same format,
+    and optionally the raw electrometer vectors and the mount files.
+    """
+    def __init__(self, path, save_vectors=True):
+        self.root = path
+        self.save_vectors = save_vectors
+        self.pending = []
+        self.seq_id = 0
+        self.nexposures = 0
+        self.date = None
+        self.exposures = []  # (t, az, alt_rank, az_rank, flag) of each exposure
+
+    def _filenames(self, date):
+        month = date[:6]
+        return (os.path.join(self.root, 'DATA', month, f'{date}.csv'),
+                os.path.join(self.root, 'DATA', 'keysighB2987A', month, f'{date}_{self.seq_id}.npy'),
+                os.path.join(self.root, 'DATA', 'mount', month, f'mount_pointing_{date}_{self.seq_id}'))
+
+    def add_exposure(self, timestamp, alt, az, exp_time_cmd, exp_time, filter_type,
+                     current_mean, current_std, alt_rank, az_rank, flag):
+        self.seq_id += 1
+        self.nexposures += 1
+        self.date = timestamp.strftime('%Y%m%d')
+        t = timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()
+        self.exposures.append((t, az, alt_rank, az_rank, flag is True))
+        _, efile, mfile = self._filenames(self.date)
+        self.pending.append([timestamp.strftime('%Y%m%d%H%M%S'), timestamp.isoformat(sep=' '), self.seq_id,
+                             exp_time_cmd, exp_time, filter_type, alt, az, current_mean, current_std,
+                             '', '', alt_rank, az_rank, efile, flag, mfile])
+
+    def save_electrometer_file(self, data):
+        if self.save_vectors and self.date is not None:
+            _, efile, _ = self._filenames(self.date)
+            os.makedirs(os.path.dirname(efile), exist_ok=True)
+            np.save(efile, data)
+
+    def save_mount_file(self, mountDict):
+        if self.save_vectors and self.date is not None:
+            _, _, mfile = self._filenames(self.date)
+            os.makedirs(os.path.dirname(mfile), exist_ok=True)
+            np.savez(mfile, **{k: np.asarray(v) for k, v in mountDict.items()})
+
+    def save(self):
+        if not self.pending:
+            return
+        fname, _, _ = self._filenames(self.date)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        new = not os.path.exists(fname)
+        with open(fname, 'a') as f:
+            if new:
+                f.write(','.join(COLUMNS) + '\n')
+            for row in self.pending:
+                f.write(','.join(str(v) for v in row) + '\n')
+        self.pending = []
+
+
+class NullDatabase(ReplayDatabase):
+    """Counts the exposures without writing files."""
+    def __init__(self):
+        super().__init__(path='', save_vectors=False)
+
+    def save(self):
+        self.pending = []
+
+
+class MemoryDatabase(NullDatabase):
+    """Keeps the exposures (rows of the nightly file) in memory."""
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+
+    def save(self):
+        self.rows += self.pending
+        self.pending = []
+
+
+def step_jitter(timing):
+    """
+    Altitude jitter [deg] added by the mount per elevation slew.
+
+    alt_jitter is the scatter of a pointing across maps (median over the alt
+    ranks), accumulated over the steps before it.
+    """
+    return timing['alt_jitter']/np.sqrt((int(timing['el_steps']) + 1)/2.)
+
+
+def make_devices(clock, recorded, timing, seed=0, jitter=True, mount_class=ReplayMount):
+    """
+    Replay mount and photodiode with the timing model (see `RecordedNight.fit_timing`),
+    with the pointing jitter or without it.
+    """
+    mount = mount_class(clock, el_rate=timing['el_rate'], az_rate=timing['az_rate'],
+                        slew_pause=timing['slew_pause'], alt_jitter=step_jitter(timing) if jitter else 0., seed=seed,
+                        slew_latency=timing['slew_latency'], goto_overhead=timing['goto_overhead'],
+                        goto_rate=timing['goto_rate'], goto_settle=timing['goto_settle'])
+    photodiode = ReplayPhotodiode(clock, recorded, mount, overhead=timing['overhead'], seed=seed,
+                                  scale_time=timing['scale_time'])
+    return mount, photodiode
+
+
+def make_scheduler(recorded, timing, mount, photodiode, database, clock, nplc=5, rang0=20e-6,
+                   photodiode_delay=PHOTODIODE_DELAY):
+    """Scheduler on the replay devices with the sweep parameters of the timing model."""
+    s = Scheduler(expTime=timing['exp_time'], nplc=nplc, rang0=rang0, filter=recorded.filter,
+                  mount=mount, photodiode=photodiode, database=database, clock=clock)
+    s.set_photodioe_params(expTime=timing['exp_time'], nplc=nplc, rang0=rang0)
+    s.set_azimuth_sweep_params(az_steps=int(timing['az_steps']), az_slew_time=timing['az_slew_time'])
+    s.set_elevation_sweep_params(el_steps=int(timing['el_steps']), el_slew_time=timing['el_slew_time'],
+                                 photodiode_delay=photodiode_delay)
+    return s
+
+
+def simulate_edges(recorded, timing):
+    """
+    Simulated time [s] from the start of a map to its first exposure, and from
+    its last exposure to the end of the map (goto zero).
+    """
+    clock = VirtualClock(recorded.start)
+    mount, photodiode = make_devices(clock, recorded, timing)
+    database = NullDatabase()
+    s = make_scheduler(recorded, timing, mount, photodiode, database, clock)
+    with contextlib.redirect_stdout(io.StringIO()):
+        s.map_alt_az()
+    return database.exposures[0][0] - recorded.start, clock.time() - database.exposures[-1][0]
+
+
+def simulate_gaps(recorded, timing, nmaps=2):
+    """Mean gap per type of `nmaps` maps simulated with the timing model."""
+    clock = VirtualClock(recorded.start)
+    mount, photodiode = make_devices(clock, recorded, timing)
+    database = NullDatabase()
+    s = make_scheduler(recorded, timing, mount, photodiode, database, clock)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(nmaps):
+            s.map_alt_az()
+            clock.sleep(timing['map_overhead'])
+    return gap_means(*np.array(database.exposures, dtype=float).T)
+
+
+def replay_night(night, output=None, speed=None, quiet=True, seed=0, save_vectors=False,
+                 nplc=5, rang0=20e-6, photodiode_delay=PHOTODIODE_DELAY, timing=None, continuous=False,
+                 **params):
+    """
+    Replays a recorded night through the Scheduler, run by run (or session by session).
+
+    The sweep parameters and the timing default to the ones fitted from the
+    recorded night (`RecordedNight.fit_timing`), any DEFAULT_TIMING key in
+    `params` overrides them (e.g. el_steps=6, az_slew_time=7.0, expTime=1).
+
+    Parameters:
+    night (str): date 'YYYYMMDD' or path to the nightly CSV file
+    output (str): database root of the replayed night (default: no files written)
+    speed (float): virtual/wall time factor, None runs as fast as possible
+    quiet (bool): hides the Scheduler output
+    timing (dict): timing model (default: fitted from the night)
+    continuous (bool): maps through the sessions instead of replaying the recorded runs
+
+    Returns:
+    dict: number of complete maps and exposures, mean complete map duration [min],
+        the same for the recorded night, and the achieved speedup
+    """
+    recorded = RecordedNight(night)
+    if not len(recorded):
+        raise ValueError(f"{night}: no valid exposures to replay")
+    fitted = recorded.fit_timing(photodiode_delay) if timing is None else timing
+    if 'expTime' in params:
+        params['exp_time'] = params.pop('expTime')
+    unknown = set(params) - set(DEFAULT_TIMING)
+    if unknown:
+        raise ValueError(f"unknown replay parameters: {sorted(unknown)}")
+    timing = {**fitted, **params}
+
+    # a run starts before its first exposure and ends after the goto zero
+    lead, tail = simulate_edges(recorded, timing)
+
+    database = ReplayDatabase(output, save_vectors=save_vectors) if output else NullDatabase()
+    stdout = io.StringIO() if quiet else None
+    speedups = []
+    with contextlib.redirect_stdout(stdout) if quiet else contextlib.nullcontext():
+        spans = recorded.sessions() if continuous else recorded.runs()
+        for i, (start, end) in enumerate(spans):
+            clock = VirtualClock(start - lead, end + tail, speed=speed)
+            mount, photodiode = make_devices(clock, recorded, timing, seed=seed + i)
+            s = make_scheduler(recorded, timing, mount, photodiode, database, clock, nplc=nplc, rang0=rang0,
+                               photodiode_delay=photodiode_delay)
+            try:
+                while True:
+                    s.map_alt_az()
+                    clock.sleep(timing['map_overhead'])
+            except ReplayFinished:
+                pass
+            finally:
+                database.save()
+            speedups.append(clock.speedup())
+
+    sweep = (int(timing['el_steps']), int(timing['az_steps']))
+    durations = complete_maps(*np.array(database.exposures, dtype=float).reshape(-1, 5).T, *sweep)
+    recorded_durations = complete_maps(recorded.t, recorded.az, recorded.alt_rank, recorded.az_rank,
+                                       recorded.flag, int(fitted['el_steps']), int(fitted['az_steps']))
+    return {'night': night,
+            'nmaps': len(durations),
+            'nexposures': database.nexposures,
+            'map_duration': float(np.mean(durations)) if durations else np.nan,
+            'recorded_nmaps': len(recorded_durations),
+            'recorded_nexposures': len(recorded),
+            'recorded_map_duration': float(np.mean(recorded_durations)) if recorded_durations else np.nan,
+            'timing': timing,
+            'speedup': float(np.median(speedups)) if speedups else np.nan}
+
+
+def compare_runs(night, variants, **kwargs):
+    """
+    Replays a night once per variant of the sweep parameters, mapping
+    through the sessions (`continuous`): how many maps each variant gives.
+
+    Parameters:
+    variants (dict): name -> dict of `replay_night` keyword arguments
+
+    Returns:
+    dict: name -> replay summary
+    """
+    # the timing model of the night is fitted once, the night is mapped continuously
+    kwargs.setdefault('timing', RecordedNight(night).fit_timing())
+    kwargs.setdefault('continuous', True)
+    results = {}
+    for name, params in variants.items():
+        results[name] = replay_night(night, **{**kwargs, **params})
+        r = results[name]
+        print(f"{name:>20s}: {r['nmaps']} maps, {r['nexposures']} exposures, {r['map_duration']:0.2f} min/map")
+    return results
+
+
+def parse_variants(text):
+    """'el_steps=5,6' -> {'el_steps=5': {'el_steps': 5}, 'el_steps=6': {'el_steps': 6}}"""
+    key, _, values = text.partition('=')
+    variants = {}
+    for value in values.split(','):
+        variants[f'{key}={value}'] = {key: float(value) if '.' in value else int(value)}
+    return variants
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded night through the Scheduler")
+    parser.add_argument('night', help="night (YYYYMMDD) or nightly CSV path")
+    parser.add_argument('--output', default=None, help="database root of the replayed night")
+    parser.add_argument('--speed', type=float, default=None, help="virtual/wall time factor (default: as fast as possible)")
+    parser.add_argument('--verbose', action='store_true', help="show the Scheduler output")
+    parser.add_argument('--vectors', action='store_true', help="also write the raw electrometer vectors and mount files")
+    parser.add_argument('--compare', default=None, help="compare a sweep parameter, e.g. el_steps=5,6")
+    parser.add_argument('--continuous', action='store_true', help="map through the sessions instead of the recorded runs")
+    parser.add_argument('--timing', action='store_true', help="print the timing model fitted from the night")
+    args = parser.parse_args()
+
+    if args.timing:
+        recorded = RecordedNight(args.night)
+        timing = recorded.fit_timing()
+        gaps, sim = timing.pop('gaps'), simulate_gaps(recorded, timing)
+        for key, value in timing.items():
+            print(f"{key:>15s}: {value:0.3f}")
+        for key in GAP_TYPES:
+            print(f"{key+' gap':>15s}: {gaps[key]:0.2f} s recorded, {sim[key]:0.2f} s simulated")
+    elif args.compare:
+        compare_runs(args.night, parse_variants(args.compare), speed=args.speed)
+    else:
+        t0 = datetime.datetime.now()
+        res = replay_night(args.night, output=args.output, speed=args.speed,
+                           quiet=not args.verbose, save_vectors=args.vectors, continuous=args.continuous)
+        print(f"Replayed {res['night']}: {res['nmaps']} maps, {res['nexposures']} exposures, "
+              f"{res['map_duration']:0.2f} min/map ({res['recorded_nmaps']} maps, {res['recorded_nexposures']} "
+              f"exposures, {res['recorded_map_duration']:0.2f} min/map recorded), "
+              f"{res['speedup']:0.0f}x speed in {datetime.datetime.now()-t0}")
@@ -55,6 +55,8 @@ s = Scheduler(filter='SDSSg')
 s.set_photodioe_params(expTime=1, nplc=5, rang0=20e-6)
 s.set_azimuth_sweep_params(az_steps=7, az_slew_time=7.3)
 s.set_elevation_sweep_params(el_steps=5, el_slew_time=2.456)
+# or load the parameters found by the optimizer (python optimizer.py)
+# s.load_sweep_params('sweep_params.json')
 
 # Starting the mapping
 s.map_alt_az()
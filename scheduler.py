@@ -1,42 +1,136 @@
-from photodiode import Keysight
-from skyhunter import IoptronMount
-from twmdb import TwilightMonitorDatabase
-
 from config import port, USBSerial, databaseRoot
 
 import datetime
+import json
 import numpy as np
 import time
 
+# slew time corrections of the elevation steps (the first steps start from rest)
+EL_CORRECTIONS = [1.22815561, 0.98431782, 1.0, 1.0, 1.0, 1.0]
+# delay in the mount response subtracted from the slew up while taking data
+PHOTODIODE_DELAY = 2.0 # seconds
+# deg, map_pointings auto scales the photodiode again past this distance (about one azimuth cycle)
+RESCALE_DISTANCE = 20.0
+
+# valid range of the sweep parameters (see load_sweep_params and optimizer.py)
+SWEEP_PARAM_LIMITS = {
+    'az_steps': (1, 36),
+    'az_slew_time': (0.1, 60.0),
+    'el_steps': (1, 20),
+    'el_slew_time': (0.1, 20.0),
+    'photodiode_delay': (0.0, 10.0),
+}
+
 class Scheduler:
-    def __init__(self, expTime=1, nplc=5, rang0=20e-6, filter='Empty'):
-        self.mount = IoptronMount(port)
-        self.database = TwilightMonitorDatabase(path=databaseRoot)
-        try:
-            self.photodiode = Keysight(USBSerial)
-            self.is_photodiode_on = True
-        except:
-            print("Keysight not connected.")
-            self.is_photodiode_on = False
-            # exit()
+    def __init__(self, expTime=1, nplc=5, rang0=20e-6, filter='Empty',
+                 mount=None, photodiode=None, database=None, clock=None):
+        # the devices and the clock can be replaced (e.g. by the replay engine, see replay.py)
+        # the hardware devices are connected on first use (see the properties below)
+        self.clock = time if clock is None else clock
+        self._mount = mount
+        self._database = database
+        self._photodiode = photodiode
+        self._is_photodiode_on = True if photodiode is not None else None
 
         self.filter = filter
         self.set_photodioe_params(expTime=expTime, nplc=nplc, rang0=rang0)
 
         # # self.photodiode.find_instrument()
+
+    @property
+    def mount(self):
+        if self._mount is None:
+            from skyhunter import IoptronMount
+            from mount_controller import MountController
+            self._mount = MountController(IoptronMount(port))
+        return self._mount
+
+    @mount.setter
+    def mount(self, mount):
+        self._mount = mount
+
+    @property
+    def database(self):
+        if self._database is None:
+            from twmdb import TwilightMonitorDatabase
+            self._database = TwilightMonitorDatabase(path=databaseRoot)
+        return self._database
+
+    @database.setter
+    def database(self, database):
+        self._database = database
+
+    @property
+    def photodiode(self):
+        if self._is_photodiode_on is None:
+            self.connect_photodiode()
+        return self._photodiode
+
+    @photodiode.setter
+    def photodiode(self, photodiode):
+        self._photodiode = photodiode
+        self._is_photodiode_on = photodiode is not None
+
+    @property
+    def is_photodiode_on(self):
+        if self._is_photodiode_on is None:
+            self.connect_photodiode()
+        return self._is_photodiode_on
+
+    def connect_photodiode(self):
+        try:
+            from photodiode import Keysight
+            self._photodiode = Keysight(USBSerial)
+            self._is_photodiode_on = True
+        except:
+            print("Keysight not connected.")
+            self._photodiode = None
+            self._is_photodiode_on = False
+            # exit()
     def set_photodioe_params(self, expTime=1, nplc=5, rang0=20e-6):
         self.expTime = expTime
         self.nplc = nplc
         self.nsamples = measure_nsamples(expTime, nplc, freq=50)
         self.rang0 = rang0
 
-    def set_elevation_sweep_params(self, el_steps=6, el_slew_time=1):
+    def set_elevation_sweep_params(self, el_steps=6, el_slew_time=1, photodiode_delay=PHOTODIODE_DELAY,
+                                   el_corrections=None):
         self.el_steps = el_steps
         self.el_slew_time = el_slew_time
+        self.photodiode_delay = photodiode_delay
+        self.el_corrections = EL_CORRECTIONS if el_corrections is None else list(el_corrections)
     
-    def set_azimuth_sweep_params(self, az_steps=6, az_slew_time=1):
+    def set_azimuth_sweep_params(self, az_steps=6, az_slew_time=1, az_start=0.0, az_end=-179.0, az_rank0=0):
+        # az_start, az_end and az_rank0 select an azimuth sector (see fleet.plan_fleet)
         self.az_steps = az_steps
         self.az_slew_time = az_slew_time
+        self.az_start = az_start
+        self.az_end = az_end
+        self.az_rank0 = az_rank0
+
+    def load_sweep_params(self, fname):
+        """
+        Loads the sweep parameters from a JSON file (e.g. written by optimizer.py)
+
+        The file has a `params` dictionary with the arguments of
+        `set_azimuth_sweep_params` and `set_elevation_sweep_params`. The
+        azimuth parameters of the file are the ones of the whole range: when
+        an azimuth sector is already set (az_start, az_end, az_rank0 of
+        fleet.plan_fleet) the sector and its az_steps and az_slew_time are kept.
+        """
+        params = read_sweep_params(fname)
+        keys = ('az_steps', 'az_slew_time', 'az_start', 'az_end', 'az_rank0')
+        current = {key: getattr(self, key) for key in keys if hasattr(self, key)}
+        if (current.get('az_start', 0.0), current.get('az_end', -179.0), current.get('az_rank0', 0)) != (0.0, -179.0, 0):
+            self.set_azimuth_sweep_params(**current)
+            print(f"Azimuth sector kept: {current['az_steps']} steps from {current['az_start']:0.1f} deg")
+        else:
+            self.set_azimuth_sweep_params(az_steps=params['az_steps'], az_slew_time=params['az_slew_time'])
+        self.set_elevation_sweep_params(el_steps=params['el_steps'], el_slew_time=params['el_slew_time'],
+                                        photodiode_delay=params['photodiode_delay'],
+                                        el_corrections=params.get('el_corrections'))
+        print(f"Sweep parameters loaded from {fname}")
+        return params
 
     def reset_photodiode(self):
         if self.is_photodiode_on:
@@ -94,7 +188,7 @@ class Scheduler:
         print(f"Exposure Time: {exposureTime:0.2f} seconds")
 
         # Add exposure to the database
-        timestamp = datetime.datetime.utcnow()
+        timestamp = datetime.datetime.utcfromtimestamp(self.clock.time())
         self.database.add_exposure(
             timestamp=timestamp,
             alt=np.round(alt_current,5),
@@ -111,6 +205,7 @@ class Scheduler:
         self.database.save_electrometer_file(self.photodiode.datavector)
         self.database.save()
         print(f"Exposure added to the database at {timestamp}.")
+        return keysight_data
 
     def acquire_while_slewing_elevation(self, exposureTime, direction='up', az_rank=0):
         # start slewing
@@ -125,7 +220,7 @@ class Scheduler:
 
         else:
             print("Photodiode not connected.")
-            time.sleep(exposureTime)
+            self.clock.sleep(exposureTime)
 
         # stop slewing
         self.mount.stop_updown()
@@ -136,9 +231,10 @@ class Scheduler:
         pass
 
     def sweep_elevation(self, slewTime, nsteps=6, direction='down', flag='false', az_rank=0):        
-        test_start_time = time.time()
+        test_start_time = self.clock.time()
 
-        self.mount.set_arrow_speed(9)
+        arrow_speed = 9
+        self.mount.set_arrow_speed(arrow_speed)
         self.mount.get_current_alt_az()
         posInitial = {'alt':self.mount.altitude_deg, 'az':self.mount.azimuth_deg}
 
@@ -148,29 +244,30 @@ class Scheduler:
         durations = []
         positions = [self.mount.altitude_deg]
 
-        corrections = [1.22815561, 0.98431782, 1.0, 1.0, 1.0, 1.0]
+        corrections = getattr(self, 'el_corrections', EL_CORRECTIONS)
         # corrections = [1.0]*nsteps
         for i in range(nsteps):
             print(6*"---------")
             print(f"Step {i+1}/{nsteps}")
-            start_time = time.time()
+            start_time = self.clock.time()
 
             # start slew
-            getattr(self.mount, f'slew_{direction}')(slewTime*corrections[i])
-            slew_duration = time.time() - start_time
+            correction = corrections[i] if i < len(corrections) else 1.0
+            getattr(self.mount, f'slew_{direction}')(slewTime*correction)
+            slew_duration = self.clock.time() - start_time
 
             # take data
             if self.is_photodiode_on:
                 self.acquire(flag=flag, alt_rank=i+1, az_rank=az_rank)
             else:
-                time.sleep(self.expTime)
+                self.clock.sleep(self.expTime)
 
             self.mount.get_current_alt_az()
 
             if i>=nsteps-1:
                 self.auto_scale_photodiode()
             
-            duration = time.time() - start_time
+            duration = self.clock.time() - start_time
             # print("Alt, Az: ", self.mount.altitude_deg, self.mount.azimuth_deg)
             print(f"Slew + Data Duration: {duration:0.2f} seconds")
             print(6*"---------")
@@ -178,7 +275,7 @@ class Scheduler:
             durations.append(slew_duration)
             positions.append(self.mount.altitude_deg)
 
-        test_end_time = time.time()-test_start_time
+        test_end_time = self.clock.time()-test_start_time
 
         # Store Mount Information
         self.add_mount_info('AZ', self.mount.azimuth_deg)
@@ -188,6 +285,7 @@ class Scheduler:
         self.add_mount_info('slew_rate', np.diff(np.array(positions))/(np.array(durations)-self.mount.slew_pause))
         self.add_mount_info('test_duration', test_end_time)
         self.add_mount_info('test_slew_time', slewTime)
+        self.add_mount_info('arrow_speed', arrow_speed)
         self.add_mount_info('direction', direction)
         self.database.save_mount_file(self.mountDict)
         print(f"Swep completed in {test_end_time:0.02f} seconds")
@@ -217,7 +315,7 @@ class Scheduler:
         print("Slewing back up while taking data")
         duration_up = (85.0-self.mountDict['slew_angle'][-1])/np.median(np.abs(self.mountDict['slew_rate']))
         if self.is_photodiode_on: # there is a delay in the mount response that we subtract
-            duration_up-= 2.0 # seconds
+            duration_up-= self.photodiode_delay # seconds
         self.acquire_while_slewing_elevation(duration_up, 'up', az_rank=az_rank)
 
         print("Sweep Elevation Down and Come Back Completed")
@@ -238,7 +336,7 @@ class Scheduler:
         """
         header("Mapping the Altitude and Azimuth")
         # start the timer
-        t0 = time.time()
+        t0 = self.clock.time()
 
         header("Preparing the Mount and Photodiode")
         self.prepare_map_alt_az()
@@ -246,24 +344,88 @@ class Scheduler:
         # Forward Azimuth Sweep
         header("Starting Forward Azimuth Sweep")
         self.forward_az_alt_swep()
-        tforward = (time.time()-t0)/60.
+        tforward = (self.clock.time()-t0)/60.
         print(f"Azimuth Forward Sweep Completed in {tforward:0.2f} minutes")
 
         # Backward Azimuth Sweep
         header("Starting Backward Azimuth Sweep")
-        tbacward_initial = time.time()
+        tbacward_initial = self.clock.time()
         self.backward_az_alt_swep()
 
-        tbackward = (time.time()-tbacward_initial)/60.
+        tbackward = (self.clock.time()-tbacward_initial)/60.
         print(f"Azimuth Backward Sweep Completed in {tbackward:0.2f} minutes")
         
         # Report duration of the mapping
-        ttotal = (time.time()-t0)/60.
+        ttotal = (self.clock.time()-t0)/60.
         header("Printing Timing Information")
         print(f"Az Forward Sweep Duration: {tforward:0.2f} minute")
         print(f"Az Backward Sweep Duration: {tbackward:0.2f} minute")
         print(f"Total Script Time: {ttotal:0.2f} minute")
         print(6*"---------")
+        if hasattr(self.mount, 'report'):
+            header("Mount Command Latency [s]")
+            self.mount.report()
+
+    def map_pointings(self, plan, estimator=None, flag='priority'):
+        """
+        Map a List of Pointings (see priority.py)
+
+        1) Prepare the mount and photodiode
+        2) Go to each pointing of the plan (azimuth, then elevation)
+        3) Auto scale the photodiode when the pointing is more than
+           RESCALE_DISTANCE away from the last scaled one (the plan jumps
+           between bright and dark regions)
+        4) Take data, with the flag label of the plan
+        5) Update the rate estimator with the exposure (optional)
+        6) Save the timestamp of each pointing in the mount file
+
+        Returns a list with the pointing, start and end time of each visit
+        """
+        header(f"Mapping {len(plan)} Pointings")
+        t0 = self.clock.time()
+        self.mountDict = {}
+        self.mount.set_arrow_speed(9)
+        self.reset_photodiode()
+
+        visits = []
+        az_current = None
+        scaled = None
+        for i, pointing in enumerate(plan):
+            print(f"Pointing {i+1}/{len(plan)}: Alt {pointing['alt']:0.1f}, Az {pointing['az']:0.1f} "
+                  f"(visit {pointing.get('visit', 1)})")
+            if az_current is None or abs(pointing['az'] - az_current) > 0.5:
+                self.mount.goto_azimuth(pointing['az'], tol=1.0, speed=8, niters=3)
+                az_current = pointing['az']
+            self.mount.goto_elevation(pointing['alt'], tol=1.0, speed=8, niters=1)
+
+            if scaled is None or max(abs(pointing['alt'] - scaled[0]), abs(pointing['az'] - scaled[1])) > RESCALE_DISTANCE:
+                self.auto_scale_photodiode()
+                scaled = (pointing['alt'], pointing['az'])
+
+            start_time = self.clock.time()
+            if self.is_photodiode_on:
+                data = self.acquire(flag=flag, alt_rank=pointing['alt_rank'], az_rank=pointing['az_rank'])
+            else:
+                self.clock.sleep(self.expTime)
+                data = None
+            end_time = self.clock.time()
+
+            if estimator is not None and data is not None:
+                estimator.update(pointing, 0.5*(start_time + end_time), data['mean'])
+            visits.append(dict(pointing, t_start=start_time, t_end=end_time))
+
+        # Store the timestamps of the pointings
+        self.add_mount_info('pointing_alt', [v['alt'] for v in visits])
+        self.add_mount_info('pointing_az', [v['az'] for v in visits])
+        self.add_mount_info('pointing_t_start', [v['t_start'] for v in visits])
+        self.add_mount_info('pointing_t_end', [v['t_end'] for v in visits])
+        self.database.save_mount_file(self.mountDict)
+
+        ttotal = (self.clock.time()-t0)/60.
+        header("Printing Timing Information")
+        print(f"Total Script Time: {ttotal:0.2f} minute")
+        print(6*"---------")
+        return visits
 
     def forward_az_alt_swep(self):
         """
@@ -277,11 +439,11 @@ class Scheduler:
         """
         # going forward in azimuth
         for i in range(self.az_steps):
-            t0 = time.time()
+            t0 = self.clock.time()
             # print the az cycle header
             header(f"Starting Az Forward Cycle {i+1}/{self.az_steps}")
 
-            self.sweep_elevation_down_and_come_back(i+1)
+            self.sweep_elevation_down_and_come_back(self.az_rank0+i+1)
 
             # going forward in azimuth
             if i!=self.az_steps-1:
@@ -289,7 +451,7 @@ class Scheduler:
             else:
                 print("Azimuth Forward Sweep Completed")
                 break
-            tfinal = time.time()-t0
+            tfinal = self.clock.time()-t0
             
             print(f"Azimuth Forward Cycle {i+1} completed within {tfinal:0.2f} seconds")
             print(6*"---------")
@@ -308,14 +470,14 @@ class Scheduler:
             print("Error: set the azimuth parameters first")
             return
         
-        # Make sure the azimuth position is -180 deg
-        print("Returning to -180 degree position")
-        self.mount.goto_azimuth(-179.0, tol=1.0, speed=8, niters=3)
+        # Make sure the azimuth position is -180 deg (or the end of the sector)
+        print(f"Returning to {self.az_end:0.0f} degree position")
+        self.mount.goto_azimuth(self.az_end, tol=1.0, speed=8, niters=3)
 
         # going forward in bacward
         header("Starting Backward Azimuth Sweep")
         for i in range(self.az_steps):
-            t0 = time.time()
+            t0 = self.clock.time()
 
             header(f"Starting Az Backward Cycle {i+1}/{self.az_steps}")
 
@@ -326,7 +488,7 @@ class Scheduler:
             # 1) stop at alt=85.0
             # 2) do a series of pointing in elevation for a fixed slew time
             # 3) come back to the top while taking data
-            self.sweep_elevation_down_and_come_back(i+1)
+            self.sweep_elevation_down_and_come_back(self.az_rank0+i+1)
 
             # going backward in azimuth
             if i==self.az_steps-1:
@@ -337,7 +499,7 @@ class Scheduler:
             else:
                 self.going_backward_az(self.az_slew_time)
 
-            tfinal = (time.time()-t0)/60.
+            tfinal = (self.clock.time()-t0)/60.
             
             print(f"Azimuth Backward Cycle {i+1} completed within {tfinal:0.2f} seconds")
             print(6*"---------")
@@ -366,12 +528,15 @@ class Scheduler:
         2) Reset the photodiode
         3) Go to the zero position
         4) Slew down to 1.25 degrees
+        5) Go to the start of the azimuth sector (if not zero)
 
         """
         self.mount.set_arrow_speed(9)
         self.reset_photodiode()
         self.mount.goto_zero_position()
         self.mount.slew_down(1.25)
+        if self.az_start != 0.0:
+            self.mount.goto_azimuth(self.az_start, tol=1.0, speed=8, niters=3)
         pass
 
     def add_mount_info(self, col, data):
@@ -382,6 +547,33 @@ class Scheduler:
 def measure_nsamples(expTime, nplc, freq=50):
     return int(expTime*freq/nplc)
 
+def validate_sweep_params(params):
+    """Checks the sweep parameters, raises ValueError if one is missing or out of range."""
+    for key, (vmin, vmax) in SWEEP_PARAM_LIMITS.items():
+        if key not in params:
+            raise ValueError(f"missing sweep parameter: {key}")
+        value = params[key]
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not np.isfinite(value):
+            raise ValueError(f"sweep parameter {key} is not a number: {value!r}")
+        if key.endswith('_steps') and int(value) != value:
+            raise ValueError(f"sweep parameter {key} is not an integer: {value!r}")
+        if not vmin <= value <= vmax:
+            raise ValueError(f"sweep parameter {key}={value} out of range [{vmin}, {vmax}]")
+
+    corrections = params.get('el_corrections')
+    if corrections is not None:
+        if not isinstance(corrections, list) or not all(isinstance(c, (int, float)) and not isinstance(c, bool) and 0.5 <= c <= 2.0 for c in corrections):
+            raise ValueError(f"el_corrections must be a list of factors in [0.5, 2.0]: {corrections!r}")
+    return params
+
+def read_sweep_params(fname):
+    with open(fname) as f:
+        params = json.load(f).get('params', {})
+    params = validate_sweep_params(params)
+    params['az_steps'] = int(params['az_steps'])
+    params['el_steps'] = int(params['el_steps'])
+    return params
+
 def header(text):
     print("")
     print("\t"+text)
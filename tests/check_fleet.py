@@ -0,0 +1,184 @@
+"""
+
+This script is used to check the fleet stream on the local machine.
+An aggregator listens on a free port and two publishers stream the rows of
+two units (ranks 1-4 and 5-7) on a virtual clock:
+- the merged nightly file must have every row, in time order
+- with a small `max_buffer`, a unit holding the watermark back must not
+  let the aggregator buffer grow past it, and the rows are still written
+- on an advancing clock, the heartbeats sent between the timestamp of an
+  exposure and its publication must not let the other unit rows pass it
+The script exits with an error if a check fails.
+
+"""
+import os
+import sys
+import tempfile
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import fleet
+from fleet import HEARTBEAT_INTERVAL, Aggregator, Publisher, plan_fleet
+
+START = 1727910000.  # 2024-10-02 23:00 UTC
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def make_row(unit_id, seq_id, t, az_rank, alt_rank):
+    stamp = time.gmtime(t)
+    return {'unit_id': unit_id, 't': t, 'tmid': time.strftime('%Y%m%d%H%M%S', stamp),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S', stamp) + f'{t % 1:.6f}'[1:],
+            'seq_id': seq_id, 'exp_time_cmd': 1, 'exp_time': 1.0, 'filter': 'SDSSg',
+            'Alt': 75.7, 'Az': 0.0, 'current_mean': -1e-8, 'current_std': 1e-10,
+            'alt_rank': alt_rank, 'az_rank': az_rank, 'flag': 'False'}
+
+
+def read_rows(output):
+    fname = os.path.join(output, 'DATA', 'fleet', '202410', '20241002.csv')
+    with open(fname) as f:
+        header = f.readline().strip().split(',')
+        return [dict(zip(header, line.strip().split(','))) for line in f]
+
+
+def wait_written(aggregator, n, timeout=20.):
+    t0 = time.time()
+    while aggregator.nwritten + aggregator.nbuffered < n and time.time() - t0 < timeout:
+        time.sleep(0.05)
+
+
+def wait_registered(aggregator, units, timeout=20.):
+    t0 = time.time()
+    while not set(units) <= set(aggregator.watermarks) and time.time() - t0 < timeout:
+        time.sleep(0.05)
+
+
+def check_merge(output):
+    """Two units mapping their sectors at the same time, unit2 starts later."""
+    plans = plan_fleet(['unit1', 'unit2'], az_steps=7)
+    aggregator = Aggregator(output, port=0)
+    aggregator.start()
+    publishers = {u: Publisher(u, port=aggregator.address[1]) for u in plans}
+    wait_registered(aggregator, plans)
+
+    # exposures of each unit: (t, unit_id, seq_id, az_rank, alt_rank)
+    exposures = []
+    for unit_id, plan in plans.items():
+        t = START + (3. if unit_id == 'unit2' else 0.)
+        seq_id = 0
+        for az_rank in range(plan['az_rank0'] + 1, plan['az_rank0'] + plan['az_steps'] + 1):
+            for alt_rank in range(1, 6):
+                seq_id += 1
+                t += 3.7
+                exposures.append((t, unit_id, seq_id, az_rank, alt_rank))
+    # the units publish at the same time, with different delays
+    for t, unit_id, seq_id, az_rank, alt_rank in sorted(exposures):
+        publishers[unit_id].publish(make_row(unit_id, seq_id, t, az_rank, alt_rank))
+        if unit_id == 'unit2':
+            time.sleep(0.01)
+    nrows = len(exposures)
+    # wait before closing: the rows must be merged by the watermark, not by the final flush
+    wait_written(aggregator, nrows)
+    for publisher in publishers.values():
+        publisher.close()
+    aggregator.close()
+
+    rows = read_rows(output)
+    dates = [row['date'] for row in rows]
+    ranks = {u: sorted({int(row['az_rank']) for row in rows if row['unit_id'] == u}) for u in plans}
+    print(f"merge: {len(rows)} rows of {nrows}, ranks {ranks}")
+    failed = []
+    if len(rows) != nrows:
+        failed.append("rows missing in the merged file")
+    if dates != sorted(dates):
+        failed.append("merged file is not time ordered")
+    if ranks != {'unit1': [1, 2, 3, 4], 'unit2': [5, 6, 7]}:
+        failed.append("unexpected az_rank per unit")
+    return failed
+
+
+def check_backpressure(output, max_buffer=10, nrows=30):
+    """unit2 sends one row and stays silent, so the watermark holds unit1 back."""
+    aggregator = Aggregator(output, port=0, max_buffer=max_buffer)
+    aggregator.start()
+    slow = Publisher('unit2', port=aggregator.address[1])
+    fast = Publisher('unit1', port=aggregator.address[1])
+    wait_registered(aggregator, ['unit1', 'unit2'])
+    slow.publish(make_row('unit2', 1, START, 5, 1))
+    wait_written(aggregator, 1)
+    for i in range(nrows):
+        fast.publish(make_row('unit1', i + 1, START + 3.7*(i + 1), 1, i % 5 + 1))
+
+    largest = 0
+    t0 = time.time()
+    while aggregator.nwritten < nrows + 1 and time.time() - t0 < 30.:
+        largest = max(largest, aggregator.nbuffered)
+        time.sleep(0.01)
+    fast.close()
+    slow.close()
+    aggregator.close()
+
+    print(f"backpressure: largest buffer {largest} (max_buffer {max_buffer}), "
+          f"{aggregator.nwritten} rows written, {fast.ndropped} dropped")
+    failed = []
+    if largest > max_buffer:
+        failed.append("aggregator buffer grew past max_buffer")
+    if aggregator.nwritten != nrows + 1 or fast.ndropped:
+        failed.append("rows lost under backpressure")
+    return failed
+
+
+def check_heartbeat(output):
+    """unit1 timestamps an exposure, the clock advances and heartbeats go out before the row is published."""
+    fleet.HEARTBEAT_INTERVAL = 0.05
+    clock = Clock(START)
+    aggregator = Aggregator(output, port=0)
+    aggregator.start()
+    unit1 = Publisher('unit1', port=aggregator.address[1])
+    unit2 = Publisher('unit2', port=aggregator.address[1])
+    wait_registered(aggregator, ['unit1', 'unit2'])
+
+    unit1.publish(make_row('unit1', 1, clock.time(), 1, 1))
+    clock.now += 3.7
+    stamp = clock.time()  # acquire: timestamp of the next unit1 exposure
+    for i in range(5):
+        # unit2 keeps mapping while unit1 adds its exposure to the local database
+        clock.now += 1.
+        unit2.publish(make_row('unit2', i + 1, clock.time(), 5, i + 1))
+        time.sleep(0.1)
+    unit1.publish(make_row('unit1', 2, stamp, 1, 2))
+    wait_written(aggregator, 7)
+    unit1.close()
+    unit2.close()
+    aggregator.close()
+    fleet.HEARTBEAT_INTERVAL = HEARTBEAT_INTERVAL
+
+    rows = read_rows(output)
+    dates = [row['date'] for row in rows]
+    print(f"heartbeat: {len(rows)} rows of 7, order {[row['unit_id'] + ':' + row['seq_id'] for row in rows]}")
+    failed = []
+    if len(rows) != 7:
+        failed.append("rows missing with heartbeats")
+    if dates != sorted(dates):
+        failed.append("a heartbeat let rows pass an exposure not yet published")
+    return failed
+
+
+failed = []
+with tempfile.TemporaryDirectory() as tmp:
+    failed += check_merge(os.path.join(tmp, 'merge'))
+    failed += check_backpressure(os.path.join(tmp, 'backpressure'))
+    failed += check_heartbeat(os.path.join(tmp, 'heartbeat'))
+
+if failed:
+    print(f"Fleet check failed: {', '.join(failed)}")
+    sys.exit(1)
+print("Fleet check passed.")
@@ -0,0 +1,72 @@
+"""
+
+This script is used to check the import time of the entry points.
+Each module is imported in a fresh interpreter (best of three runs) and
+must stay under its time budget without loading the modules it does not
+need at import (hardware drivers, SciPy, matplotlib, ephem, pandas).
+The script exits with an error if a module is too slow or loads one of them.
+
+"""
+import os
+import subprocess
+import sys
+import time
+
+# module: (time budget [s] on top of the interpreter startup, modules that must not be loaded)
+HARDWARE = ['photodiode', 'skyhunter', 'twmdb', 'pyvisa', 'serial']
+HEAVY = ['scipy', 'matplotlib', 'ephem']
+ENTRY_POINTS = {
+    'scheduler': (0.3, HARDWARE + HEAVY + ['pandas']),
+    'mount_controller': (0.3, HARDWARE + HEAVY + ['pandas']),
+    'twilightSunAltAz': (0.3, HARDWARE + HEAVY + ['pytz', 'pandas']),
+    'loader': (0.3, HARDWARE + HEAVY + ['pandas']),
+    'quicklook': (0.3, HARDWARE + HEAVY + ['pandas']),
+    'fleet': (0.3, HARDWARE + HEAVY + ['pandas']),
+    'archive': (0.3, HARDWARE + HEAVY + ['pandas']),
+    'priority': (0.3, HARDWARE + HEAVY + ['pandas']),
+    'reduction': (1.0, HARDWARE + HEAVY),
+    'pointing': (1.0, HARDWARE + HEAVY),
+    'rawstats': (1.0, HARDWARE + HEAVY),
+    'replay': (1.0, HARDWARE + HEAVY),
+    'benchmark': (1.0, HARDWARE + HEAVY),
+    'optimizer': (1.0, HARDWARE + HEAVY),
+}
+NRUNS = 3
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_time(code):
+    best = None
+    for i in range(NRUNS):
+        t0 = time.perf_counter()
+        res = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+startup, _ = import_time('pass')
+print(f"Interpreter startup: {startup:0.3f} seconds")
+
+failed = []
+for module, (budget, forbidden) in ENTRY_POINTS.items():
+    code = f"import sys, {module}; print(','.join(m for m in {forbidden!r} if m in sys.modules))"
+    elapsed, res = import_time(code)
+    if res.returncode != 0:
+        print(f"{module:>18s}: import failed: {res.stderr.strip().splitlines()[-1]}")
+        failed.append(module)
+        continue
+    loaded = res.stdout.strip().splitlines()[-1] if res.stdout.strip() else ''
+    elapsed -= startup
+    status = "ok"
+    if elapsed > budget:
+        status = f"too slow (budget {budget:0.2f} seconds)"
+    if loaded:
+        status = f"loads {loaded} at import"
+    if status != "ok":
+        failed.append(module)
+    print(f"{module:>18s}: {elapsed:0.3f} seconds, {status}")
+
+if failed:
+    print(f"Import time check failed: {', '.join(failed)}")
+    sys.exit(1)
+print("Import time check passed.")
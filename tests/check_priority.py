@@ -0,0 +1,154 @@
+"""
+
+This script is used to check the map prioritization on the archived nights.
+- `RateEstimator` starts from the rates of past nights and follows the visits
+- `plan_map` visits every pointing, spends the visit budget and fits in `max_time`
+- `choose_plan` keeps the priority plan only within the raster map time and
+  with a lower time skew, the raster order otherwise
+- `Scheduler.map_pointings` on the replay devices (timing fitted from the
+  archive) takes the time of `plan_times` and `reduction.time_correct_map`
+  brings the map to one reference time
+The script exits with an error if a check fails.
+
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+import pandas as pd
+
+from loader import list_nights, load_dataframe, load_nights, night_filename
+from optimizer import fit_timing_model
+from priority import (RateEstimator, choose_plan, fit_region_rates, grid_pointings, map_skew, nearest_rate,
+                      plan_map, plan_times, raster_plan)
+from reduction import reduce_maps, time_correct_map
+from replay import DEFAULT_TIMING, RecordedNight, ReplayDatabase, VirtualClock, make_devices
+from scheduler import Scheduler
+
+REPLAY_NIGHT = '20241002'
+TIME_TOLERANCE = 0.02  # fraction of the expected map time
+
+
+def check_estimator():
+    prior = pd.DataFrame({'Alt': [70., 40.], 'Az': [0., -90.], 'rate': [-0.2, -0.05], 'nnights': [2, 2]})
+    estimator = RateEstimator(prior=prior)
+    p = {'alt': 66., 'az': -10., 'alt_rank': 2, 'az_rank': 1}
+    before = estimator.rate(p)
+    t0 = 1727910000.
+    estimator.update(p, t0, -1e-8)
+    estimator.update(p, t0 + 120., -1e-8*10**(-0.3*2))
+    after = estimator.rate(p)
+    estimator.update(p, t0 + 240., -1e-8*10**(-0.3*2 - 0.1*2))
+    smoothed = estimator.rate(p)
+    print(f"estimator: prior {before:0.3f}, after two visits {after:0.3f}, after three {smoothed:0.3f} dex/min")
+    failed = []
+    if before != -0.2:
+        failed.append("estimator prior rate")
+    if not np.isclose(after, -0.3) or not np.isclose(smoothed, -0.2):
+        failed.append("estimator running rate")
+    return failed
+
+
+def check_plan(rates, timing):
+    pointings = grid_pointings()
+    plan = plan_map(pointings, rates)
+    visits = [sum(v['az_rank'] == p['az_rank'] and v['alt_rank'] == p['alt_rank'] for v in plan) for p in pointings]
+    raster_time = plan_times(raster_plan(pointings), timing)[-1]
+    short = plan_map(pointings, rates, max_time=0.8*raster_time, timing=timing)
+    print(f"plan: {len(plan)} visits, {min(visits)} to {max(visits)} per pointing; "
+          f"{len(short)} visits in {plan_times(short, timing)[-1]/60.:0.2f} of {0.8*raster_time/60.:0.2f} min")
+    failed = []
+    if len(plan) != 2*len(pointings) or min(visits) < 1:
+        failed.append("plan visit budget")
+    if any(v['nvisits'] != n for p, n in zip(pointings, visits) for v in plan
+           if (v['az_rank'], v['alt_rank']) == (p['az_rank'], p['alt_rank'])):
+        failed.append("plan nvisits")
+    if plan_times(short, timing)[-1] > 0.8*raster_time or len(short) < len(pointings):
+        failed.append("plan max_time")
+    return failed
+
+
+def check_choice(rates, timing):
+    pointings = grid_pointings()
+    rate = {(p['az_rank'], p['alt_rank']): r for p, r in zip(pointings, rates)}
+    raster = raster_plan(pointings)
+    raster_times = plan_times(raster, timing)
+    plan, priority = choose_plan(pointings, rates, timing)
+    times = plan_times(plan, timing)
+    print(f"choice: {'priority' if priority else 'raster'} order, {times[-1]/60.:0.2f} min, "
+          f"skew {map_skew(plan, times, rate):0.4f} dex (raster {raster_times[-1]/60.:0.2f} min, "
+          f"{map_skew(raster, raster_times, rate):0.4f} dex)")
+    failed = []
+    if times[-1] > raster_times[-1] + 1e-6:
+        failed.append("priority plan longer than the raster map")
+    if map_skew(plan, times, rate) > map_skew(raster, raster_times, rate) + 1e-9:
+        failed.append("priority plan with a larger skew than the raster map")
+    # no rates (empty table): the priority plan does not lower the skew, the raster order is kept
+    plan, priority = choose_plan(pointings, [0.]*len(pointings), timing)
+    if priority or plan != raster:
+        failed.append("no fallback to the raster order")
+    return failed
+
+
+def check_map_pointings(rates, timing):
+    recorded = RecordedNight(night_filename(REPLAY_NIGHT, root))
+    timing = dict(timing, **{k: v for k, v in recorded.fit_timing().items() if k in timing})
+    pointings = grid_pointings()
+    plan, _ = choose_plan(pointings, rates, timing)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        clock = VirtualClock(recorded.start)
+        mount, photodiode = make_devices(clock, recorded, timing, jitter=False)
+        database = ReplayDatabase(tmp, save_vectors=False)
+        s = Scheduler(expTime=timing['exp_time'], filter=recorded.filter, mount=mount, photodiode=photodiode,
+                      database=database, clock=clock)
+        estimator = RateEstimator()
+        with contextlib.redirect_stdout(io.StringIO()):
+            visits = s.map_pointings(plan, estimator=estimator)
+        duration = clock.time() - recorded.start
+        expected = plan_times(plan, timing)[-1]
+        df = load_dataframe(os.path.join(tmp, 'DATA', REPLAY_NIGHT[:6], f'{REPLAY_NIGHT}.csv'), chile_time=False)
+
+    corrected = time_correct_map(df, rates={(p['az_rank'], p['alt_rank']): r for p, r in zip(pointings, rates)})
+    revisited = {(v['az_rank'], v['alt_rank']) for v in plan if v['visit'] == 2}
+    t_ref = corrected.attrs['t_ref']
+    print(f"map_pointings: {len(visits)} visits in {duration/60.:0.2f} min (expected {expected/60.:0.2f} min), "
+          f"{len(estimator.running)} rates updated, {len(corrected)} pointings corrected "
+          f"to {t_ref - recorded.start:0.0f} s")
+    failed = []
+    if len(visits) != len(plan) or len(s.mountDict['pointing_t_start']) != len(plan):
+        failed.append("map_pointings visits")
+    if abs(duration/expected - 1.) > TIME_TOLERANCE:
+        failed.append("map_pointings time differs from plan_times")
+    if set(estimator.running) != revisited:
+        failed.append("estimator not updated by map_pointings")
+    if len(corrected) != len(pointings) or not np.isfinite(corrected['current_corr']).all():
+        failed.append("time_correct_map pointings")
+    if not df['date'].min()/1e6 <= t_ref <= df['date'].max()/1e6:
+        failed.append("time_correct_map reference time")
+    return failed
+
+
+nights = list_nights(root)
+with contextlib.redirect_stdout(io.StringIO()):
+    table = fit_region_rates(reduce_maps(load_nights(nights, chile_time=False)))
+    model = fit_timing_model(nights)
+timing = dict(DEFAULT_TIMING, **{k: v for k, v in model.items() if k in DEFAULT_TIMING})
+rates = [nearest_rate(table, p['alt'], p['az']) for p in grid_pointings()]
+print(f"{len(table)} regions from {len(nights)} nights")
+
+failed = check_estimator()
+failed += check_plan(rates, timing)
+failed += check_choice(rates, timing)
+failed += check_map_pointings(rates, timing)
+
+if failed:
+    print(f"Priority check failed: {', '.join(failed)}")
+    sys.exit(1)
+print("Priority check passed.")
@@ -0,0 +1,54 @@
+"""
+
+This script is used to check the replay timing against the archived nights.
+Each night of the `DATA` folder is replayed with the sweep parameters and
+the timing model fitted from it (`RecordedNight.fit_timing`), run by run:
+- the replay must give the recorded number of complete maps
+- the mean duration of the complete maps must be within DURATION_TOLERANCE
+  of the recorded one
+The nights without a complete map (test runs, nights without ranks) are skipped.
+The script exits with an error if a check fails.
+
+"""
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import numpy as np
+
+from loader import list_nights
+from replay import replay_night
+
+DURATION_TOLERANCE = 0.10  # fraction of the recorded map duration
+
+failed = []
+nchecked = 0
+for night in list_nights(root):
+    name = os.path.basename(night)[:8]
+    try:
+        res = replay_night(night)
+    except ValueError as e:
+        print(f"{name}: skipped ({e})")
+        continue
+    if not res['recorded_nmaps']:
+        print(f"{name}: skipped (no complete map recorded)")
+        continue
+
+    nchecked += 1
+    error = res['map_duration']/res['recorded_map_duration'] - 1.
+    print(f"{name}: {res['nmaps']} maps of {res['map_duration']:0.2f} min replayed, "
+          f"{res['recorded_nmaps']} maps of {res['recorded_map_duration']:0.2f} min recorded ({100*error:+0.1f}%)")
+    if res['nmaps'] != res['recorded_nmaps']:
+        failed.append(f"{name} map count")
+    if not np.abs(error) <= DURATION_TOLERANCE:
+        failed.append(f"{name} map duration")
+
+if not nchecked:
+    failed.append("no night with a complete map")
+
+if failed:
+    print(f"Replay check failed: {', '.join(failed)}")
+    sys.exit(1)
+print("Replay check passed.")
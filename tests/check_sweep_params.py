@@ -0,0 +1,71 @@
+"""
+
+This script is used to check the sweep parameter files of the Scheduler.
+- a file loaded on a single unit sets the azimuth and elevation parameters
+- a file loaded on a fleet unit keeps its azimuth sector (az_steps and
+  az_slew_time of `fleet.plan_fleet`) and sets the elevation parameters
+- `validate_sweep_params` rejects the missing, out of range and boolean values
+The script exits with an error if a check fails.
+
+"""
+import json
+import os
+import sys
+import tempfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from fleet import plan_fleet
+from scheduler import Scheduler, validate_sweep_params
+
+PARAMS = {'az_steps': 9, 'az_slew_time': 5.2, 'el_steps': 6, 'el_slew_time': 2.1,
+          'photodiode_delay': 2.5, 'el_corrections': [1.2, 1.0, 1.0, 1.0, 1.0, 1.0]}
+
+
+def load(fname, plan=None):
+    s = Scheduler()
+    if plan is not None:
+        s.set_azimuth_sweep_params(**plan)
+    s.load_sweep_params(fname)
+    return s
+
+
+failed = []
+with tempfile.TemporaryDirectory() as tmp:
+    fname = os.path.join(tmp, 'sweep_params.json')
+    with open(fname, 'w') as f:
+        json.dump({'params': PARAMS}, f)
+
+    s = load(fname)
+    print(f"single unit: az_steps {s.az_steps}, az_slew_time {s.az_slew_time}, el_steps {s.el_steps}")
+    if (s.az_steps, s.az_slew_time, s.az_start, s.az_end) != (9, 5.2, 0.0, -179.0):
+        failed.append("single unit azimuth parameters")
+    if (s.el_steps, s.el_slew_time, s.photodiode_delay) != (6, 2.1, 2.5):
+        failed.append("single unit elevation parameters")
+
+    for unit_id, plan in plan_fleet(['unit1', 'unit2'], az_steps=7).items():
+        s = load(fname, plan)
+        print(f"{unit_id}: az_steps {s.az_steps}, az_slew_time {s.az_slew_time}, "
+              f"az {s.az_start} to {s.az_end}, az_rank0 {s.az_rank0}, el_steps {s.el_steps}")
+        if any(getattr(s, key) != value for key, value in plan.items()):
+            failed.append(f"{unit_id} azimuth sector")
+        if (s.el_steps, s.el_slew_time, s.photodiode_delay) != (6, 2.1, 2.5):
+            failed.append(f"{unit_id} elevation parameters")
+
+bad = {'missing': {k: v for k, v in PARAMS.items() if k != 'el_steps'},
+       'out of range': dict(PARAMS, az_slew_time=100.),
+       'boolean steps': dict(PARAMS, el_steps=True),
+       'boolean correction': dict(PARAMS, el_corrections=[True, 1.0, 1.0]),
+       'string correction': dict(PARAMS, el_corrections=['1.0'])}
+for name, params in bad.items():
+    try:
+        validate_sweep_params(params)
+        failed.append(f"{name} accepted")
+    except ValueError as e:
+        print(f"{name}: rejected ({e})")
+
+if failed:
+    print(f"Sweep parameter check failed: {', '.join(failed)}")
+    sys.exit(1)
+print("Sweep parameter check passed.")
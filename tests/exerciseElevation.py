@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import time
 
@@ -77,7 +76,8 @@ if __name__ == "__main__":
         d = np.load(f'./tmp/{name}_forward.npz')
         maps.append(d)
 
-    # Plot the results
+    # Plot the results (matplotlib is only needed here)
+    import matplotlib.pyplot as plt
     fig, ax = plt.subplots()
     evals = []
     evals2 = []